@@ -0,0 +1,1054 @@
+# stdlib modules
+import argparse
+import asyncio
+import cProfile
+import json
+import multiprocessing
+import os
+import platform
+import pstats
+import subprocess
+import time
+import tracemalloc
+from typing import Callable, List, Tuple
+
+# third-party modules
+import networkx as nx
+import numpy as np
+from numpy import ndarray
+import pandas as pd
+
+# local modules
+import cache
+import graph
+import grid
+import ingest
+import metrics
+import projection
+import service
+import tree
+import utils
+
+
+def random_points(n: int, seed: int = 0) -> Tuple[ndarray, ndarray, ndarray]:
+    """Generates n uniformly distributed points over the same square used by
+    main.py for random query points.
+    ---------------------------------------------------------------------------
+    Args:
+        n: number of points
+        seed: random generator seed
+    Returns:
+        ids, xs, ys: point ids and coordinates"""
+    rng = np.random.default_rng(seed)
+    xs, ys = rng.uniform(-6, 7, size=(2, n))
+
+    return np.arange(n), xs, ys
+
+def clustered_points(
+        n: int,
+        seed: int = 0,
+        clusters: int = 20,
+        spread: float = 0.3) -> Tuple[ndarray, ndarray, ndarray]:
+    """Generates n points around a few gaussian clusters whose centers are
+    uniformly distributed over the same square as random_points.
+    ---------------------------------------------------------------------------
+    Args:
+        n: number of points
+        seed: random generator seed
+        clusters: number of clusters
+        spread: standard deviation of points around cluster centers
+    Returns:
+        ids, xs, ys: point ids and coordinates"""
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(-6, 7, size=(clusters, 2))
+    xs, ys = (centers[rng.integers(0, clusters, n)]
+              + rng.normal(scale=spread, size=(n, 2))).T
+
+    return np.arange(n), xs, ys
+
+def best_time(fn: Callable, repeat: int = 3) -> float:
+    """Returns best wall time in seconds among several runs of fn."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+def bench_build(args: argparse.Namespace) -> None:
+    """Tree build time as a function of the number of points."""
+    print(f"{'n':>9} {'build [s]':>10} {'us/point':>9}")
+    for n in args.sizes:
+        ids, xs, ys = random_points(n, args.seed)
+        t = best_time(lambda: tree.Tree(ids, xs, ys), args.repeat)
+        print(f"{n:>9} {t:>10.4f} {1e6 * t / n:>9.2f}")
+
+def bench_layout(args: argparse.Namespace) -> None:
+    """Memory use per point, build and query time of linked and flat trees."""
+    print(f"{'n':>9} {'layout':>7} {'bytes/point':>12} {'build [s]':>10} "
+          f"{'query [us]':>11}")
+    for n in args.sizes:
+        ids, xs, ys = random_points(n, args.seed)
+        _, qx, qy = random_points(args.queries, args.seed + 1)
+        for name, cls in (('linked', tree.Tree), ('flat', tree.FlatTree)):
+            # measure memory retained by the built tree
+            tracemalloc.start()
+            T = cls(ids, xs, ys)
+            size, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del T
+            t_build = best_time(lambda: cls(ids, xs, ys), args.repeat)
+            T = cls(ids, xs, ys)
+            def queries():
+                for q in zip(qx, qy):
+                    T.nearest_neighbors(q, T.root, k=args.k)
+            t_query = best_time(queries, args.repeat) / args.queries
+            print(f"{n:>9} {name:>7} {size / n:>12.1f} {t_build:>10.4f} "
+                  f"{1e6 * t_query:>11.2f}")
+
+def bench_query(args: argparse.Namespace) -> None:
+    """Throughput of per-point nearest_neighbors calls vs batched queries."""
+    print(f"{'n':>9} {'layout':>7} {'loop [q/s]':>11} {'batch [q/s]':>12}")
+    for n in args.sizes:
+        ids, xs, ys = random_points(n, args.seed)
+        _, qx, qy = random_points(args.queries, args.seed + 1)
+        points = np.column_stack([qx, qy])
+        for name, cls in (('linked', tree.Tree), ('flat', tree.FlatTree)):
+            T = cls(ids, xs, ys)
+            # time per-point queries over a subset, they are much slower
+            m = min(args.queries, 1000)
+            def loop():
+                for q in points[:m]:
+                    T.nearest_neighbors(q, T.root, k=args.k)
+            t_loop = best_time(loop, args.repeat) / m
+            t_batch = best_time(lambda: T.query(points, args.k), args.repeat)
+            t_batch /= args.queries
+            print(f"{n:>9} {name:>7} {1 / t_loop:>11.0f} {1 / t_batch:>12.0f}")
+
+def bench_leaf(args: argparse.Namespace) -> None:
+    """Build time and query throughput of Tree as a function of leaf size."""
+    print(f"{'n':>9} {'leaf_size':>9} {'build [s]':>10} {'loop [q/s]':>11} "
+          f"{'batch [q/s]':>12}")
+    for n in args.sizes:
+        ids, xs, ys = random_points(n, args.seed)
+        _, qx, qy = random_points(args.queries, args.seed + 1)
+        points = np.column_stack([qx, qy])
+        for leaf_size in args.leaf_sizes:
+            build = lambda: tree.Tree(ids, xs, ys, leaf_size=leaf_size)
+            t_build = best_time(build, args.repeat)
+            T = build()
+            m = min(args.queries, 1000)
+            def loop():
+                for q in points[:m]:
+                    T.nearest_neighbors(q, T.root, k=args.k)
+            t_loop = best_time(loop, args.repeat) / m
+            t_batch = best_time(lambda: T.query(points, args.k), args.repeat)
+            t_batch /= args.queries
+            print(f"{n:>9} {leaf_size:>9} {t_build:>10.4f} {1 / t_loop:>11.0f} "
+                  f"{1 / t_batch:>12.0f}")
+
+def bench_grid(args: argparse.Namespace) -> None:
+    """Nearest stations snapping throughput of the grid spatial hash against
+    the tree, over uniform and clustered stations and queries."""
+    print(f"{'stations':>9} {'queries':>9} {'n':>8} {'index':>7} "
+          f"{'build [s]':>10} {'loop [q/s]':>11} {'batch [q/s]':>12} "
+          f"{'agree':>6}")
+    generators = {'uniform': random_points, 'clustered': clustered_points}
+    for data in args.data:
+        for n in args.sizes:
+            ids, xs, ys = generators[data](n, args.seed)
+            for queries in args.data:
+                _, qx, qy = generators[queries](args.queries, args.seed + 1)
+                points = np.column_stack([qx, qy])
+                m = min(args.queries, 1000) # per-point loops are slower
+                reference = None
+                for name, build in (
+                        ('tree', lambda: tree.Tree(ids, xs, ys)),
+                        ('tree16', lambda: tree.Tree(ids, xs, ys,
+                                                     leaf_size=16)),
+                        ('grid', lambda: grid.Grid(ids, xs, ys))):
+                    t_build = best_time(build, args.repeat)
+                    index = build()
+                    if name == 'grid':
+                        loop = lambda: [index.nearest(q, args.k)
+                                        for q in points[:m]]
+                    else:
+                        loop = lambda: [index.nearest_neighbors(q, index.root,
+                                                                k=args.k)
+                                        for q in points[:m]]
+                    t_loop = best_time(loop, args.repeat) / m
+                    t_batch = best_time(lambda: index.query(points, args.k),
+                                        args.repeat) / args.queries
+                    dists, _ = index.query(points, args.k)
+                    if reference is None:
+                        reference = dists
+                    agree = np.allclose(dists, reference)
+                    print(f"{data:>9} {queries:>9} {n:>8} {name:>7} "
+                          f"{t_build:>10.4f} {1 / t_loop:>11.0f} "
+                          f"{1 / t_batch:>12.0f} {str(agree):>6}")
+
+def random_graph(n: int, k: int, seed: int = 0):
+    """Builds a k-nearest neighbors graph and its tree over n random points."""
+    ids, xs, ys = random_points(n, seed)
+    T = tree.Tree(ids, xs, ys)
+
+    return graph.build_graph(ids, xs, ys, k=k, T=T), T
+
+def bench_route(args: argparse.Namespace) -> None:
+    """Shortest-path query time for each graph engine and method, and whether
+    path lengths agree with the first one. Paths themselves may differ among
+    ties, see graph.path_plan."""
+    print(f"{'n':>9} {'engine':>9} {'method':>18} {'query [ms]':>11} "
+          f"{'agree':>6}")
+    for n in args.sizes:
+        G, _ = random_graph(n, args.k, args.seed)
+        C = graph.CSRGraph(G)
+        rng = np.random.default_rng(args.seed + 1)
+        pairs = rng.integers(0, n, size=(args.queries, 2))
+        reference = None
+        for engine, H in (('networkx', G), ('csr', C)):
+            for method in args.methods:
+                def queries():
+                    paths = []
+                    for p, q in pairs:
+                        try:
+                            paths.append(graph.path_plan(p, q, H,
+                                                         method=method)[1])
+                        except RuntimeError: # disconnected pair
+                            paths.append(None)
+                    return paths
+                t = best_time(queries, args.repeat) / args.queries
+                lengths = [np.inf if path is None else
+                           graph.path_length(H, path) for path in queries()]
+                if reference is None:
+                    reference = lengths
+                agree = np.allclose(lengths, reference)
+                print(f"{n:>9} {engine:>9} {method:>18} {1e3 * t:>11.3f} "
+                      f"{str(agree):>6}")
+
+def bench_profile(args: argparse.Namespace) -> None:
+    """Cost of changing edge weights by swapping a CSR weight profile against
+    rewriting networkx weights and compiling the graph again, along with
+    query time under each profile."""
+    print(f"{'n':>9} {'update':>8} {'update [ms]':>12} {'query [ms]':>11}")
+    for n in args.sizes:
+        G, _ = random_graph(n, args.k, args.seed)
+        C = graph.CSRGraph(G)
+        rng = np.random.default_rng(args.seed + 1)
+        pairs = rng.integers(0, n, size=(args.queries, 2))
+        factors = rng.uniform(0.8, 2., size=(24, len(C.edge_w))) # per hour
+        full = rng.choice(n, size=max(1, n // 20), replace=False).tolist()
+        profiles = [graph.weight_profile(C, factors[h], dict.fromkeys(full, 4.))
+                    for h in range(args.hours)]
+
+        def rewrite(m):
+            weights = {(C.ids[u], C.ids[v]): w for u, v, w in
+                       zip(C.edge_u.tolist(), C.edge_v.tolist(),
+                           (C.base_edge_w * m).tolist())}
+            H = G.copy()
+            nx.set_edge_attributes(H, weights, 'weight')
+            return graph.CSRGraph(H)
+
+        def queries(H):
+            for p, q in pairs:
+                try:
+                    graph.path_plan(p, q, H, method=args.method)
+                except RuntimeError: # disconnected pair
+                    pass
+
+        for name, update in (('rebuild', rewrite), ('swap', C.set_profile)):
+            t_update = best_time(lambda: [update(m) for m in profiles],
+                                 args.repeat) / len(profiles)
+            # swaps left the last profile set on C
+            H = C if name == 'swap' else rewrite(profiles[-1])
+            t_query = best_time(lambda: queries(H), args.repeat) / args.queries
+            print(f"{n:>9} {name:>8} {1e3 * t_update:>12.3f} "
+                  f"{1e3 * t_query:>11.3f}")
+        C.set_profile(None)
+
+def bench_knn_graph(args: argparse.Namespace) -> None:
+    """k-nearest neighbors graph build time, serial and across processes, and
+    whether parallel builds match the serial one."""
+    print(f"{'n':>9} {'workers':>8} {'build [s]':>10} {'identical':>10}")
+    for n in args.sizes:
+        ids, xs, ys = random_points(n, args.seed)
+        start = time.perf_counter()
+        G = graph.build_graph(ids, xs, ys, k=args.k)
+        print(f"{n:>9} {'serial':>8} {time.perf_counter() - start:>10.3f}")
+        for workers in args.workers:
+            start = time.perf_counter()
+            H = graph.build_graph(ids, xs, ys, k=args.k, workers=workers)
+            t = time.perf_counter() - start
+            same = all(list(G.adj[u].items()) == list(H.adj[u].items())
+                       for u in G) and list(G) == list(H)
+            print(f"{n:>9} {workers:>8} {t:>10.3f} {str(same):>10}")
+
+def bench_concurrency(args: argparse.Namespace) -> None:
+    """Routing throughput of path_plan_many over a shared graph."""
+    G, T = random_graph(args.size, args.k, args.seed)
+    C = graph.CSRGraph(G)
+    rng = np.random.default_rng(args.seed + 1)
+    pairs = rng.uniform(-6, 7, size=(args.queries, 2, 2))
+    print(f"{'engine':>9} {'executor':>9} {'workers':>8} {'routes/s':>9}")
+    for engine, H in (('networkx', G), ('csr', C)):
+        for executor in args.executors:
+            for workers in args.workers:
+                plan = lambda: graph.path_plan_many(H, T, pairs, k=args.k,
+                                                    workers=workers,
+                                                    executor=executor)
+                t = best_time(plan, args.repeat)
+                print(f"{engine:>9} {executor:>9} {workers:>8} "
+                      f"{args.queries / t:>9.0f}")
+
+def bench_settled(args: argparse.Namespace) -> None:
+    """Nodes settled and time per point-to-point query for full, early-exit
+    and bidirectional Dijkstra's searches and A* search."""
+    print(f"{'n':>9} {'search':>13} {'settled':>9} {'query [ms]':>11}")
+    for n in args.sizes:
+        G, _ = random_graph(n, args.k, args.seed)
+        rng = np.random.default_rng(args.seed + 1)
+        pairs = rng.integers(0, n, size=(args.queries, 2)).tolist()
+        nbrs = lambda u: ((v, data['weight']) for v, data in G.adj[u].items())
+        coords = lambda u: graph.node_coords(G, u)
+        searches = (
+            ('full', lambda s, t: graph.dijkstra_search(G, s)[2]),
+            ('early-exit', lambda s, t: graph.dijkstra_search(G, s, t)[2]),
+            ('bidirectional',
+             lambda s, t: graph.bidirectional_search(nbrs, s, t)[1]),
+            ('astar', lambda s, t: graph.astar_search(
+                nbrs, graph.euclidean_heuristic(coords, t), s, t)[2]))
+        for name, search in searches:
+            settled = np.mean([search(s, t) for s, t in pairs])
+            t = best_time(lambda: [search(s, t) for s, t in pairs], args.repeat)
+            print(f"{n:>9} {name:>13} {settled:>9.1f} "
+                  f"{1e3 * t / args.queries:>11.3f}")
+
+def bench_bellman(args: argparse.Namespace) -> None:
+    """Sweeps, queue pops and time per query of Bellman-Ford search modes."""
+    print(f"{'n':>9} {'mode':>7} {'work':>9} {'query [ms]':>11}")
+    for n in args.sizes:
+        G, _ = random_graph(n, args.k, args.seed)
+        C = graph.CSRGraph(G)
+        rng = np.random.default_rng(args.seed + 1)
+        sources = rng.integers(0, n, size=args.queries).tolist()
+        E = list(zip(C.edge_u.tolist(), C.edge_v.tolist(), C.edge_w.tolist()))
+        indptr, indices = C.indptr.tolist(), C.indices.tolist()
+        weights = C.weights.tolist()
+        nbrs = lambda u: zip(indices[indptr[u]:indptr[u+1]],
+                             weights[indptr[u]:indptr[u+1]])
+        def init():
+            return [np.inf] * n, [-1] * n
+        def sweep(s):
+            d, pred = init()
+            d[s] = 0.
+            return graph.bellman_ford_search(E, d, pred)
+        def spfa(s):
+            d, pred = init()
+            d[s] = 0.
+            return graph.spfa_search(nbrs, d, pred, s)
+        def vectorized(s):
+            return graph.numpy_bellman_ford_search(C.edge_u, C.edge_v, C.edge_w,
+                                                   n, s)[2]
+        # work is sweeps for sweep modes and queue pops for spfa
+        for name, search in (('sweep', sweep), ('spfa', spfa),
+                             ('numpy', vectorized)):
+            work = np.mean([search(s) for s in sources])
+            t = best_time(lambda: [search(s) for s in sources], args.repeat)
+            print(f"{n:>9} {name:>7} {work:>9.1f} "
+                  f"{1e3 * t / args.queries:>11.3f}")
+
+def bench_apsp(args: argparse.Namespace) -> None:
+    """All-pairs matrices build time per number of workers, cached load time
+    and path query time from the matrices vs point-to-point Dijkstra."""
+    print(f"{'n':>9} {'stage':>12} {'workers':>8} {'time [ms]':>10}")
+    for n in args.sizes:
+        G, _ = random_graph(n, args.k, args.seed)
+        prefix = os.path.join(args.cache_dir, f'bench_{n}')
+        os.makedirs(args.cache_dir, exist_ok=True)
+        for workers in args.workers:
+            t = best_time(lambda: graph.all_pairs(G, prefix, workers=workers),
+                          args.repeat)
+            print(f"{n:>9} {'build':>12} {workers:>8} {1e3 * t:>10.1f}")
+        t = best_time(lambda: graph.AllPairs.load(prefix), args.repeat)
+        print(f"{n:>9} {'load':>12} {'':>8} {1e3 * t:>10.3f}")
+        A = graph.AllPairs.load(prefix)
+        rng = np.random.default_rng(args.seed + 1)
+        pairs = rng.integers(0, n, size=(args.queries, 2)).tolist()
+        for name, route in (('matrix path', A.path),
+                            ('dijkstra', lambda p, q: graph.dijkstra_path(G, p,
+                                                                          q))):
+            def queries():
+                for p, q in pairs:
+                    try:
+                        route(p, q)
+                    except RuntimeError: # disconnected pair
+                        pass
+            t = best_time(queries, args.repeat) / args.queries
+            print(f"{n:>9} {name:>12} {'':>8} {1e3 * t:>10.4f}")
+
+def bench_ch(args: argparse.Namespace) -> None:
+    """Contraction hierarchy preprocessing time, index size and query latency
+    percentiles vs Dijkstra's search over the compiled graph."""
+    print(f"{'n':>9} {'prep [s]':>9} {'shortcuts':>10} {'size [kB]':>10} "
+          f"{'search':>9} {'p50 [us]':>9} {'p90 [us]':>9} {'p99 [us]':>9} "
+          f"{'identical':>10}")
+    for n in args.sizes:
+        G, _ = random_graph(n, args.k, args.seed)
+        C = graph.CSRGraph(G)
+        start = time.perf_counter()
+        H = graph.ContractionHierarchy(C)
+        t_prep = time.perf_counter() - start
+        shortcuts = int((H.mid >= 0).sum())
+        rng = np.random.default_rng(args.seed + 1)
+        pairs = rng.integers(0, n, size=(args.queries, 2)).tolist()
+        paths = {}
+        for name, H_ in (('dijkstra', C), ('ch', H)):
+            times, paths[name] = [], []
+            for p, q in pairs:
+                start = time.perf_counter()
+                try:
+                    _, path = graph.path_plan(p, q, H_)
+                except RuntimeError: # disconnected pair
+                    path = None
+                times.append(time.perf_counter() - start)
+                paths[name].append(path)
+            p50, p90, p99 = 1e6 * np.percentile(times, [50, 90, 99])
+            same = np.mean([a == b for a, b in zip(paths['dijkstra'],
+                                                   paths[name])])
+            print(f"{n:>9} {t_prep:>9.3f} {shortcuts:>10} "
+                  f"{H.nbytes / 1024:>10.1f} {name:>9} {p50:>9.1f} {p90:>9.1f} "
+                  f"{p99:>9.1f} {same:>10.3f}")
+
+def bench_cache(args: argparse.Namespace) -> None:
+    """Routing time with and without the route cache over a workload of
+    repeated hotspot origins and destinations."""
+    G, T = random_graph(args.size, args.k, args.seed)
+    rng = np.random.default_rng(args.seed + 1)
+    hubs = rng.uniform(-6, 7, size=(args.hotspots, 2))
+    # queries land anywhere within a few meters around a hotspot
+    pairs = hubs[rng.integers(0, args.hotspots, size=(args.queries, 2))]
+    pairs += rng.normal(scale=args.spread, size=pairs.shape)
+    print(f"{'routing':>9} {'cell':>6} {'route [us]':>11} {'snap hits':>10} "
+          f"{'seg hits':>9}")
+    t = best_time(lambda: [graph.plan_points(G, T, p, q, k=args.k)
+                           for p, q in pairs], 1)
+    print(f"{'plain':>9} {'':>6} {1e6 * t / args.queries:>11.1f}")
+    for cell in args.cells:
+        R = cache.RouteCache(G, T, k=args.k, cell=cell, maxsize=args.maxsize)
+        t = best_time(lambda: [R.route(p, q) for p, q in pairs], 1)
+        stats = R.stats()
+        rate = lambda c: c['hits'] / max(1, c['hits'] + c['misses'])
+        print(f"{'cached':>9} {cell:>6} {1e6 * t / args.queries:>11.1f} "
+              f"{rate(stats['snaps']):>10.3f} {rate(stats['segments']):>9.3f}")
+
+def _serve_synthetic(args: argparse.Namespace, window: float,
+                     ports: multiprocessing.Queue) -> None:
+    """Runs a route service over a synthetic graph, sending its port once it
+    listens."""
+    G, T = random_graph(args.size, args.k, args.seed)
+    routes = service.RouteService(G, T, k=args.k, method=args.method,
+                                  window=window)
+
+    async def serve():
+        ready = asyncio.Event()
+        task = asyncio.create_task(routes.serve('127.0.0.1', 0, ready))
+        await ready.wait()
+        ports.put(routes.port)
+        await task
+
+    asyncio.run(serve())
+
+async def _request(reader, writer, method: str, target: str,
+                   body: dict = None) -> dict:
+    """Sends a request over a keep-alive connection and reads its response."""
+    data = b'' if body is None else json.dumps(body).encode()
+    writer.write(f'{method} {target} HTTP/1.1\r\nHost: localhost\r\n'
+                 f'Content-Length: {len(data)}\r\n\r\n'.encode() + data)
+    await writer.drain()
+    await reader.readline() # status line
+    length = 0
+    while True:
+        header = await reader.readline()
+        if header in (b'\r\n', b''):
+            break
+        name, _, value = header.decode().partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+
+    return json.loads(await reader.readexactly(length))
+
+async def _load(port: int, requests: List[tuple], clients: int) -> tuple:
+    """Replays requests over concurrent keep-alive connections.
+    ---------------------------------------------------------------------------
+    Args:
+        port: service port
+        requests: list of (target, body) requests
+        clients: number of concurrent connections
+    Returns:
+        latencies: per-request latencies in seconds
+        elapsed: seconds to answer all the requests
+        health: service counters after the load"""
+    latencies = []
+
+    async def client(share):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        for target, body in share:
+            start = time.perf_counter()
+            await _request(reader, writer, 'POST', target, body)
+            latencies.append(time.perf_counter() - start)
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(requests[i::clients])
+                           for i in range(clients)))
+    elapsed = time.perf_counter() - start
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    health = await _request(reader, writer, 'GET', '/health')
+    writer.close()
+
+    return np.array(latencies), elapsed, health
+
+def bench_service(args: argparse.Namespace) -> None:
+    """Throughput and latency of the route service under concurrent route and
+    nearest stations requests, for several snap batching windows. The service
+    runs in its own process."""
+    rng = np.random.default_rng(args.seed + 1)
+    points = rng.uniform(-6, 7, size=(args.requests, 2, 2)).tolist()
+    routes = rng.random(args.requests) < args.routes
+    requests = [('/route', {'p': p, 'q': q}) if r else
+                ('/nearest', {'point': p}) for (p, q), r in zip(points, routes)]
+    print(f"{'window [ms]':>12} {'clients':>8} {'req/s':>8} {'p50 [ms]':>9} "
+          f"{'p99 [ms]':>9} {'snaps/batch':>12}")
+    for window in args.windows:
+        ports = multiprocessing.Queue()
+        server = multiprocessing.Process(target=_serve_synthetic,
+                                         args=(args, window / 1e3, ports),
+                                         daemon=True)
+        server.start()
+        try:
+            port = ports.get(timeout=600)
+            for clients in args.clients:
+                latencies, elapsed, health = asyncio.run(
+                    _load(port, requests, clients))
+                p50, p99 = 1e3 * np.percentile(latencies, [50, 99])
+                print(f"{window:>12} {clients:>8} "
+                      f"{len(requests) / elapsed:>8.0f} {p50:>9.2f} "
+                      f"{p99:>9.2f} "
+                      f"{health['snaps'] / max(1, health['batches']):>12.1f}")
+        finally:
+            server.terminate()
+            server.join()
+
+def write_snapshot(fname: str, n: int, seed: int = 0) -> None:
+    """Writes a synthetic snapshot CSV with the columns of the real ones."""
+    rng = np.random.default_rng(seed)
+    lat = rng.uniform(20.6, 20.75, n)
+    lon = rng.uniform(-103.45, -103.3, n)
+    with open(fname, 'w', encoding='ISO-8859-1') as f:
+        f.write('id,name,obcn,location,latitude,longitude,status\n')
+        for i in range(n):
+            f.write(f'{i},Station {i},GDL-{i:06d},ZONE,{lat[i]:.6f},'
+                    f'{lon[i]:.6f},IN_SERVICE\n')
+
+def write_history(
+        dirname: str,
+        n: int,
+        months: int,
+        churn: float,
+        seed: int = 0) -> List[str]:
+    """Writes a series of synthetic monthly snapshots. Every month a fraction
+    churn of the stations is removed, as many are added, another fraction is
+    moved a few meters and another one is switched in or out of service.
+    ---------------------------------------------------------------------------
+    Args:
+        dirname: output directory
+        n: number of stations of the first snapshot
+        months: number of snapshots
+        churn: fraction of stations changed by each kind of update
+        seed: random generator seed
+    Returns:
+        fnames: snapshot file paths in chronological order"""
+    rng = np.random.default_rng(seed)
+    ids = np.arange(n)
+    lat, lon = rng.uniform(20.6, 20.75, n), rng.uniform(-103.45, -103.3, n)
+    status = np.full(n, 'IN_SERVICE', dtype='U14')
+    fnames = []
+    for month in range(months):
+        if month > 0:
+            m = max(1, int(churn * len(ids)))
+            keep = np.ones(len(ids), dtype=bool)
+            keep[rng.choice(len(ids), m, replace=False)] = False
+            ids, lat, lon, status = ids[keep], lat[keep], lon[keep], status[keep]
+            moved = rng.choice(len(ids), m, replace=False)
+            lat[moved] += rng.normal(scale=1e-4, size=m)
+            lon[moved] += rng.normal(scale=1e-4, size=m)
+            switched = rng.choice(len(ids), m, replace=False)
+            status[switched] = np.where(status[switched] == 'IN_SERVICE',
+                                        'NOT_IN_SERVICE', 'IN_SERVICE')
+            ids = np.append(ids, np.arange(m) + ids.max() + 1)
+            lat = np.append(lat, rng.uniform(20.6, 20.75, m))
+            lon = np.append(lon, rng.uniform(-103.45, -103.3, m))
+            status = np.append(status, np.full(m, 'IN_SERVICE'))
+        fname = os.path.join(dirname, f'nomenclatura_{n}_{month:03d}.csv')
+        with open(fname, 'w', encoding='ISO-8859-1') as f:
+            f.write('id,name,obcn,location,latitude,longitude,status\n')
+            for i, a, b, c in zip(ids, lat, lon, status):
+                f.write(f'{i},Station {i},GDL-{i:06d},ZONE,{a:.6f},{b:.6f},'
+                        f'{c}\n')
+        fnames.append(fname)
+
+    return fnames
+
+def bench_ingest(args: argparse.Namespace) -> None:
+    """Per-snapshot incremental update time vs full rebuild time over a
+    history of monthly snapshots."""
+    if args.files:
+        fnames = sorted(args.files)
+    else:
+        os.makedirs(args.cache_dir, exist_ok=True)
+        fnames = write_history(args.cache_dir, args.size, args.months,
+                               args.churn, args.seed)
+    print(f"{'snapshot':>28} {'added':>6} {'removed':>7} {'moved':>6} "
+          f"{'requeried':>9} {'update [ms]':>11} {'rebuild [ms]':>12}")
+    active = None if args.all_statuses else {'IN_SERVICE'}
+    for report in ingest.ingest_snapshots(fnames, k=args.k, active=active):
+        print(f"{os.path.basename(report['path']):>28} {report['added']:>6} "
+              f"{report['removed']:>7} {report['moved']:>6} "
+              f"{report['requeried']:>9} {1e3 * report['update']:>11.1f} "
+              f"{1e3 * report['rebuild']:>12.1f}")
+
+def bench_load(args: argparse.Namespace) -> None:
+    """Snapshot load time: full pandas parse, chunked parse and sidecar map."""
+    os.makedirs(args.cache_dir, exist_ok=True)
+    print(f"{'n':>9} {'loader':>9} {'time [ms]':>10}")
+    for n in args.sizes:
+        fname = os.path.join(args.cache_dir, f'snapshot_{n}.csv')
+        write_snapshot(fname, n, args.seed)
+        loaders = (
+            ('pandas', lambda: utils.to_global(pd.read_csv(
+                fname, encoding='ISO-8859-1')[['latitude', 'longitude']])),
+            ('chunked', lambda: utils.load_stations(fname, cache_dir=None)),
+            ('sidecar', lambda: utils.load_stations(fname,
+                                                    cache_dir=args.cache_dir)))
+        for name, load in loaders:
+            t = best_time(load, args.repeat)
+            print(f"{n:>9} {name:>9} {1e3 * t:>10.2f}")
+
+def bench_project(args: argparse.Namespace) -> None:
+    """Projection throughput of each projection vs utils.to_global."""
+    print(f"{'n':>9} {'projection':>16} {'time [ms]':>10} {'Mpoints/s':>10}")
+    for n in args.sizes:
+        rng = np.random.default_rng(args.seed)
+        lat, lon = rng.uniform(20.6, 20.75, n), rng.uniform(-103.45, -103.3, n)
+        df = pd.DataFrame({'latitude': lat, 'longitude': lon})
+        runs = [('to_global', lambda: utils.to_global(df))]
+        for kind, cls in projection.PROJECTIONS.items():
+            P = cls.centered(lat, lon)
+            runs.append((kind, lambda P=P: P.forward(lat, lon)))
+        runs.append(('haversine', lambda: projection.haversine(
+            lat[1:], lon[1:], lat[:-1], lon[:-1])))
+        for name, run in runs:
+            t = best_time(run, args.repeat)
+            print(f"{n:>9} {name:>16} {1e3 * t:>10.2f} {n / t / 1e6:>10.1f}")
+
+def bench_pipeline(args: argparse.Namespace) -> None:
+    """Times each stage of the routing pipeline over synthetic snapshots:
+    load, projection, tree build, graph build, query point connection and
+    shortest-path search for each method. Optionally captures a cProfile
+    dump and peak traced memory per stage, and writes a JSON report."""
+    generate = clustered_points if args.data == 'clustered' else random_points
+    report = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': platform.python_version(),
+                       'numpy': np.__version__, 'version': git_version(),
+                       'args': {k: v for k, v in vars(args).items()
+                                if k != 'run'}},
+              'runs': []}
+    profiler = cProfile.Profile() if args.profile else None
+    os.makedirs(args.cache_dir, exist_ok=True)
+    print(f"{'n':>9} {'stage':>34} {'total [ms]':>11} {'per item [us]':>14} "
+          f"{'peak [kB]':>10}")
+    for n in args.sizes:
+        run = {'n': n, 'stages': {}}
+        rng = np.random.default_rng(args.seed + 1)
+        # synthetic snapshot, projected back to latitudes and longitudes
+        ids, xs, ys = generate(n, args.seed)
+        P = projection.Equirectangular((20.676, -103.347))
+        lat, lon = P.inverse(xs, ys)
+        fname = os.path.join(args.cache_dir, f'pipeline_{args.data}_{n}.csv')
+        with open(fname, 'w', encoding='ISO-8859-1') as f:
+            f.write('id,name,obcn,location,latitude,longitude,status\n')
+            for i, a, b in zip(ids, lat, lon):
+                f.write(f'{i},Station {i},GDL-{i:06d},ZONE,{a:.9f},{b:.9f},'
+                        f'IN_SERVICE\n')
+
+        def stage(name, fn, items=1):
+            """Runs and times a stage, keeping its result."""
+            if args.tracemalloc:
+                tracemalloc.start()
+            if profiler is not None:
+                profiler.enable()
+            start = time.perf_counter()
+            result = fn()
+            elapsed = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+            peak = None
+            if args.tracemalloc:
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            run['stages'][name] = {'seconds': elapsed, 'items': items,
+                                   'peak_bytes': peak}
+            peak = '' if peak is None else f'{peak / 1024:.1f}'
+            print(f"{n:>9} {name:>34} {1e3 * elapsed:>11.2f} "
+                  f"{1e6 * elapsed / items:>14.2f} {peak:>10}")
+            return result
+
+        S = stage('load', lambda: utils.load_stations(fname, cache_dir=None,
+                                                      projection=P), n)
+        xs, ys = stage('projection', lambda: P.forward(S['lat'], S['lon']), n)
+        T = stage('tree', lambda: tree.Tree(S['id'], xs, ys), n)
+        G = stage('build_graph',
+                  lambda: graph.build_graph(S['id'], xs, ys, k=args.k, T=T), n)
+        pairs = rng.uniform(xs.min(), xs.max(), size=(args.queries, 2, 2))
+        pairs[..., 1] = rng.uniform(ys.min(), ys.max(),
+                                    size=(args.queries, 2))
+        graphs = [G.copy() for _ in range(args.queries)]
+        stage('connect_query_points', lambda: [
+            graph.connect_query_points(H, T, ['p', 'q'], p, q, k=args.k)
+            for H, (p, q) in zip(graphs, pairs)], args.queries)
+        for engine in args.engines:
+            for method in args.methods:
+                if engine == 'csr':
+                    compiled = [graph.CSRGraph(H) for H in graphs]
+                else:
+                    compiled = graphs
+
+                def plan():
+                    for H in compiled:
+                        try:
+                            graph.path_plan('p', 'q', H, method=method)
+                        except RuntimeError: # disconnected pair
+                            pass
+                stage(f'path_plan {engine} {method}', plan, args.queries)
+        report['runs'].append(run)
+
+    if profiler is not None:
+        profiler.dump_stats(args.profile)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+def bench_metrics(args: argparse.Namespace) -> None:
+    """Query time with metrics disabled and enabled, and the recorded counters
+    summary of the enabled runs."""
+    print(f"{'n':>9} {'call':>13} {'off [us]':>9} {'on [us]':>9} "
+          f"{'overhead':>9}")
+    metrics.recorder.clear()
+    for n in args.sizes:
+        G, T = random_graph(n, args.k, args.seed)
+        C = graph.CSRGraph(G)
+        rng = np.random.default_rng(args.seed + 1)
+        pairs = rng.integers(0, n, size=(args.queries, 2)).tolist()
+        points = rng.uniform(-6, 7, size=(args.queries, 2))
+
+        def routes(H, method):
+            for p, q in pairs:
+                try:
+                    graph.path_plan(p, q, H, method=method)
+                except RuntimeError: # disconnected pair
+                    pass
+
+        calls = [(f'{m}/{e}', lambda H=H, m=m: routes(H, m))
+                 for e, H in (('nx', G), ('csr', C)) for m in args.methods]
+        calls.append(('query', lambda: T.query(points, k=args.k)))
+        for name, call in calls:
+            metrics.enable(False)
+            off = best_time(call, args.repeat)
+            metrics.enable(True)
+            on = best_time(call, args.repeat)
+            metrics.enable(False)
+            print(f"{n:>9} {name:>13} {1e6 * off / args.queries:>9.1f} "
+                  f"{1e6 * on / args.queries:>9.1f} {on / off - 1:>9.1%}")
+
+    print(f"\n{'call':>18} {'counter':>12} {'p50':>10} {'p99':>10} "
+          f"{'max':>10}")
+    for name, counters in metrics.recorder.histograms().items():
+        for key, h in counters.items():
+            print(f"{name:>18} {key:>12} {h['p50']:>10.4g} {h['p99']:>10.4g} "
+                  f"{h['max']:>10.4g}")
+    if args.export is not None:
+        metrics.recorder.export(args.export)
+
+def git_version() -> str:
+    """Current git commit of the repository, None if unknown."""
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                             capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+
+    return out.stdout.strip() or None
+
+
+# configure arg parser
+parser = argparse.ArgumentParser(description='Spatial index and routing '
+                                             'benchmarks')
+parser.add_argument('-seed', type=int, default=0,
+                    help='Seed for synthetic data generation')
+parser.add_argument('-repeat', type=int, default=3,
+                    help='Number of runs per measurement, best is reported')
+subparsers = parser.add_subparsers(dest='bench', required=True)
+
+build = subparsers.add_parser('build', help='Tree build time')
+build.add_argument('-sizes', type=int, nargs='+',
+                   default=[300, 3000, 30000, 300000, 1000000],
+                   help='Number of points to build the tree from')
+build.set_defaults(run=bench_build)
+
+layout = subparsers.add_parser('layout', help='Linked vs flat tree layout')
+layout.add_argument('-sizes', type=int, nargs='+',
+                    default=[300, 3000, 30000, 300000],
+                    help='Number of points to build the trees from')
+layout.add_argument('-queries', type=int, default=1000,
+                    help='Number of nearest neighbor queries')
+layout.add_argument('-k', type=int, default=3,
+                    help='Number of nearest neighbors per query')
+layout.set_defaults(run=bench_layout)
+
+query = subparsers.add_parser('query', help='Per-point vs batched k-NN queries')
+query.add_argument('-sizes', type=int, nargs='+', default=[300, 3000, 30000],
+                   help='Number of points to build the trees from')
+query.add_argument('-queries', type=int, default=20000,
+                   help='Number of query points')
+query.add_argument('-k', type=int, default=3,
+                   help='Number of nearest neighbors per query')
+query.set_defaults(run=bench_query)
+
+leaf = subparsers.add_parser('leaf', help='Leaf bucket size sweep')
+leaf.add_argument('-sizes', type=int, nargs='+', default=[300, 30000],
+                  help='Number of points to build the trees from')
+leaf.add_argument('-leaf_sizes', type=int, nargs='+',
+                  default=[1, 2, 4, 8, 16, 32, 64],
+                  help='Leaf bucket sizes to sweep')
+leaf.add_argument('-queries', type=int, default=20000,
+                  help='Number of query points')
+leaf.add_argument('-k', type=int, default=3,
+                  help='Number of nearest neighbors per query')
+leaf.set_defaults(run=bench_leaf)
+
+grids = subparsers.add_parser('grid', help='Grid spatial hash vs tree snapping')
+grids.add_argument('-sizes', type=int, nargs='+', default=[3000, 30000],
+                   help='Number of stations')
+grids.add_argument('-data', type=str, nargs='+',
+                   default=['uniform', 'clustered'],
+                   choices=['uniform', 'clustered'],
+                   help='Station and query distributions to combine')
+grids.add_argument('-queries', type=int, default=10000,
+                   help='Number of query points')
+grids.add_argument('-k', type=int, default=1,
+                   help='Number of nearest stations per query')
+grids.set_defaults(run=bench_grid)
+
+route = subparsers.add_parser('route', help='Shortest-path query time')
+route.add_argument('-sizes', type=int, nargs='+', default=[300, 3000],
+                   help='Number of stations of the synthetic graphs')
+route.add_argument('-methods', type=str, nargs='+', default=['dijkstra'],
+                   help='Shortest-path methods to time')
+route.add_argument('-queries', type=int, default=20,
+                   help='Number of random station pairs')
+route.add_argument('-k', type=int, default=3,
+                   help='Number of nearest neighbors per station')
+route.set_defaults(run=bench_route)
+
+profile = subparsers.add_parser('profile',
+                                help='Edge weight profile swap vs rebuild')
+profile.add_argument('-sizes', type=int, nargs='+', default=[3000, 30000],
+                     help='Number of stations of the synthetic graphs')
+profile.add_argument('-hours', type=int, default=4,
+                     help='Number of hourly profiles to apply')
+profile.add_argument('-queries', type=int, default=20,
+                     help='Number of random station pairs')
+profile.add_argument('-method', type=str, default='dijkstra',
+                     help='Shortest-path method to time')
+profile.add_argument('-k', type=int, default=3,
+                     help='Number of nearest neighbors per station')
+profile.set_defaults(run=bench_profile)
+
+knn_graph = subparsers.add_parser('graph', help='Parallel k-NN graph build')
+knn_graph.add_argument('-sizes', type=int, nargs='+', default=[3000, 30000],
+                       help='Number of stations of the synthetic graphs')
+knn_graph.add_argument('-workers', type=int, nargs='+', default=[2, 4],
+                       help='Numbers of worker processes to try')
+knn_graph.add_argument('-k', type=int, default=3,
+                       help='Number of nearest neighbors per station')
+knn_graph.set_defaults(run=bench_knn_graph)
+
+concurrency = subparsers.add_parser('concurrency',
+                                    help='Concurrent routing throughput')
+concurrency.add_argument('-size', type=int, default=3000,
+                         help='Number of stations of the synthetic graph')
+concurrency.add_argument('-queries', type=int, default=400,
+                         help='Number of random origin/destination pairs')
+concurrency.add_argument('-workers', type=int, nargs='+', default=[1, 2, 4],
+                         help='Numbers of workers to try')
+concurrency.add_argument('-executors', type=str, nargs='+',
+                         default=['thread', 'process'],
+                         help='Pool types to try, thread and/or process')
+concurrency.add_argument('-k', type=int, default=3,
+                         help='Number of nearest neighbors per station')
+concurrency.set_defaults(run=bench_concurrency)
+
+settled = subparsers.add_parser('settled',
+                                help='Nodes settled per point-to-point query')
+settled.add_argument('-sizes', type=int, nargs='+', default=[300, 3000, 30000],
+                     help='Number of stations of the synthetic graphs')
+settled.add_argument('-queries', type=int, default=100,
+                     help='Number of random station pairs')
+settled.add_argument('-k', type=int, default=3,
+                     help='Number of nearest neighbors per station')
+settled.set_defaults(run=bench_settled)
+
+bellman = subparsers.add_parser('bellman', help='Bellman-Ford search modes')
+bellman.add_argument('-sizes', type=int, nargs='+', default=[300, 3000],
+                     help='Number of stations of the synthetic graphs')
+bellman.add_argument('-queries', type=int, default=10,
+                     help='Number of random sources')
+bellman.add_argument('-k', type=int, default=3,
+                     help='Number of nearest neighbors per station')
+bellman.set_defaults(run=bench_bellman)
+
+apsp = subparsers.add_parser('apsp', help='All-pairs distance matrices')
+apsp.add_argument('-sizes', type=int, nargs='+', default=[300, 3000],
+                  help='Number of stations of the synthetic graphs')
+apsp.add_argument('-workers', type=int, nargs='+', default=[1, 2, 4],
+                  help='Numbers of worker processes to try')
+apsp.add_argument('-queries', type=int, default=1000,
+                  help='Number of random station pairs')
+apsp.add_argument('-k', type=int, default=3,
+                  help='Number of nearest neighbors per station')
+apsp.add_argument('-cache_dir', type=str, default='cache',
+                  help='Directory where matrices are written')
+apsp.set_defaults(run=bench_apsp)
+
+ch = subparsers.add_parser('ch', help='Contraction hierarchy queries')
+ch.add_argument('-sizes', type=int, nargs='+', default=[300, 3000, 30000],
+                help='Number of stations of the synthetic graphs')
+ch.add_argument('-queries', type=int, default=1000,
+                help='Number of random station pairs')
+ch.add_argument('-k', type=int, default=3,
+                help='Number of nearest neighbors per station')
+ch.set_defaults(run=bench_ch)
+
+cached = subparsers.add_parser('cache', help='Hotspot route caching')
+cached.add_argument('-size', type=int, default=3000,
+                    help='Number of stations of the synthetic graph')
+cached.add_argument('-hotspots', type=int, default=20,
+                    help='Number of hotspots queries start and end around')
+cached.add_argument('-spread', type=float, default=0.005,
+                    help='Standard deviation of queries around hotspots')
+cached.add_argument('-queries', type=int, default=2000,
+                    help='Number of origin/destination pairs')
+cached.add_argument('-cells', type=float, nargs='+', default=[0.01, 0.05],
+                    help='Snapping cell sizes to try')
+cached.add_argument('-maxsize', type=int, default=4096,
+                    help='Maximum number of entries of each cache')
+cached.add_argument('-k', type=int, default=3,
+                    help='Number of nearest neighbors per station')
+cached.set_defaults(run=bench_cache)
+
+served = subparsers.add_parser('service', help='Route service load generator')
+served.add_argument('-size', type=int, default=3000,
+                    help='Number of stations of the synthetic graph')
+served.add_argument('-requests', type=int, default=2000,
+                    help='Number of requests per run')
+served.add_argument('-routes', type=float, default=0.5,
+                    help='Fraction of route requests, the rest are nearest '
+                         'stations requests')
+served.add_argument('-clients', type=int, nargs='+', default=[1, 16, 64],
+                    help='Numbers of concurrent connections to try')
+served.add_argument('-windows', type=float, nargs='+', default=[0, 2],
+                    help='Snap batching windows in milliseconds to try')
+served.add_argument('-method', type=str, default='dijkstra',
+                    help='Shortest-path method of the service')
+served.add_argument('-k', type=int, default=3,
+                    help='Number of nearest neighbors per station')
+served.set_defaults(run=bench_service)
+
+load = subparsers.add_parser('load', help='Station snapshot loading')
+load.add_argument('-sizes', type=int, nargs='+', default=[300, 30000, 1000000],
+                  help='Number of stations of the synthetic snapshots')
+load.add_argument('-cache_dir', type=str, default='cache',
+                  help='Directory of synthetic snapshots and sidecars')
+load.set_defaults(run=bench_load)
+
+ingestion = subparsers.add_parser('ingest', help='Monthly snapshot ingestion')
+ingestion.add_argument('-files', type=str, nargs='*', default=[],
+                       help='Snapshot files, synthetic ones if none given')
+ingestion.add_argument('-size', type=int, default=30000,
+                       help='Number of stations of the synthetic snapshots')
+ingestion.add_argument('-months', type=int, default=6,
+                       help='Number of synthetic snapshots')
+ingestion.add_argument('-churn', type=float, default=0.01,
+                       help='Fraction of stations changed per month')
+ingestion.add_argument('-all_statuses', action='store_true',
+                       help='Keep stations regardless of their status')
+ingestion.add_argument('-k', type=int, default=3,
+                       help='Number of nearest neighbors per station')
+ingestion.add_argument('-cache_dir', type=str, default='cache',
+                       help='Directory of synthetic snapshots')
+ingestion.set_defaults(run=bench_ingest)
+
+project = subparsers.add_parser('project', help='Map projection throughput')
+project.add_argument('-sizes', type=int, nargs='+', default=[300, 1000000],
+                     help='Number of points to project')
+project.set_defaults(run=bench_project)
+
+pipeline = subparsers.add_parser('pipeline', help='Per-stage pipeline timing')
+pipeline.add_argument('-sizes', type=int, nargs='+', default=[300, 3000, 30000],
+                      help='Number of stations of the synthetic snapshots')
+pipeline.add_argument('-data', type=str, default='uniform',
+                      choices=['uniform', 'clustered'],
+                      help='Synthetic station distribution')
+pipeline.add_argument('-queries', type=int, default=20,
+                      help='Number of random origin/destination pairs')
+pipeline.add_argument('-methods', type=str, nargs='+',
+                      default=['dijkstra', 'bidirectional', 'astar'],
+                      help='Shortest-path methods to time')
+pipeline.add_argument('-engines', type=str, nargs='+',
+                      default=['networkx', 'csr'],
+                      help='Graph engines to time, networkx and/or csr')
+pipeline.add_argument('-k', type=int, default=3,
+                      help='Number of nearest neighbors per station')
+pipeline.add_argument('-profile', type=str, default=None,
+                      help='File to dump cProfile stats of all the stages to')
+pipeline.add_argument('-tracemalloc', action='store_true',
+                      help='Report peak traced memory of each stage, '
+                           'tracing slows stages down')
+pipeline.add_argument('-json', type=str, default=None,
+                      help='File to write the JSON report to')
+pipeline.add_argument('-cache_dir', type=str, default='cache',
+                      help='Directory of synthetic snapshots')
+pipeline.set_defaults(run=bench_pipeline)
+
+instrumented = subparsers.add_parser('metrics',
+                                     help='Instrumentation counters overhead')
+instrumented.add_argument('-sizes', type=int, nargs='+', default=[3000],
+                          help='Number of stations of the synthetic graphs')
+instrumented.add_argument('-queries', type=int, default=200,
+                          help='Number of random station pairs and points')
+instrumented.add_argument('-methods', type=str, nargs='+',
+                          default=['dijkstra', 'astar'],
+                          help='Shortest-path methods to time')
+instrumented.add_argument('-k', type=int, default=3,
+                          help='Number of nearest neighbors per station')
+instrumented.add_argument('-export', type=str, default=None,
+                          help='JSON file to export the counter histograms to')
+instrumented.set_defaults(run=bench_metrics)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.run(args)
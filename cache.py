@@ -0,0 +1,230 @@
+# stdlib modules
+from collections import OrderedDict
+import math
+import threading
+from typing import Any, Hashable, List, Tuple
+
+# third-party modules
+from networkx import Graph
+import numpy as np
+
+# custom modules
+import graph
+from tree import Tree
+
+
+class LRUCache:
+    def __init__(self, maxsize: int = 4096):
+        """Constructor method. Bounded mapping that evicts its least recently
+        used entry once full, and counts hits and misses. Safe to share among
+        threads.
+        -----------------------------------------------------------------------
+        Args:
+            maxsize: maximum number of entries"""
+        self.maxsize = maxsize
+        self.hits = self.misses = self.evictions = 0
+        self.__data = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.__data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Returns the value stored under key and marks it as recently used,
+        default if it is missing."""
+        with self.__lock:
+            if key in self.__data:
+                self.__data.move_to_end(key)
+                self.hits += 1
+                return self.__data[key]
+            self.misses += 1
+
+        return default
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Stores value under key, evicting the least recently used entry if
+        the cache is full."""
+        with self.__lock:
+            self.__data[key] = value
+            self.__data.move_to_end(key)
+            if len(self.__data) > self.maxsize:
+                self.__data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """Drops all entries, counters are kept."""
+        with self.__lock:
+            self.__data.clear()
+
+    def stats(self) -> dict:
+        """Hit, miss and eviction counters along with current size."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self),
+                'maxsize': self.maxsize}
+
+class RouteCache:
+    def __init__(
+            self,
+            G: Graph,
+            T: Tree,
+            k: int = 3,
+            method: str = 'dijkstra',
+            cell: float = 0.01,
+            maxsize: int = 4096):
+        """Constructor method. Caches the candidate nearest stations of query
+        points, keyed by the square cell of side cell containing them, and the
+        paths between pairs of stations. Both caches are dropped as soon as
+        the version of T or G changes.
+        -----------------------------------------------------------------------
+        Args:
+            G: station graph, either networkx or compiled, contraction
+                hierarchies do not keep the station coords snaps need
+            T: spatial index over the graph stations
+            k: number of nearest stations to connect each point to
+            method: shortest-path method for station to station segments
+            cell: side of snapping cells, same units as the coords, 0 to key
+                snaps by exact coords
+            maxsize: maximum number of entries of each cache"""
+        if isinstance(G, graph.ContractionHierarchy):
+            raise TypeError('RouteCache needs station coords, which '
+                            'contraction hierarchies do not keep; pass the '
+                            'networkx or compiled graph instead')
+        self.G, self.T = G, T
+        self.k, self.method, self.cell = k, method, cell
+        self.snaps = LRUCache(maxsize)
+        self.segments = LRUCache(maxsize)
+        self.invalidations = 0
+        self.__version = self.__get_version()
+        self.__lock = threading.Lock()
+
+    def __get_version(self) -> tuple:
+        """Current versions of the tree and the graph."""
+        return getattr(self.T, 'version', 0), graph.graph_version(self.G)
+
+    def __check(self) -> None:
+        """Drops cached results computed over a previous tree or graph."""
+        version = self.__get_version()
+        if version != self.__version:
+            with self.__lock:
+                if version != self.__version:
+                    self.snaps.clear()
+                    self.segments.clear()
+                    self.invalidations += 1
+                    self.__version = version
+
+    def __candidates(self, center: Tuple[float, float]) -> List[Any]:
+        """Stations that can be among the k nearest of any point of a cell:
+        those within the k-th nearest distance of its center plus the cell
+        diagonal, since no point of the cell is farther than half of it from
+        the center. A station lying exactly at the center is skipped, as in
+        Tree.query."""
+        margin = math.sqrt(2) * self.cell
+        width = self.k
+        while True:
+            dists, near = self.T.query(np.array([center]), k=width)
+            r = dists[0, self.k - 1] + margin
+            last = dists[0, -1]
+            if last == math.inf or last > r: # all stations within r found
+                break
+            width *= 2
+
+        return [u.item() for u, d in zip(near[0], dists[0])
+                if d <= r and d < math.inf]
+
+    def snap(self, point: List[float]) -> List[Tuple[Any, float]]:
+        """Nearest stations of a query point, the same ones as T.query up to
+        ties. Candidates are looked up once per cell, then the k nearest of
+        them are kept by their exact distances to the point.
+        ------------------------------------------------------------------------
+        Args:
+            point: query point coords
+        Returns:
+            snaps: list of (station id, distance) pairs by ascending distance"""
+        self.__check()
+        x, y = float(point[0]), float(point[1])
+        if self.cell > 0:
+            key = (math.floor(x / self.cell), math.floor(y / self.cell))
+            center = ((key[0] + .5) * self.cell, (key[1] + .5) * self.cell)
+        else:
+            key = center = (x, y)
+        ids = self.snaps.get(key)
+        if ids is None:
+            ids = self.__candidates(center)
+            self.snaps.put(key, ids)
+        snaps = [(u, math.dist((x, y), graph.node_coords(self.G, u)))
+                 for u in ids]
+        snaps = sorted((s for s in snaps if s[1] > 0), # as T.query skips them
+                       key=lambda s: s[1])
+
+        return snaps[:self.k]
+
+    def segment(self, a: Any, b: Any) -> Tuple[float, List[Any]]:
+        """Shortest path between two stations. Graphs are undirected, so both
+        directions share a single entry.
+        ------------------------------------------------------------------------
+        Args:
+            a: source station id
+            b: target station id
+        Returns:
+            length: path length, infinite if there is no path
+            path: list of station ids from a to b, None if there is no path"""
+        self.__check()
+        key = (a, b) if repr(a) <= repr(b) else (b, a)
+        seg = self.segments.get(key)
+        if seg is None:
+            try:
+                _, path = graph.path_plan(*key, self.G, method=self.method)
+                seg = graph.path_length(self.G, path), path
+            except graph.NegativeCycleError:
+                raise
+            except RuntimeError: # disconnected stations
+                seg = math.inf, None
+            self.segments.put(key, seg)
+        length, path = seg
+        if path is not None and key[0] != a:
+            path = path[::-1]
+
+        return length, path
+
+    def route(
+            self,
+            p: List[float],
+            q: List[float],
+            ids: Tuple[Any, Any] = ('p', 'q')) -> List[Any]:
+        """Shortest path between two arbitrary points through their cached
+        nearest stations and the cached segments joining them. Straight-line
+        distances only prune segments of planar graphs, see
+        graph.heuristic_scale.
+        ------------------------------------------------------------------------
+        Args:
+            p: origin coords
+            q: destination coords
+            ids: node ids given to the query points in the path
+        Returns:
+            path: list of node ids from ids[0] to ids[1], None if there is no
+                path"""
+        best, path = math.inf, None
+        # scaled straight-line distances between stations bound their
+        # segments lengths from below, so hopeless segments are never computed
+        coords = lambda u: graph.node_coords(self.G, u)
+        scale = graph.heuristic_scale(self.G)
+        snaps = self.snap(p), self.snap(q)
+        pairs = sorted((da + scale * math.dist(coords(a), coords(b)) + db,
+                        a, da, b, db)
+                       for a, da in snaps[0] for b, db in snaps[1])
+        for bound, a, da, b, db in pairs:
+            if bound >= best:
+                break
+            length, seg = self.segment(a, b)
+            if da + length + db < best:
+                best, path = da + length + db, seg
+
+        if path is None:
+            return None
+
+        return [ids[0]] + path + [ids[1]]
+
+    def stats(self) -> dict:
+        """Counters of both caches and number of invalidations."""
+        return {'snaps': self.snaps.stats(), 'segments': self.segments.stats(),
+                'invalidations': self.invalidations}
@@ -1,13 +1,23 @@
 # stdlib modules
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import heapq
+from itertools import chain
 import math
-from queue import PriorityQueue
-from typing import Any, List
+from multiprocessing.shared_memory import SharedMemory
+import os
+from typing import Any, Callable, List, Tuple
 
 # third-party modules
 import networkx as nx
 from networkx import Graph
+import numpy as np
+from numpy import ndarray
 
 # custom modules
+import metrics
+from projection import geodesic_query, Projection
 import tree as t
 from tree import Tree
 
@@ -15,108 +25,1519 @@ def build_graph(
         ids: List[int],
         xs: List[float], 
         ys: List[float], 
-        k: int = 3) -> Graph:
-    """"""
-    tree = t.Tree(ids, xs, ys) # build 2D-tree for efficient spatial search
+        k: int = 3,
+        T: Tree = None,
+        projection: Projection = None,
+        workers: int = 1) -> Graph:
+    """Builds a k-nearest neighbors graph over the stations. A prebuilt spatial
+    index, either a Tree or a FlatTree over the same points, can be given
+    through T, otherwise a Tree is built. If the projection of the coords is
+    given, neighbors and edge weights use great-circle distances instead of
+    planar ones, and the graph is marked geodesic, see heuristic_scale. With
+    several workers, queries are split across processes, see knn_edges, and
+    the graph is the same as the serial one."""
+    if workers > 1:
+        G = _bulk_graph(ids, xs, ys, *knn_edges(ids, xs, ys, k, T, projection,
+                                                workers))
+        G.graph['geodesic'] = projection is not None
+        return G
+    # build 2D-tree for efficient spatial search
+    tree = t.Tree(ids, xs, ys) if T is None else T
     G = nx.Graph()
     nodes = [(ids[i], {'x': xs[i], 'y': ys[i]}) for i in range(len(xs))]
     G.add_nodes_from(nodes)
-    edges = []
-    for query_id, x, y in zip(ids, xs, ys):
-        query = [x, y]
-        dists, nns = tree.nearest_neighbors(query, tree.root, k=k)
-        near = [(query_id, nn.id, d) for nn, d in zip(nns, dists)]
-        edges += near
+    # query k nearest neighbors of all the stations at once
+    points = np.column_stack([xs, ys])
+    if projection is None:
+        dists, nns = tree.query(points, k=k)
+    else:
+        index = {u: i for i, u in enumerate(np.asarray(ids).tolist())}
+        dists, nns = geodesic_query(tree, projection, points, k, xs, ys, index)
+    edges = [(query_id, nn_id, d)
+             for query_id, row_nn, row_d in zip(ids, nns, dists)
+             for nn_id, d in zip(row_nn, row_d) if d < math.inf]
     G.add_weighted_edges_from(edges)
+    G.graph['geodesic'] = projection is not None
 
     return G
 
-def get_path(G: Graph, node_id: Any):
-    """"""
-    parent = G.nodes[node_id]['pred']
-    if parent is None:
-        return [node_id]
-    path = get_path(G, parent) + [node_id]
-    
-    return path
+def _bulk_graph(ids, xs, ys, u: ndarray, v: ndarray, w: ndarray) -> Graph:
+    """Loads nodes and deduplicated edges given by positions into a graph."""
+    G = nx.Graph()
+    ids = np.asarray(ids).tolist()
+    G.add_nodes_from((u, {'x': x, 'y': y}) for u, x, y in
+                     zip(ids, np.asarray(xs).tolist(), np.asarray(ys).tolist()))
+    G.add_weighted_edges_from((ids[a], ids[b], d) for a, b, d in
+                              zip(u.tolist(), v.tolist(), w.tolist()))
+
+    return G
+
+def _share(arrays: dict) -> Tuple[List[SharedMemory], dict]:
+    """Copies arrays into new shared memory blocks.
+    ---------------------------------------------------------------------------
+    Args:
+        arrays: dict mapping names to arrays
+    Returns:
+        blocks: shared memory blocks, to be closed and unlinked by the caller
+        specs: dict mapping names to (block name, shape, dtype), see _attach"""
+    blocks, specs = [], {}
+    for name, a in arrays.items():
+        shm = SharedMemory(create=True, size=max(1, a.nbytes))
+        np.ndarray(a.shape, a.dtype, buffer=shm.buf)[...] = a
+        blocks.append(shm)
+        specs[name] = (shm.name, a.shape, a.dtype.str)
+
+    return blocks, specs
+
+def _attach(specs: dict) -> Tuple[List[SharedMemory], dict]:
+    """Maps the arrays of shared memory blocks created by _share in another
+    process, which remains their owner."""
+    blocks, arrays = [], {}
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = SharedMemory(name=shm_name)
+        blocks.append(shm)
+        arrays[name] = np.ndarray(shape, dtype, buffer=shm.buf)
+
+    return blocks, arrays
+
+def _init_knn_worker(specs: dict, k: int, projection: Projection) -> None:
+    """Maps the shared coords, tree arrays and output rows of a worker
+    process."""
+    blocks, arrays = _attach(specs)
+    T = t.FlatTree.from_arrays(arrays)
+    index = dict(zip(arrays['tree_ids'].tolist(), range(len(T))))
+    _worker.update(knn_blocks=blocks, T=T, index=index, k=k,
+                   projection=projection, **arrays)
+
+def _knn_rows(chunk: slice) -> int:
+    """Queries the nearest neighbors of a chunk of stations using a worker's
+    shared state and writes them to the shared output rows."""
+    rows = _worker['order'][chunk]
+    _query_rows(_worker['T'], _worker['px'], _worker['py'], rows, _worker['k'],
+                _worker['projection'], _worker['index'], _worker['dists'],
+                _worker['nbrs'])
+
+    return len(rows)
+
+def _query_rows(T, xs: ndarray, ys: ndarray, rows: ndarray, k: int,
+                projection: Projection, index: dict, dists: ndarray,
+                nbrs: ndarray) -> None:
+    """Stores the k nearest neighbors of some stations in their rows of dists
+    and nbrs, as build_graph queries them."""
+    points = np.column_stack([xs[rows], ys[rows]])
+    if projection is None:
+        d, nns = T.query(points, k=k)
+    else:
+        d, nns = geodesic_query(T, projection, points, k, xs, ys, index)
+    dists[rows] = d
+    nbrs[rows] = nns
+
+def knn_edges(
+        ids: List[Any],
+        xs: List[float],
+        ys: List[float],
+        k: int = 3,
+        T: Any = None,
+        projection: Projection = None,
+        workers: int = 1,
+        chunksize: int = 1024) -> Tuple[ndarray, ndarray, ndarray]:
+    """Edges of the k-nearest neighbors graph as deduplicated arrays. Workers
+    map the coords and the flat tree arrays from shared memory and write the
+    neighbors of chunks of stations to shared output rows, so the result does
+    not depend on scheduling. Chunks follow the tree layout, which keeps the
+    stations of a chunk close together and their batched search within a
+    small part of the tree. Each undirected edge is kept once,
+    at its first occurrence in station order with the weight of its last one,
+    so loading the arrays yields the same graph as build_graph.
+    ---------------------------------------------------------------------------
+    Args:
+        ids: list of station ids
+        xs, ys: station coords
+        k: number of nearest neighbors per station
+        T: FlatTree over the same points with numeric ids, reused instead of
+            building a flat tree if given
+        projection: projection of the coords for great-circle distances
+        workers: number of worker processes, queries run in this one if 1
+        chunksize: number of stations per task
+    Returns:
+        u, v: (e,)-shape arrays of edge endpoints positions in ids
+        w: (e,)-shape array of edge weights"""
+    xs, ys = np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+    n = len(xs)
+    if isinstance(T, t.FlatTree) and T.ids.dtype.kind in 'iu':
+        tree_ids = np.asarray(ids) # ids stored in the tree
+    else:
+        tree_ids = np.arange(n)
+        T = t.FlatTree(tree_ids, xs, ys)
+    # positions of tree ids, and of stations in tree layout order
+    sorter = np.argsort(tree_ids, kind='stable')
+    position = lambda a: sorter[np.searchsorted(tree_ids, a, sorter=sorter)]
+    order = position(T.ids)
+    dists = np.full((n, k), math.inf)
+    nbrs = np.full((n, k), -1, dtype=np.int64)
+    chunks = [slice(a, a + chunksize) for a in range(0, n, chunksize)]
+    if workers <= 1:
+        index = dict(zip(tree_ids.tolist(), range(n)))
+        for chunk in chunks:
+            _query_rows(T, xs, ys, order[chunk], k, projection, index, dists,
+                        nbrs)
+    else:
+        arrays = {f: getattr(T, f) for f in t.FlatTree.fields}
+        blocks, specs = _share(dict(arrays, tree_ids=tree_ids, order=order,
+                                    px=xs, py=ys, dists=dists, nbrs=nbrs))
+        try:
+            pool = ProcessPoolExecutor(max_workers=workers,
+                                       initializer=_init_knn_worker,
+                                       initargs=(specs, k, projection))
+            with pool:
+                list(pool.map(_knn_rows, chunks))
+            shared = dict(zip(specs, blocks))
+            dists = np.ndarray((n, k), np.float64,
+                               buffer=shared['dists'].buf).copy()
+            nbrs = np.ndarray((n, k), np.int64,
+                              buffer=shared['nbrs'].buf).copy()
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+    # map tree ids of neighbors to positions
+    found = nbrs >= 0
+    pos = np.full(nbrs.shape, -1, dtype=np.int64)
+    pos[found] = position(nbrs[found])
+    # directed edges in the order build_graph inserts them
+    keep = (dists < math.inf).ravel()
+    src = np.repeat(np.arange(n, dtype=np.int64), k)[keep]
+    dst, w = pos.ravel()[keep], dists.ravel()[keep]
+    key = np.minimum(src, dst) * n + np.maximum(src, dst)
+    _, first = np.unique(key, return_index=True)
+    _, last = np.unique(key[::-1], return_index=True)
+    last = key.shape[0] - 1 - last
+    order = np.argsort(first, kind='stable')
+
+    return src[first[order]], dst[first[order]], w[last[order]]
+
+def touch(G: Graph) -> None:
+    """Records a change of G, to be called after modifying it in place."""
+    G.graph['version'] = G.graph.get('version', 0) + 1
+
+def graph_version(G: Graph) -> tuple:
+    """Version of a networkx or compiled graph. It changes whenever G is
+    touched or its number of nodes changes, both checked in O(1). Compiled
+    graphs only change when their weight profile is swapped, see
+    CSRGraph.set_profile, and hierarchies are never modified."""
+    if isinstance(G, Graph):
+        return G.graph.get('version', 0), G.number_of_nodes()
 
-def relax(G: Graph, u: Any, v: Any, w: float):
-    """"""
+    return (getattr(G, 'version', 0),)
+
+def heuristic_scale(G: Graph) -> float:
+    """Factor keeping straight-line distances between node coords a lower
+    bound of path lengths in a networkx or compiled graph. Great-circle edge
+    weights of geodesic graphs can be shorter than planar distances in their
+    projection, so they get 0 and straight-line bounds are not used. Compiled
+    graphs get the scale of their current weight profile."""
+    if isinstance(G, Graph):
+        return 0. if G.graph.get('geodesic', False) else 1.
+    if getattr(G, 'geodesic', False):
+        return 0.
+    active = getattr(G, 'active', None)
+
+    return 1. if active is None else active[3]
+
+def get_path(pred: dict, node_id: Any) -> List[Any]:
+    """Follows predecessors back from node_id to the search source."""
+    path = [node_id]
+    while pred[path[-1]] is not None:
+        path.append(pred[path[-1]])
+
+    return path[::-1]
+
+def path_length(G: Graph, path: List[Any], overlay: dict = None) -> float:
+    """Sum of edge weights along a path of a networkx graph, compiled graph or
+    contraction hierarchy, with the weights its searches use."""
+    length = 0.
+    weights = None if isinstance(G, Graph) else G.weights # current profile
+    for u, v in zip(path[:-1], path[1:]):
+        if overlay is not None and v in overlay.get(u, ()):
+            length += overlay[u][v]['weight']
+        elif weights is None:
+            length += G.adj[u][v]['weight']
+        else: # hierarchies only store the upward direction
+            w = math.inf
+            for i, j in ((G.index[u], G.index[v]), (G.index[v], G.index[u])):
+                a, b = G.indptr[i], G.indptr[i+1]
+                w = min(w, weights[a:b][G.indices[a:b] == j].min(
+                    initial=math.inf))
+            length += w
+
+    return float(length)
+
+def neighbors(G: Graph, u: Any, overlay: dict = None):
+    """Iterates over (neighbor, edge data) pairs of node u in the base graph
+    and in the per-query overlay."""
+    if u in G.adj:
+        yield from G.adj[u].items()
+    if overlay is not None and u in overlay:
+        yield from overlay[u].items()
+
+def node_coords(G: Graph, u: Any, overlay: dict = None) -> Tuple[float]:
+    """Returns (x, y) coords of node u, None if they are unknown."""
+    if overlay is not None and u in getattr(overlay, 'coords', {}):
+        return overlay.coords[u]
+    if isinstance(G, CSRGraph):
+        i = G.index.get(u)
+        if i is not None and not math.isnan(G.xs[i]):
+            return float(G.xs[i]), float(G.ys[i])
+        return None
+    if u in G.nodes and 'x' in G.nodes[u]:
+        return G.nodes[u]['x'], G.nodes[u]['y']
+
+    return None
+
+def edges(G: Graph, overlay: dict = None):
+    """Iterates over (u, v, weight) undirected edges of the base graph and of
+    the per-query overlay, each one once."""
+    yield from G.edges(data='weight')
+    if overlay is not None:
+        for u in overlay:
+            if u not in G.adj: # virtual nodes own their overlay edges
+                for v, data in overlay[u].items():
+                    yield u, v, data['weight']
+
+def relax(d: dict, pred: dict, u: Any, v: Any, w: float) -> bool:
+    """Relaxes undirected edge (u, v) in either direction."""
     relaxed = False
-    if G.nodes[v]['d'] > G.nodes[u]['d'] + w:
-        G.nodes[v]['d'] = G.nodes[u]['d'] + w
-        G.nodes[v]['pred'] = u
+    if d[v] > d[u] + w:
+        d[v] = d[u] + w
+        pred[v] = u
         relaxed = True
-    elif G.nodes[u]['d'] > G.nodes[v]['d'] + w:
-        G.nodes[u]['d'] = G.nodes[v]['d'] + w
-        G.nodes[u]['pred'] = v
+    elif d[u] > d[v] + w:
+        d[u] = d[v] + w
+        pred[u] = v
         relaxed = True
     
-    return relaxed, G
+    return relaxed
 
 
-def init_single_source(G: Graph, s: Any) -> Graph:
-    """"""
-    for node_id in list(G.nodes):
-        G.nodes[node_id]['d'] = math.inf
-        G.nodes[node_id]['pred'] = None
+def init_single_source(
+        G: Graph,
+        s: Any,
+        overlay: dict = None) -> Tuple[dict, dict]:
+    """Creates per-query distance and predecessor maps for a search from s.
+    The graph itself is never modified, so concurrent queries can share it."""
+    nodes = list(G.nodes) + ([] if overlay is None else
+                             [u for u in overlay if u not in G.adj])
+    d = dict.fromkeys(nodes, math.inf)
+    pred = dict.fromkeys(nodes)
+    d[s] = 0.
 
-    G.nodes[s]['d'] = 0.
+    return d, pred
 
-    return G
+class NegativeCycleError(RuntimeError):
+    """Raised when a negative cycle is reachable from the search source."""
+
+def bellman_ford_search(E: List[tuple], d, pred, stats: dict = None) -> int:
+    """Bellman-Ford algorithm. Sweeps relax every undirected edge in both
+    directions and stop as soon as a whole sweep leaves distances unchanged.
+    ---------------------------------------------------------------------------
+    Args:
+        E: list of (u, v, w) undirected edges
+        d: distance of each node, infinite but for the source
+        pred: predecessor of each node, None if missing
+        stats: dict to add the passes, relax calls, successful relaxations
+            and wall time to, see metrics.report
+    Returns:
+        passes: number of sweeps performed"""
+    counters = metrics.probe(stats)
+    n = len(d)
+    relaxations = 0
+    for passes in range(1, n + 1):
+        relaxed = 0
+        for u, v, w in E:
+            relaxed += relax(d, pred, u, v, w)
+        relaxations += relaxed
+        if not relaxed: # distances are final
+            if counters is not None:
+                counters.update(passes=passes, relax_calls=passes * len(E),
+                                relaxations=relaxations)
+                metrics.report('bellman-ford', counters, stats)
+            return passes
+
+    # distances still changing after n sweeps
+    raise NegativeCycleError('Graph contains a negative cycle reachable from '
+                             'the source')
+
+def spfa_search(
+        nbrs: Callable,
+        d,
+        pred,
+        s: Any,
+        stats: dict = None) -> int:
+    """Queue-based Bellman-Ford algorithm, also known as Shortest Path Faster
+    Algorithm (SPFA). Only neighbors of nodes whose distance changed are
+    relaxed. A shortest path with as many edges as nodes reveals a negative
+    cycle.
+    ---------------------------------------------------------------------------
+    Args:
+        nbrs: function mapping a node to an iterable of (neighbor, weight)
+        d: distance of each node, infinite but for the source
+        pred: predecessor of each node, None if missing
+        s: source node
+        stats: dict to add the queue pushes and pops, successful relaxations
+            and wall time to, see metrics.report
+    Returns:
+        pops: number of nodes taken from the queue"""
+    counters = metrics.probe(stats)
+    n = len(d)
+    Q, queued = deque([s]), {s}
+    hops = {s: 0} # number of edges of current shortest paths
+    pops = relaxations = 0
+    while Q:
+        u = Q.popleft()
+        queued.discard(u)
+        pops += 1
+        for v, w in nbrs(u):
+            if d[v] > d[u] + w:
+                d[v], pred[v] = d[u] + w, u
+                hops[v] = hops[u] + 1
+                relaxations += 1
+                if hops[v] >= n:
+                    raise NegativeCycleError('Graph contains a negative cycle '
+                                             'reachable from the source')
+                if v not in queued:
+                    Q.append(v)
+                    queued.add(v)
+    if counters is not None:
+        # the queue ends empty, so every push was popped
+        counters.update(pushes=pops, pops=pops, relaxations=relaxations)
+        metrics.report('spfa', counters, stats)
+
+    return pops
+
+def numpy_bellman_ford_search(
+        u: ndarray,
+        v: ndarray,
+        w: ndarray,
+        n: int,
+        s: int,
+        stats: dict = None) -> Tuple[ndarray, ndarray, int]:
+    """Vectorized Bellman-Ford algorithm over edge arrays. Each pass relaxes
+    all the edges at once, in both directions, from previous pass distances.
+    Stops once a pass leaves distances unchanged.
+    ---------------------------------------------------------------------------
+    Args:
+        u, v, w: arrays of undirected edges endpoints indices and weights
+        n: number of nodes
+        s: source node index
+        stats: dict to add the passes, relax calls, successful relaxations
+            and wall time to, see metrics.report
+    Returns:
+        d: distance of each node
+        pred: predecessor index of each node, -1 if missing
+        passes: number of passes performed"""
+    counters = metrics.probe(stats)
+    # both directions of every edge
+    src, dst = np.concatenate([u, v]), np.concatenate([v, u])
+    w = np.concatenate([w, w])
+    d = np.full(n, math.inf)
+    pred = np.full(n, -1, dtype=np.int64)
+    d[s] = 0.
+    for passes in range(1, n + 1):
+        cand = d[src] + w
+        new = d.copy()
+        np.minimum.at(new, dst, cand)
+        improved = new < d
+        if not improved.any(): # distances are final
+            if counters is not None:
+                counters.update(passes=passes,
+                                relax_calls=passes * src.shape[0])
+                metrics.report('bellman-ford-numpy', counters, stats)
+            return d, pred, passes
+        if counters is not None:
+            counters['relaxations'] += int(improved.sum())
+        # predecessors are sources of the edges achieving new distances
+        best = (cand == new[dst]) & improved[dst]
+        pred[dst[best]] = src[best]
+        d = new
+
+    raise NegativeCycleError('Graph contains a negative cycle reachable from '
+                             'the source')
+
+def bellman_ford_path(
+        G: Graph,
+        p_id: Any,
+        q_id: Any,
+        overlay: dict = None,
+        mode: str = 'sweep',
+        stats: dict = None) -> List[Any]:
+    """Point-to-point Bellman-Ford search. Handles negative edge weights and
+    raises NegativeCycleError if a negative cycle is reachable from p_id.
+    ---------------------------------------------------------------------------
+    Args:
+        G: station graph
+        p_id: source node id
+        q_id: target node id
+        overlay: per-query extra adjacency, see attach_query_points
+        mode: 'sweep' for edge sweeps until stable, 'spfa' for queue-based
+            relaxations or 'numpy' for vectorized sweeps over edge arrays
+        stats: dict to add the search counters to, see metrics.report
+    Returns:
+        path: list of node ids from p_id to q_id"""
+    if mode == 'numpy':
+        return csr_bellman_ford_path(CSRGraph(G), p_id, q_id, overlay, mode,
+                                     stats)
+
+    d, pred = init_single_source(G, p_id, overlay) # initialize nodes
+    if mode == 'spfa':
+        nbrs = lambda u: ((v, data['weight'])
+                          for v, data in neighbors(G, u, overlay))
+        spfa_search(nbrs, d, pred, p_id, stats)
+    else:
+        bellman_ford_search(list(edges(G, overlay)), d, pred, stats)
+
+    if d[q_id] == math.inf:
+        raise RuntimeError(f'There is no path between nodes {p_id} and {q_id}')
+
+    return get_path(pred, q_id)
+
+def dijkstra_search(
+        G: Graph,
+        s: Any,
+        t: Any = None,
+        overlay: dict = None,
+        stats: dict = None) -> Tuple[dict, dict, int]:
+    """Dijkstra's algorithm from s using a lock-free binary heap. Stale heap
+    entries are skipped, and the search stops as soon as t, if given, is
+    settled. Only reached nodes get distances and predecessors.
+    ---------------------------------------------------------------------------
+    Args:
+        G: station graph
+        s: source node id
+        t: target node id, None to settle the whole graph
+        overlay: per-query extra adjacency, see attach_query_points
+        stats: dict to add the heap pushes, pops and stale pops, settled
+            nodes and wall time to, see metrics.report
+    Returns:
+        d: distances of reached nodes
+        pred: predecessors of reached nodes
+        settled: number of settled nodes"""
+    counters = metrics.probe(stats)
+    d, pred = {s: 0.}, {s: None}
+    S = set() # initialize set of settled vertices
+    Q = [(0., 0, s)] # heap entries are (distance, counter, node)
+    count = 1 # breaks distance ties without comparing node ids
+    while Q:
+        du, _, u = heapq.heappop(Q)
+        if u in S: # skip stale entries
+            continue
+        S.add(u)
+        if u == t: # target distance is final
+            break
+        for v, data in neighbors(G, u, overlay):
+            dv = du + data['weight']
+            if v not in S and dv < d.get(v, math.inf):
+                d[v], pred[v] = dv, u
+                heapq.heappush(Q, (dv, count, v))
+                count += 1
+    if counters is not None: # every push but the first follows a relaxation
+        _heap_counters(counters, count, len(Q), len(S))
+        metrics.report('dijkstra', counters, stats)
+
+    return d, pred, len(S)
+
+def _heap_counters(counters: dict, pushes: int, left: int,
+                   settled: int) -> None:
+    """Derives the heap counters of a search from its number of pushes,
+    entries left in the heap and settled nodes, so its loop stays as is."""
+    pops = pushes - left
+    counters.update(pushes=pushes, pops=pops, stale=pops - settled,
+                    settled=settled, relaxations=pushes - 1)
+
+def dijkstra_path(
+        G: Graph,
+        p_id: Any,
+        q_id: Any,
+        overlay: dict = None,
+        stats: dict = None) -> List[Any]:
+    """Point-to-point Dijkstra's search, stops once q_id is settled."""
+    _, pred, _ = dijkstra_search(G, p_id, q_id, overlay, stats)
+    if q_id not in pred:
+        raise RuntimeError(f'There is no path between nodes {p_id} and {q_id}')
+
+    return get_path(pred, q_id)
+
+def bidirectional_search(
+        nbrs: Callable,
+        s: Any,
+        t: Any,
+        stats: dict = None) -> Tuple[List[Any], int]:
+    """Bidirectional Dijkstra's search. Forward and backward searches from s
+    and t expand the smallest frontier key until the sum of both frontier keys
+    reaches the best s-t distance found through an edge joining them.
+    ---------------------------------------------------------------------------
+    Args:
+        nbrs: function mapping a node to an iterable of (neighbor, weight)
+        s: source node
+        t: target node
+        stats: dict to add the heap counters and wall time to, see
+            dijkstra_search
+    Returns:
+        path: list of nodes from s to t, None if there is no path
+        settled: number of settled nodes in both directions"""
+    if s == t:
+        return [s], 1
+    counters = metrics.probe(stats)
+    d, pred = ({s: 0.}, {t: 0.}), ({s: None}, {t: None})
+    S = (set(), set())
+    Q = ([(0., 0, s)], [(0., 0, t)])
+    count = 1
+    mu, meet = math.inf, None # best distance and its joining edge
+    while Q[0] and Q[1] and Q[0][0][0] + Q[1][0][0] < mu:
+        i = 0 if Q[0][0][0] <= Q[1][0][0] else 1 # direction to expand
+        du, _, u = heapq.heappop(Q[i])
+        if u in S[i]: # skip stale entries
+            continue
+        S[i].add(u)
+        for v, w in nbrs(u):
+            dv = du + w
+            if v not in S[i] and dv < d[i].get(v, math.inf):
+                d[i][v], pred[i][v] = dv, u
+                heapq.heappush(Q[i], (dv, count, v))
+                count += 1
+            if v in d[1-i] and dv + d[1-i][v] < mu:
+                mu = dv + d[1-i][v]
+                meet = (u, v) if i == 0 else (v, u)
 
-def bellman_ford_path(G: Graph, p_id: Any, q_id: Any) -> List[Any]:
-    """"""
-    G = init_single_source(G, p_id) # initialize nodes
-    for _ in range(len(G.nodes) - 1):
-        for u, v, w in G.edges(data='weight'):
-            relaxed, G = relax(G, u, v, w)
-
-    # compute path
-    path = get_path(G, q_id)
-    print(path)
-    if path[0] != p_id:
+    settled = len(S[0]) + len(S[1])
+    if counters is not None: # both directions start with one entry
+        _heap_counters(counters, count + 1, len(Q[0]) + len(Q[1]), settled)
+        counters['relaxations'] -= 1
+        metrics.report('bidirectional', counters, stats)
+    if meet is None:
+        return None, settled
+    # join forward path to meet[0] and backward path from meet[1]
+    path = get_path(pred[0], meet[0]) + get_path(pred[1], meet[1])[::-1]
+
+    return path, settled
+
+def bidirectional_dijkstra_path(
+        G: Graph,
+        p_id: Any,
+        q_id: Any,
+        overlay: dict = None,
+        stats: dict = None) -> List[Any]:
+    """Point-to-point bidirectional Dijkstra's search."""
+    nbrs = lambda u: ((v, data['weight'])
+                      for v, data in neighbors(G, u, overlay))
+    path, _ = bidirectional_search(nbrs, p_id, q_id, stats)
+    if path is None:
         raise RuntimeError(f'There is no path between nodes {p_id} and {q_id}')
 
     return path
-            
-
-def dijkstra_path(G: Graph, p_id: Any, q_id: Any) -> List[Any]:
-    """"""
-    G = init_single_source(G, p_id) # initialize nodes
-    S = set() # initialize set of path vertices
-    Q = PriorityQueue() # priority queue
-    Q.put((G.nodes[p_id]['d'], p_id)) # insert root into Q
-    while not Q.empty():
-        _, u = Q.get()
+
+def astar_search(
+        nbrs: Callable,
+        h: Callable,
+        s: Any,
+        t: Any,
+        stats: dict = None) -> Tuple[dict, dict, int]:
+    """A* search from s to t. Nodes are settled by distance plus heuristic
+    estimate, which must be consistent for paths to be shortest ones.
+    ---------------------------------------------------------------------------
+    Args:
+        nbrs: function mapping a node to an iterable of (neighbor, weight)
+        h: function mapping a node to a lower bound of its distance to t
+        s: source node
+        t: target node
+        stats: dict to add the heap counters and wall time to, see
+            dijkstra_search
+    Returns:
+        d: distances of reached nodes
+        pred: predecessors of reached nodes
+        settled: number of settled nodes"""
+    counters = metrics.probe(stats)
+    d, pred = {s: 0.}, {s: None}
+    S = set()
+    Q = [(h(s), 0, s)]
+    count = 1
+    while Q:
+        _, _, u = heapq.heappop(Q)
+        if u in S: # skip stale entries
+            continue
         S.add(u)
-        for v in G.neighbors(u):
-            if v not in S:
-                # retrieve edge weight
-                edge_data = G.get_edge_data(u, v)
-                w = edge_data['weight']
-                # perform edge relaxation
-                relaxed, G = relax(G, u, v, w)
-                if relaxed is True:
-                    Q.put((G.nodes[v]['d'], v))
-
-    # compute path
-    path = get_path(G, q_id)
-    if path[0] != p_id:
+        if u == t:
+            break
+        du = d[u]
+        for v, w in nbrs(u):
+            dv = du + w
+            if v not in S and dv < d.get(v, math.inf):
+                d[v], pred[v] = dv, u
+                heapq.heappush(Q, (dv + h(v), count, v))
+                count += 1
+    if counters is not None:
+        _heap_counters(counters, count, len(Q), len(S))
+        metrics.report('astar', counters, stats)
+
+    return d, pred, len(S)
+
+def euclidean_heuristic(
+        coords: Callable,
+        t: Any,
+        scale: float = 1.) -> Callable:
+    """Straight-line distance to t. Planar edge weights are Euclidean distances
+    between station coords, so it is admissible and consistent once scaled
+    by heuristic_scale. Nodes without coords get a zero estimate.
+    ---------------------------------------------------------------------------
+    Args:
+        coords: function mapping a node to its (x, y) coords or None
+        t: target node
+        scale: factor keeping the estimate a lower bound, see heuristic_scale
+            and CSRGraph.set_profile, 0 to search without estimates
+    Returns:
+        h: heuristic function"""
+    target = coords(t)
+    if target is None or scale <= 0:
+        return lambda u: 0.
+    xt, yt = target
+
+    def h(u):
+        c = coords(u)
+        return 0. if c is None else \
+               scale * math.sqrt((c[0] - xt)**2 + (c[1] - yt)**2)
+
+    return h
+
+def astar_path(
+        G: Graph,
+        p_id: Any,
+        q_id: Any,
+        overlay: dict = None,
+        stats: dict = None) -> List[Any]:
+    """Point-to-point A* search guided by node coordinates."""
+    nbrs = lambda u: ((v, data['weight'])
+                      for v, data in neighbors(G, u, overlay))
+    h = euclidean_heuristic(lambda u: node_coords(G, u, overlay), q_id,
+                            heuristic_scale(G))
+    _, pred, _ = astar_search(nbrs, h, p_id, q_id, stats)
+    if q_id not in pred:
+        raise RuntimeError(f'There is no path between nodes {p_id} and {q_id}')
+
+    return get_path(pred, q_id)
+
+class CSRGraph:
+    def __init__(self, G: Graph):
+        """Constructor method. Compiles a weighted undirected graph into
+        compressed sparse row (CSR) arrays with integer node indices. Neighbors
+        of node index i are indices[indptr[i]:indptr[i+1]] and their edge
+        weights are weights[indptr[i]:indptr[i+1]]. Undirected edges are
+        numbered in networkx ordering, edge_ids holds the edge id of every
+        neighbor slot. Weights read by searches are the base ones times the
+        current weight profile, see set_profile.
+        -----------------------------------------------------------------------
+        Args:
+            G: networkx graph with 'weight' edge attributes"""
+        # id <-> index mapping
+        self.ids = list(G.nodes)
+        self.index = {node_id: i for i, node_id in enumerate(self.ids)}
+        # undirected edge arrays in networkx ordering for edge sweeps
+        edges = list(G.edges(data='weight'))
+        self.edge_u = np.array([self.index[u] for u, _, _ in edges],
+                               dtype=np.int64)
+        self.edge_v = np.array([self.index[v] for _, v, _ in edges],
+                               dtype=np.int64)
+        self.base_edge_w = np.array([w for _, _, w in edges], dtype=np.float64)
+        eid = {}
+        for e, (u, v) in enumerate(zip(self.edge_u.tolist(),
+                                       self.edge_v.tolist())):
+            eid[u, v] = eid[v, u] = e
+        # adjacency arrays, neighbors keep networkx ordering
+        degrees = [len(G.adj[u]) for u in self.ids]
+        self.indptr = np.zeros(len(self.ids) + 1, dtype=np.int64)
+        np.cumsum(degrees, out=self.indptr[1:])
+        self.indices = np.array([self.index[v] for u in self.ids
+                                 for v in G.adj[u]], dtype=np.int64)
+        self.base_weights = np.array([data['weight'] for u in self.ids
+                                      for data in G.adj[u].values()],
+                                     dtype=np.float64)
+        self.edge_ids = np.array([eid[self.index[u], self.index[v]]
+                                  for u in self.ids for v in G.adj[u]],
+                                 dtype=np.int64)
+        # profile multipliers, weights, edge weights and heuristic scale
+        self.__active = (None, self.base_weights, self.base_edge_w, 1.)
+        self.version = 0 # number of profile swaps, see graph_version
+        # node coords for goal-directed search, nan if unknown
+        self.geodesic = bool(G.graph.get('geodesic', False))
+        self.xs = np.array([G.nodes[u].get('x', math.nan) for u in self.ids],
+                           dtype=np.float64)
+        self.ys = np.array([G.nodes[u].get('y', math.nan) for u in self.ids],
+                           dtype=np.float64)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def active(self) -> tuple:
+        """Current profile multipliers (None if unset), neighbor slot weights,
+        edge weights and A* heuristic scale, read at once so that a search
+        never mixes two profiles."""
+        return self.__active
+
+    @property
+    def profile(self) -> ndarray:
+        """Current read-only per-edge multipliers, None if unset."""
+        return self.__active[0]
+
+    @property
+    def weights(self) -> ndarray:
+        """Neighbor slot weights under the current profile."""
+        return self.__active[1]
+
+    @property
+    def edge_w(self) -> ndarray:
+        """Undirected edge weights under the current profile."""
+        return self.__active[2]
+
+    def set_profile(self, multipliers: ndarray = None) -> ndarray:
+        """Swaps the weight profile in a single assignment. Searches already
+        running keep the weights they started with, later ones read the new
+        ones, and version is bumped so that caches over the graph drop their
+        results, see graph_version. Overlay edges of query points keep their
+        weights.
+        ------------------------------------------------------------------------
+        Args:
+            multipliers: (e,)-shape array of positive factors indexed by edge
+                id, None to go back to base weights
+        Returns:
+            previous: multipliers of the replaced profile, None if unset"""
+        if multipliers is None:
+            active = (None, self.base_weights, self.base_edge_w, 1.)
+        else:
+            m = np.array(multipliers, dtype=np.float64) # caller may reuse it
+            if m.shape != self.base_edge_w.shape:
+                raise ValueError(f'Profile has shape {m.shape}, expected one '
+                                 f'multiplier per edge {self.base_edge_w.shape}')
+            if not (np.isfinite(m).all() and (m > 0).all()):
+                raise ValueError('Profile multipliers must be positive and '
+                                 'finite')
+            m.flags.writeable = False
+            # straight-line heuristic stays a lower bound if scaled by the
+            # smallest multiplier below one
+            scale = min(1., float(m.min())) if m.shape[0] > 0 else 1.
+            active = (m, self.base_weights * m[self.edge_ids],
+                      self.base_edge_w * m, scale)
+        previous = self.__active[0]
+        self.__active = active
+        self.version += 1
+
+        return previous
+
+    def edge_id(self, u_id: Any, v_id: Any) -> int:
+        """Id of the edge joining two stations, -1 if there is none."""
+        i, j = self.index[u_id], self.index[v_id]
+        a, b = self.indptr[i], self.indptr[i+1]
+        slots = np.flatnonzero(self.indices[a:b] == j)
+
+        return int(self.edge_ids[a + slots[0]]) if slots.shape[0] > 0 else -1
+
+    def incident_edges(self, node_ids: List[Any]) -> ndarray:
+        """Ids of the edges touching any of some stations."""
+        idx = np.array([self.index[u] for u in node_ids], dtype=np.int64)
+
+        return np.flatnonzero(np.isin(self.edge_u, idx) |
+                              np.isin(self.edge_v, idx))
+
+    def resolve(self, overlay: dict = None) -> Tuple[List[Any], dict, dict]:
+        """Maps a per-query overlay onto node indices. Virtual nodes, the ones
+        not in the compiled graph, get indices following the compiled ones.
+        ------------------------------------------------------------------------
+        Args:
+            overlay: extra adjacency, see attach_query_points
+        Returns:
+            virtual: list of virtual node ids, index len(self) + j is virtual[j]
+            vindex: map from virtual node ids to their indices
+            extra: map from node index to a list of (neighbor index, weight)
+                overlay edges"""
+        virtual, vindex, extra = [], {}, {}
+        if overlay is None:
+            return virtual, vindex, extra
+
+        for u in overlay:
+            if u not in self.index:
+                vindex[u] = len(self) + len(virtual)
+                virtual.append(u)
+        for u, nbrs in overlay.items():
+            extra[self.lookup(u, vindex)] = [
+                (self.lookup(v, vindex), data['weight'])
+                for v, data in nbrs.items()]
+
+        return virtual, vindex, extra
+
+    def lookup(self, node_id: Any, vindex: dict = None) -> int:
+        """Returns the index of a compiled or virtual node id."""
+        if node_id in self.index:
+            return self.index[node_id]
+
+        return vindex[node_id]
+
+    def get_path(
+            self,
+            pred: List[int],
+            s: int,
+            t: int,
+            virtual: List[Any] = ()) -> List[Any]:
+        """Follows predecessors from node index t back to node index s.
+        ------------------------------------------------------------------------
+        Args:
+            pred: predecessor index of each node, -1 if missing
+            s: source node index
+            t: target node index
+            virtual: list of virtual node ids, see resolve
+        Returns:
+            path: list of node ids from s to t"""
+        n = len(self)
+        ids = [self.ids[i] if i < n else virtual[i - n] for i in (s, t)]
+        path = [t]
+        while pred[path[-1]] >= 0:
+            path.append(pred[path[-1]])
+        if path[-1] != s:
+            raise RuntimeError(f'There is no path between nodes {ids[0]} '
+                               f'and {ids[1]}')
+
+        return [self.ids[i] if i < n else virtual[i - n]
+                for i in reversed(path)]
+
+def weight_profile(
+        C: CSRGraph,
+        factor: Any = 1.,
+        penalties: dict = None) -> ndarray:
+    """Per-edge multipliers for CSRGraph.set_profile, e.g. hour-of-day travel
+    time factors times penalties of stations that are empty or full. An edge
+    takes the largest penalty of its two stations.
+    ---------------------------------------------------------------------------
+    Args:
+        C: compiled graph
+        factor: scalar or (e,)-shape array of multipliers indexed by edge id
+        penalties: dict mapping station ids to multipliers of their edges, at
+            least 1, ValueError otherwise
+    Returns:
+        multipliers: (e,)-shape array of edge multipliers"""
+    m = np.broadcast_to(np.asarray(factor, dtype=np.float64),
+                        C.base_edge_w.shape).copy()
+    if penalties:
+        node = np.ones(len(C))
+        for u, penalty in penalties.items():
+            if not 1 <= penalty < math.inf:
+                raise ValueError(f'Penalty of station {u} must be finite and '
+                                 f'at least 1, got {penalty}')
+            node[C.index[u]] = penalty
+        m *= np.maximum(node[C.edge_u], node[C.edge_v])
+
+    return m
+
+def csr_dijkstra_search(
+        C: CSRGraph,
+        s: int,
+        t: int = -1,
+        n: int = None,
+        extra: dict = None,
+        stats: dict = None) -> Tuple[List[float], List[int], List[int]]:
+    """Dijkstra's algorithm over a compiled graph. Distances and predecessors
+    are flat per-query lists, so the compiled graph is never modified. Stops
+    once t, if given, is settled.
+    ---------------------------------------------------------------------------
+    Args:
+        C: compiled graph
+        s: source node index
+        t: target node index, -1 to settle the whole graph
+        n: number of compiled and virtual nodes, len(C) if None
+        extra: overlay edges of each node index, see CSRGraph.resolve
+        stats: dict to add the heap counters and wall time to, see
+            dijkstra_search
+    Returns:
+        d: distance of each node, infinite if not reached
+        pred: predecessor index of each node, -1 if missing
+        order: node indices in settling order"""
+    counters = metrics.probe(stats)
+    indptr, indices = C.indptr.tolist(), C.indices.tolist()
+    weights = C.weights.tolist()
+    n = len(C) if n is None else n
+    extra = {} if extra is None else extra
+    d = [math.inf] * n
+    pred = [-1] * n
+    done = [False] * n
+    order = []
+    d[s] = 0.
+    Q = [(0., s)]
+    pushes = 1
+    while Q:
+        du, u = heapq.heappop(Q)
+        if done[u]: # skip stale entries
+            continue
+        done[u] = True
+        order.append(u)
+        if u == t: # target distance is final
+            break
+        nbrs = []
+        if u < len(C):
+            a, b = indptr[u], indptr[u+1]
+            nbrs = zip(indices[a:b], weights[a:b])
+        for v, w in chain(nbrs, extra.get(u, ())):
+            if not done[v] and d[v] > du + w:
+                d[v] = du + w
+                pred[v] = u
+                heapq.heappush(Q, (d[v], v))
+                pushes += 1
+    if counters is not None:
+        _heap_counters(counters, pushes, len(Q), len(order))
+        metrics.report('dijkstra', counters, stats)
+
+    return d, pred, order
+
+def csr_dijkstra_path(
+        C: CSRGraph,
+        p_id: Any,
+        q_id: Any,
+        overlay: dict = None,
+        stats: dict = None) -> List[Any]:
+    """Point-to-point Dijkstra's search over a compiled graph, see
+    csr_dijkstra_search.
+    ---------------------------------------------------------------------------
+    Args:
+        C: compiled graph
+        p_id: source node id
+        q_id: target node id
+        overlay: per-query extra adjacency, see attach_query_points
+        stats: dict to add the search counters to, see metrics.report
+    Returns:
+        path: list of node ids from p_id to q_id"""
+    virtual, vindex, extra = C.resolve(overlay)
+    s, t = C.lookup(p_id, vindex), C.lookup(q_id, vindex)
+    _, pred, _ = csr_dijkstra_search(C, s, t, len(C) + len(virtual), extra,
+                                     stats)
+
+    return C.get_path(pred, s, t, virtual)
+
+def csr_bidirectional_dijkstra_path(
+        C: CSRGraph,
+        p_id: Any,
+        q_id: Any,
+        overlay: dict = None,
+        stats: dict = None) -> List[Any]:
+    """Bidirectional Dijkstra's search over a compiled graph.
+    ---------------------------------------------------------------------------
+    Args:
+        C: compiled graph
+        p_id: source node id
+        q_id: target node id
+        overlay: per-query extra adjacency, see attach_query_points
+        stats: dict to add the search counters to, see metrics.report
+    Returns:
+        path: list of node ids from p_id to q_id"""
+    virtual, vindex, extra = C.resolve(overlay)
+    s, t = C.lookup(p_id, vindex), C.lookup(q_id, vindex)
+    indptr, indices = C.indptr.tolist(), C.indices.tolist()
+    weights = C.weights.tolist()
+
+    def nbrs(u):
+        if u < len(C):
+            a, b = indptr[u], indptr[u+1]
+            yield from zip(indices[a:b], weights[a:b])
+        yield from extra.get(u, ())
+
+    path, _ = bidirectional_search(nbrs, s, t, stats)
+    if path is None:
+        raise RuntimeError(f'There is no path between nodes {p_id} and {q_id}')
+
+    return [C.ids[i] if i < len(C) else virtual[i - len(C)] for i in path]
+
+def csr_astar_path(
+        C: CSRGraph,
+        p_id: Any,
+        q_id: Any,
+        overlay: dict = None,
+        stats: dict = None) -> List[Any]:
+    """A* search over a compiled graph guided by node coordinates.
+    ---------------------------------------------------------------------------
+    Args:
+        C: compiled graph
+        p_id: source node id
+        q_id: target node id
+        overlay: per-query extra adjacency, see attach_query_points
+        stats: dict to add the search counters to, see metrics.report
+    Returns:
+        path: list of node ids from p_id to q_id"""
+    virtual, vindex, extra = C.resolve(overlay)
+    s, t = C.lookup(p_id, vindex), C.lookup(q_id, vindex)
+    indptr, indices = C.indptr.tolist(), C.indices.tolist()
+    _, weights, _, scale = C.active # profile weights and heuristic scale
+    scale = 0. if C.geodesic else scale
+    weights = weights.tolist()
+    xs, ys = C.xs.tolist(), C.ys.tolist()
+    vcoords = getattr(overlay, 'coords', {})
+
+    def nbrs(u):
+        if u < len(C):
+            a, b = indptr[u], indptr[u+1]
+            yield from zip(indices[a:b], weights[a:b])
+        yield from extra.get(u, ())
+
+    def coords(u):
+        if u >= len(C):
+            return vcoords.get(virtual[u - len(C)])
+        return None if math.isnan(xs[u]) else (xs[u], ys[u])
+
+    _, pred, _ = astar_search(nbrs, euclidean_heuristic(coords, t, scale),
+                              s, t, stats)
+    if t not in pred:
+        raise RuntimeError(f'There is no path between nodes {p_id} and {q_id}')
+
+    return [C.ids[i] if i < len(C) else virtual[i - len(C)]
+            for i in get_path(pred, t)]
+
+def csr_bellman_ford_path(
+        C: CSRGraph,
+        p_id: Any,
+        q_id: Any,
+        overlay: dict = None,
+        mode: str = 'sweep',
+        stats: dict = None) -> List[Any]:
+    """Bellman-Ford search over a compiled graph, see bellman_ford_path.
+    ---------------------------------------------------------------------------
+    Args:
+        C: compiled graph
+        p_id: source node id
+        q_id: target node id
+        overlay: per-query extra adjacency, see attach_query_points
+        mode: 'sweep', 'spfa' or 'numpy'
+        stats: dict to add the search counters to, see metrics.report
+    Returns:
+        path: list of node ids from p_id to q_id"""
+    virtual, vindex, extra = C.resolve(overlay)
+    s, t = C.lookup(p_id, vindex), C.lookup(q_id, vindex)
+    n = len(C) + len(virtual)
+    # virtual nodes own their overlay edges
+    extra_edges = [(u, v, w) for u in extra if u >= len(C) for v, w in extra[u]]
+    if mode == 'numpy':
+        u, v, w = (np.array(a) for a in zip(*extra_edges)) if extra_edges \
+                  else (np.empty(0, dtype=np.int64),) * 2 + (np.empty(0),)
+        d, pred, _ = numpy_bellman_ford_search(
+            np.concatenate([C.edge_u, u]).astype(np.int64),
+            np.concatenate([C.edge_v, v]).astype(np.int64),
+            np.concatenate([C.edge_w, w]), n, s, stats)
+        pred = pred.tolist()
+    else:
+        d = [math.inf] * n
+        pred = [-1] * n
+        d[s] = 0.
+        if mode == 'spfa':
+            indptr, indices = C.indptr.tolist(), C.indices.tolist()
+            weights = C.weights.tolist()
+
+            def nbrs(u):
+                if u < len(C):
+                    a, b = indptr[u], indptr[u+1]
+                    yield from zip(indices[a:b], weights[a:b])
+                yield from extra.get(u, ())
+
+            spfa_search(nbrs, d, pred, s, stats)
+        else:
+            E = list(zip(C.edge_u.tolist(), C.edge_v.tolist(),
+                         C.edge_w.tolist()))
+            bellman_ford_search(E + extra_edges, d, pred, stats)
+
+    return C.get_path(pred, s, t, virtual)
+
+def _witness_search(
+        adj: List[dict],
+        u: int,
+        v: int,
+        limit: float,
+        settle_limit: int) -> dict:
+    """Dijkstra's search from u over the remaining graph avoiding v, bounded
+    by distance limit and number of settled nodes.
+    ---------------------------------------------------------------------------
+    Args:
+        adj: remaining adjacency, adj[a] maps neighbors to edge weights
+        u: source node index
+        v: node index being contracted
+        limit: largest distance worth settling
+        settle_limit: largest number of nodes to settle
+    Returns:
+        d: distances of reached nodes, upper bounds if not settled"""
+    d, done = {u: 0.}, set()
+    Q = [(0., u)]
+    while Q and len(done) < settle_limit:
+        du, a = heapq.heappop(Q)
+        if a in done: # skip stale entries
+            continue
+        if du > limit:
+            break
+        done.add(a)
+        for b, w in adj[a].items():
+            if b != v and du + w < d.get(b, math.inf):
+                d[b] = du + w
+                heapq.heappush(Q, (d[b], b))
+
+    return d
+
+def _shortcuts(adj: List[dict], v: int, settle_limit: int) -> List[tuple]:
+    """Shortcuts needed to contract v, one per pair of neighbors u, w whose
+    path u-v-w is shorter than any witness path avoiding v.
+    ---------------------------------------------------------------------------
+    Args:
+        adj: remaining adjacency, adj[a] maps neighbors to edge weights
+        v: node index to contract
+        settle_limit: largest number of nodes settled per witness search
+    Returns:
+        shortcuts: list of (u, w, weight) shortcuts"""
+    nbrs = list(adj[v].items())
+    shortcuts = []
+    for i, (u, wu) in enumerate(nbrs[:-1]):
+        limit = wu + max(ww for _, ww in nbrs[i+1:])
+        d = _witness_search(adj, u, v, limit, settle_limit)
+        for w, ww in nbrs[i+1:]:
+            if d.get(w, math.inf) > wu + ww:
+                shortcuts.append((u, w, wu + ww))
+
+    return shortcuts
+
+class ContractionHierarchy:
+    # persisted arrays
+    fields = ('ids', 'indptr', 'indices', 'weights', 'mid', 'via_src',
+              'via_dst')
+
+    def __init__(self, G: Graph, settle_limit: int = 64):
+        """Constructor method. Contracts graph nodes one at a time, in order
+        of edge difference plus contracted neighbors, adding shortcuts that
+        preserve shortest-path distances among remaining nodes. Only upward
+        edges, towards later contracted nodes, are kept in CSR arrays. The
+        upward edges of node i are indices[indptr[i]:indptr[i+1]]; mid is the
+        contracted node a shortcut bypasses, -1 for original edges, and
+        via_src, via_dst are the upward edges from mid to each shortcut end.
+        Weights of a compiled graph include its current profile, so a new
+        hierarchy is needed after swapping it, see CSRGraph.set_profile.
+        -----------------------------------------------------------------------
+        Args:
+            G: station graph, either networkx or compiled
+            settle_limit: largest number of nodes settled per witness search,
+                lower limits preprocess faster but add more shortcuts"""
+        C = G if isinstance(G, CSRGraph) else CSRGraph(G)
+        n = len(C)
+        self.ids = np.array(C.ids)
+        # remaining adjacency and bypassed node of each shortcut
+        adj = [{} for _ in range(n)]
+        mids = {}
+        for u, v, w in zip(C.edge_u.tolist(), C.edge_v.tolist(),
+                           C.edge_w.tolist()):
+            if u != v and w < adj[u].get(v, math.inf):
+                adj[u][v] = adj[v][u] = w
+        up = [None] * n # upward edges of contracted nodes
+        deleted = [0] * n # contracted neighbors of each node
+        priority = lambda v: (len(_shortcuts(adj, v, settle_limit))
+                              - len(adj[v]) + deleted[v])
+        Q = [(priority(v), v) for v in range(n)]
+        heapq.heapify(Q)
+        while Q:
+            _, v = heapq.heappop(Q)
+            p = priority(v) # lazy update, neighbors may have changed
+            if Q and p > Q[0][0]:
+                heapq.heappush(Q, (p, v))
+                continue
+            for a, b, w in _shortcuts(adj, v, settle_limit):
+                if w < adj[a].get(b, math.inf):
+                    adj[a][b] = adj[b][a] = w
+                    mids[min(a, b), max(a, b)] = v
+            up[v] = [(u, w, mids.get((min(u, v), max(u, v)), -1))
+                     for u, w in adj[v].items()]
+            for u in adj[v]:
+                del adj[u][v]
+                deleted[u] += 1
+            adj[v] = {}
+
+        # upward edges CSR arrays
+        self.indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in up], out=self.indptr[1:])
+        self.indices = np.array([u for e in up for u, _, _ in e],
+                                dtype=np.int64)
+        self.weights = np.array([w for e in up for _, w, _ in e],
+                                dtype=np.float64)
+        self.mid = np.array([m for e in up for _, _, m in e], dtype=np.int64)
+        # a shortcut src-dst bypasses mid, whose upward edges reach both ends
+        edge = {(v, u): i for v in range(n)
+                for i, u in zip(range(self.indptr[v], self.indptr[v+1]),
+                                self.indices[self.indptr[v]:self.indptr[v+1]])}
+        src = np.repeat(np.arange(n), np.diff(self.indptr))
+        self.via_src = np.array([edge[m, s] if m >= 0 else -1
+                                 for s, m in zip(src, self.mid)],
+                                dtype=np.int64)
+        self.via_dst = np.array([edge[m, d] if m >= 0 else -1
+                                 for d, m in zip(self.indices, self.mid)],
+                                dtype=np.int64)
+        self.__prepare()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the hierarchy arrays, in bytes."""
+        return sum(getattr(self, f).nbytes for f in self.fields)
+
+    def save(self, fname: str) -> None:
+        """Stores hierarchy arrays in a .npz file. No Python objects are
+        pickled.
+        ------------------------------------------------------------------------
+        Args:
+            fname: output filename"""
+        np.savez(fname, **{f: getattr(self, f) for f in self.fields})
+
+    @classmethod
+    def load(cls, fname: str) -> 'ContractionHierarchy':
+        """Loads a hierarchy previously stored with save method.
+        ------------------------------------------------------------------------
+        Args:
+            fname: input filename
+        Returns:
+            hierarchy: loaded contraction hierarchy"""
+        ch = cls.__new__(cls)
+        with np.load(fname, allow_pickle=False) as data:
+            for f in cls.fields:
+                setattr(ch, f, data[f])
+        ch.__prepare()
+
+        return ch
+
+    def __prepare(self) -> None:
+        """Builds id to index map and list copies of the arrays read by
+        queries, Python lists being faster to index one item at a time."""
+        self.index = {node_id: i for i, node_id in
+                      enumerate(self.ids.tolist())}
+        self.__lists = [getattr(self, f).tolist() for f in self.fields[1:]]
+        # source of each upward edge
+        self.__lists.append(np.repeat(np.arange(len(self.ids)),
+                                      np.diff(self.indptr)).tolist())
+
+    def __seeds(self, node_id: Any, overlay: dict = None) -> dict:
+        """Initial distances of a search from a station or a virtual node."""
+        if node_id in self.index:
+            return {self.index[node_id]: 0.}
+
+        return {self.index[v]: data['weight']
+                for v, data in overlay[node_id].items() if v in self.index}
+
+    def __inner(self, e: int) -> List[int]:
+        """Original nodes a shortcut bypasses, from its source to its target
+        upward edge end, both excluded. Empty for original edges."""
+        mid, via_src, via_dst = self.__lists[3:6]
+        if mid[e] < 0:
+            return []
+        # source to mid is upward edge via_src reversed, mid to target is via_dst
+        return self.__inner(via_src[e])[::-1] + [mid[e]] \
+               + self.__inner(via_dst[e])
+
+    def search(
+            self,
+            p_id: Any,
+            q_id: Any,
+            overlay: dict = None) -> Tuple[List[Any], int]:
+        """Bidirectional upward search. Both searches only follow edges
+        towards later contracted nodes, and each one stops once its smallest
+        key reaches the best distance found through a node reached by both.
+        ------------------------------------------------------------------------
+        Args:
+            p_id: source node id
+            q_id: target node id
+            overlay: per-query extra adjacency, see attach_query_points
+        Returns:
+            path: list of node ids from p_id to q_id, None if there is no path
+            settled: number of settled nodes in both directions"""
+        if p_id == q_id:
+            return [p_id], 1
+        indptr, indices, weights = self.__lists[:3]
+        src = self.__lists[6]
+        seeds = (self.__seeds(p_id, overlay), self.__seeds(q_id, overlay))
+        d = (dict(seeds[0]), dict(seeds[1]))
+        pred = ({u: -1 for u in seeds[0]}, {u: -1 for u in seeds[1]})
+        S = (set(), set())
+        Q = ([(w, u) for u, w in seeds[0].items()],
+             [(w, u) for u, w in seeds[1].items()])
+        heapq.heapify(Q[0])
+        heapq.heapify(Q[1])
+        mu, meet = math.inf, None
+        # query points joined by an overlay edge
+        if overlay is not None and q_id in overlay.get(p_id, ()):
+            mu = overlay[p_id][q_id]['weight']
+        while (Q[0] and Q[0][0][0] < mu) or (Q[1] and Q[1][0][0] < mu):
+            # expand the direction with the smallest key still below mu
+            i = 0 if Q[0] and Q[0][0][0] < mu and \
+                     (not Q[1] or Q[0][0][0] <= Q[1][0][0]) else 1
+            du, u = heapq.heappop(Q[i])
+            if u in S[i]: # skip stale entries
+                continue
+            S[i].add(u)
+            if u in d[1-i] and du + d[1-i][u] < mu:
+                mu, meet = du + d[1-i][u], u
+            for e in range(indptr[u], indptr[u+1]):
+                v, dv = indices[e], du + weights[e]
+                if dv < d[i].get(v, math.inf):
+                    d[i][v], pred[i][v] = dv, e
+                    heapq.heappush(Q[i], (dv, v))
+
+        settled = len(S[0]) + len(S[1])
+        if meet is None:
+            if mu < math.inf: # direct overlay edge
+                return [p_id, q_id], settled
+            return None, settled
+        # unpack upward edges from meet back to both seeds
+        halves = []
+        for i in (0, 1):
+            nodes, u = [meet], meet
+            while pred[i][u] >= 0:
+                e = pred[i][u]
+                u = src[e]
+                nodes += self.__inner(e)[::-1] + [u]
+            halves.append(nodes)
+        path = halves[0][::-1] + halves[1][1:]
+        path = [self.ids[i].item() for i in path]
+        if p_id not in self.index:
+            path.insert(0, p_id)
+        if q_id not in self.index:
+            path.append(q_id)
+
+        return path, settled
+
+def ch_path(
+        H: ContractionHierarchy,
+        p_id: Any,
+        q_id: Any,
+        overlay: dict = None,
+        stats: dict = None) -> List[Any]:
+    """Point-to-point search over a contraction hierarchy, see
+    ContractionHierarchy.search. Only settled nodes and wall time are added
+    to stats."""
+    counters = metrics.probe(stats)
+    path, settled = H.search(p_id, q_id, overlay)
+    if counters is not None:
+        counters['settled'] = settled
+        metrics.report('ch', counters, stats)
+    if path is None:
         raise RuntimeError(f'There is no path between nodes {p_id} and {q_id}')
 
     return path
 
-def connect_query_points(G, T, ids, p, q, k=3):
-    """"""
-    id_p, id_q = ids
-    G.add_node(id_p)
-    dists_p, near_p = T.nearest_neighbors(p, T.root, k=k)
-    edges = [(id_p, nn.id, d) for nn, d in zip(near_p, dists_p)]
-    G.add_weighted_edges_from(edges)
-    dists_q, near_q = T.nearest_neighbors(q, T.root, k=k)
-    edges = [(id_q, nn.id, d) for nn, d in zip(near_q, dists_q)]
-    G.add_weighted_edges_from(edges)
+def hierarchy_cached(
+        G: Graph,
+        fname: str,
+        k: int,
+        cache_dir: str = 'cache',
+        extra: tuple = ()) -> ContractionHierarchy:
+    """Contraction hierarchy of the graph built from a stations CSV file,
+    loaded from cache_dir if it was already built for the same file contents
+    and k.
+    ---------------------------------------------------------------------------
+    Args:
+        G: station graph built from fname with k nearest neighbors
+        fname: stations CSV file path
+        k: number of nearest neighbors per station
+        cache_dir: directory of cached hierarchies
+        extra: other parameters G depends on, such as its projection; the
+            weight profile of a compiled G is added to them
+    Returns:
+        hierarchy: contraction hierarchy of G"""
+    os.makedirs(cache_dir, exist_ok=True)
+    key = matrix_key(fname, k, _cache_extra(G, extra))
+    path = os.path.join(cache_dir, f'ch_{key}.npz')
+    if os.path.exists(path):
+        return ContractionHierarchy.load(path)
+    H = ContractionHierarchy(G)
+    H.save(f'{path}.{os.getpid()}.tmp.npz')
+    os.replace(f'{path}.{os.getpid()}.tmp.npz', path) # never a partial file
+
+    return H
+
+class Overlay(dict):
+    """Per-query extra adjacency {u: {v: {'weight': w}}} read by the search
+    functions along with the base graph. Coordinates of the virtual nodes it
+    introduces are kept in coords."""
+    def __init__(self):
+        super().__init__()
+        self.coords = {}
+
+def attach_query_points(
+        T: Tree,
+        ids: List[Any],
+        p: List[float],
+        q: List[float],
+        k: int = 3,
+        projection: Projection = None,
+        stations: Tuple[ndarray, ndarray, ndarray] = None) -> dict:
+    """Connects two query points to their k nearest stations through a
+    temporary overlay instead of modifying the graph. The overlay holds both
+    directions of every query edge and the query points coordinates. If the
+    projection of the coords is given, as for graphs built with one, query
+    edges use great-circle distances too.
+    ---------------------------------------------------------------------------
+    Args:
+        T: spatial index over the graph stations
+        ids: (id_p, id_q) virtual node ids of the query points
+        p: first query point coords
+        q: second query point coords
+        k: number of nearest stations to connect each point to
+        projection: projection of the coords, None for planar distances
+        stations: (ids, xs, ys) arrays the graph was built from, required
+            along with projection
+    Returns:
+        overlay: per-query extra adjacency"""
+    # query nearest stations of both points at once
+    points = np.array([p, q], dtype=np.float64)
+    if projection is None:
+        dists, near = T.query(points, k=k)
+    else:
+        station_ids, xs, ys = stations
+        index = {u: i for i, u in enumerate(np.asarray(station_ids).tolist())}
+        dists, near = geodesic_query(T, projection, points, k, xs, ys, index)
+
+    return overlay_from_neighbors(ids, (p, q), dists, near)
+
+def overlay_from_neighbors(
+        ids: List[Any],
+        points: List[List[float]],
+        dists: ndarray,
+        near: ndarray) -> dict:
+    """Connects query points to nearest stations found beforehand, e.g. by a
+    batched query shared with other requests, see attach_query_points.
+    ---------------------------------------------------------------------------
+    Args:
+        ids: virtual node ids of the query points
+        points: query points coords
+        dists: distances to the nearest stations of each point, infinite if
+            missing
+        near: nearest station ids of each point
+    Returns:
+        overlay: per-query extra adjacency"""
+    overlay = Overlay()
+    for node_id, point, row_nn, row_d in zip(ids, points, near, dists):
+        overlay.setdefault(node_id, {})
+        overlay.coords[node_id] = (float(point[0]), float(point[1]))
+        for nn_id, d in zip(row_nn, row_d):
+            if d < math.inf:
+                overlay[node_id][nn_id] = {'weight': d}
+                overlay.setdefault(nn_id, {})[node_id] = {'weight': d}
+
+    return overlay
+
+def connect_query_points(G, T, ids, p, q, k=3, projection=None,
+                         stations=None):
+    """Permanently connects two query points to their k nearest stations in G,
+    see attach_query_points. Use it instead to leave the graph untouched."""
+    overlay = attach_query_points(T, ids, p, q, k, projection, stations)
+    touch(G)
+    for node_id in ids: # store coordinates for A* heuristic
+        x, y = overlay.coords[node_id]
+        G.add_node(node_id, x=x, y=y)
+    G.add_weighted_edges_from((u, v, data['weight'])
+                              for u in ids for v, data in overlay[u].items())
 
     return G
 
@@ -124,11 +1545,323 @@ def path_plan(
         id_p: List[float],
         id_q: List[float],
         G: Graph,
-        method: str = 'dijkstra'):
-    """"""
-    if method == 'dijkstra':
-        path = dijkstra_path(G, id_p, id_q)
+        method: str = 'dijkstra',
+        overlay: dict = None,
+        stats: dict = None):
+    """Computes the shortest path between two nodes. G can be either a
+    networkx graph, its compiled CSRGraph or its ContractionHierarchy, and
+    none of them is modified. Query nodes attached through an overlay are
+    only visible to this search. All methods and engines agree on the path
+    length, but among paths of equal length, e.g. through stations sharing
+    coords, each one may return a different path: heap ties are broken by
+    insertion order and searches stop as soon as the target is settled. If
+    stats is given, the counters of the search and the wall time of the whole
+    call are added to it, see metrics.report."""
+    counters = metrics.probe(stats)
+    if isinstance(G, ContractionHierarchy): # method is implied
+        path = ch_path(G, id_p, id_q, overlay, counters)
+    elif isinstance(G, CSRGraph):
+        if method == 'dijkstra':
+            path = csr_dijkstra_path(G, id_p, id_q, overlay, counters)
+        elif method == 'bidirectional':
+            path = csr_bidirectional_dijkstra_path(G, id_p, id_q, overlay,
+                                                   counters)
+        elif method == 'astar':
+            path = csr_astar_path(G, id_p, id_q, overlay, counters)
+        elif method == 'spfa':
+            path = csr_bellman_ford_path(G, id_p, id_q, overlay, 'spfa',
+                                         counters)
+        elif method == 'bellman-ford-numpy':
+            path = csr_bellman_ford_path(G, id_p, id_q, overlay, 'numpy',
+                                         counters)
+        else:
+            path = csr_bellman_ford_path(G, id_p, id_q, overlay,
+                                         stats=counters)
+    elif method == 'dijkstra':
+        path = dijkstra_path(G, id_p, id_q, overlay, counters)
+    elif method == 'bidirectional':
+        path = bidirectional_dijkstra_path(G, id_p, id_q, overlay, counters)
+    elif method == 'astar':
+        path = astar_path(G, id_p, id_q, overlay, counters)
+    elif method == 'spfa':
+        path = bellman_ford_path(G, id_p, id_q, overlay, 'spfa', counters)
+    elif method == 'bellman-ford-numpy':
+        path = bellman_ford_path(G, id_p, id_q, overlay, 'numpy', counters)
     else:
-        path = bellman_ford_path(G, id_p, id_q)
+        path = bellman_ford_path(G, id_p, id_q, overlay, stats=counters)
+    if counters is not None:
+        metrics.report('path_plan', counters, stats)
 
     return G, path
+
+# shared state of pool worker processes
+_worker = {}
+
+def _init_worker(G, T, k: int, method: str) -> None:
+    """Stores the graph and tree shared by the queries of a worker process."""
+    _worker.update(G=G, T=T, k=k, method=method)
+
+def _plan_pair(pair: tuple) -> List[Any]:
+    """Routes a single pair of points using a worker's shared state."""
+    return plan_points(_worker['G'], _worker['T'], *pair, k=_worker['k'],
+                       method=_worker['method'])
+
+def plan_points(
+        G: Graph,
+        T: Tree,
+        p: List[float],
+        q: List[float],
+        k: int = 3,
+        method: str = 'dijkstra') -> List[Any]:
+    """Shortest path between two arbitrary points without modifying G.
+    ---------------------------------------------------------------------------
+    Args:
+        G: station graph, either networkx or compiled
+        T: spatial index over the graph stations
+        p: origin coords
+        q: destination coords
+        k: number of nearest stations to connect each point to
+        method: shortest-path method
+    Returns:
+        path: list of node ids from 'p' to 'q', None if there is no path"""
+    overlay = attach_query_points(T, ('p', 'q'), p, q, k=k)
+    try:
+        _, path = path_plan('p', 'q', G, method=method, overlay=overlay)
+    except NegativeCycleError:
+        raise
+    except RuntimeError: # no path between the points
+        path = None
+
+    return path
+
+def path_plan_many(
+        G: Graph,
+        T: Tree,
+        pairs: List[tuple],
+        k: int = 3,
+        method: str = 'dijkstra',
+        workers: int = 1,
+        executor: str = 'thread') -> List[List[Any]]:
+    """Routes many pairs of points concurrently over a shared graph. Queries
+    never modify G, so they can run in a thread pool, or in a process pool
+    whose workers receive G and T once.
+    ---------------------------------------------------------------------------
+    Args:
+        G: station graph, either networkx or compiled
+        T: spatial index over the graph stations
+        pairs: list of (p, q) pairs of origin and destination coords
+        k: number of nearest stations to connect each point to
+        method: shortest-path method
+        workers: number of worker threads or processes
+        executor: either 'thread' or 'process'
+    Returns:
+        paths: list of paths, one per pair, None where there is no path"""
+    pairs = [(tuple(p), tuple(q)) for p, q in pairs]
+    if workers <= 1:
+        return [plan_points(G, T, p, q, k=k, method=method) for p, q in pairs]
+
+    if executor == 'process':
+        pool = ProcessPoolExecutor(max_workers=workers,
+                                   initializer=_init_worker,
+                                   initargs=(G, T, k, method))
+        chunksize = max(1, len(pairs) // (4 * workers))
+        with pool:
+            return list(pool.map(_plan_pair, pairs, chunksize=chunksize))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda pair: plan_points(G, T, *pair, k=k,
+                                                      method=method), pairs))
+
+def _init_rows_worker(C: CSRGraph, fname_dist: str, fname_next: str) -> None:
+    """Stores the compiled graph and maps the output matrices of a worker
+    process."""
+    _worker.update(C=C, dist=np.load(fname_dist, mmap_mode='r+'),
+                   next=np.load(fname_next, mmap_mode='r+'))
+
+def _fill_rows(sources: range) -> int:
+    """Fills the matrices rows of some sources using a worker's shared state."""
+    fill_rows(_worker['C'], sources, _worker['dist'], _worker['next'])
+    _worker['dist'].flush()
+    _worker['next'].flush()
+
+    return len(sources)
+
+def fill_rows(
+        C: CSRGraph,
+        sources: range,
+        dist: ndarray,
+        nxt: ndarray) -> None:
+    """Runs a full Dijkstra's search from each source and stores distances and
+    next hops in its matrices row. The next hop from s towards v is the first
+    node after s along the shortest path tree of s.
+    ---------------------------------------------------------------------------
+    Args:
+        C: compiled graph
+        sources: source node indices
+        dist: (n, n) distances matrix, infinite if there is no path
+        nxt: (n, n) next hops matrix, -1 if there is no path"""
+    for s in sources:
+        d, pred, order = csr_dijkstra_search(C, s)
+        first = [-1] * len(C)
+        first[s] = s
+        for v in order[1:]: # predecessors are settled first
+            first[v] = v if pred[v] == s else first[pred[v]]
+        dist[s] = d
+        nxt[s] = first
+
+def profile_digest(G: Graph) -> str:
+    """Digest of the weight profile of a compiled graph, None for networkx
+    graphs and compiled ones without profile."""
+    m = getattr(G, 'profile', None)
+
+    return None if m is None else hashlib.sha256(m.tobytes()).hexdigest()[:16]
+
+def _cache_extra(G: Graph, extra: tuple) -> tuple:
+    """Parameters keying cached artifacts of G, its weight profile included
+    if any."""
+    digest = profile_digest(G)
+
+    return tuple(extra) if digest is None else \
+           tuple(extra) + (('profile', digest),)
+
+def matrix_key(fname: str, k: int, extra: tuple = ()) -> str:
+    """Cache key of the all-pairs matrices of the graph built with k nearest
+    neighbors from a stations CSV file, and any other parameters the graph
+    depends on."""
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    h.update(f'k={k}'.encode())
+    if extra:
+        h.update(repr(extra).encode())
+
+    return h.hexdigest()[:16]
+
+class AllPairs:
+    def __init__(self, ids: ndarray, dist: ndarray, nxt: ndarray):
+        """Constructor method. Station-to-station distances and next hops,
+        usually memory-mapped from disk, see all_pairs.
+        -----------------------------------------------------------------------
+        Args:
+            ids: node id of each matrix index
+            dist: (n, n) distances matrix, infinite if there is no path
+            nxt: (n, n) next hops matrix, -1 if there is no path"""
+        self.ids, self.dist, self.next = ids, dist, nxt
+        self.index = {node_id: i for i, node_id in enumerate(ids.tolist())}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, prefix: str) -> 'AllPairs':
+        """Maps matrices stored by all_pairs without copying them to memory.
+        ------------------------------------------------------------------------
+        Args:
+            prefix: matrices filenames prefix
+        Returns:
+            matrices: read-only memory-mapped matrices"""
+        return cls(np.load(f'{prefix}_ids.npy', allow_pickle=False),
+                   np.load(f'{prefix}_dist.npy', mmap_mode='r'),
+                   np.load(f'{prefix}_next.npy', mmap_mode='r'))
+
+    def distance(self, p_id: Any, q_id: Any) -> float:
+        """Shortest-path distance between two stations."""
+        return float(self.dist[self.index[p_id], self.index[q_id]])
+
+    def path(self, p_id: Any, q_id: Any) -> List[Any]:
+        """Shortest path between two stations following next hops, in time
+        proportional to its length.
+        ------------------------------------------------------------------------
+        Args:
+            p_id: source node id
+            q_id: target node id
+        Returns:
+            path: list of node ids from p_id to q_id"""
+        u, t = self.index[p_id], self.index[q_id]
+        if self.next[u, t] < 0:
+            raise RuntimeError(f'There is no path between nodes {p_id} '
+                               f'and {q_id}')
+        path = [u]
+        while u != t:
+            u = int(self.next[u, t])
+            path.append(u)
+
+        return [self.ids[i].item() for i in path]
+
+def all_pairs(
+        G: Graph,
+        prefix: str,
+        workers: int = 1,
+        chunksize: int = 64) -> AllPairs:
+    """Computes all-pairs shortest-path distances and next hops with one
+    Dijkstra's search per source, spread across processes. Matrices are
+    written straight to .npy files that workers map, and are later mapped
+    again without copying by AllPairs.load. Files are only renamed into place
+    once complete, so an interrupted run never leaves a partial cache.
+    ---------------------------------------------------------------------------
+    Args:
+        G: station graph, either networkx or compiled
+        prefix: matrices filenames prefix
+        workers: number of worker processes
+        chunksize: number of sources per task
+    Returns:
+        matrices: read-only memory-mapped matrices"""
+    C = G if isinstance(G, CSRGraph) else CSRGraph(G)
+    n = len(C)
+    tmp = f'{prefix}.{os.getpid()}.tmp'
+    dist = np.lib.format.open_memmap(f'{tmp}_dist.npy', mode='w+',
+                                     dtype=np.float64, shape=(n, n))
+    nxt = np.lib.format.open_memmap(f'{tmp}_next.npy', mode='w+',
+                                    dtype=np.int32, shape=(n, n))
+    chunks = [range(a, min(a + chunksize, n)) for a in range(0, n, chunksize)]
+    if workers <= 1:
+        for sources in chunks:
+            fill_rows(C, sources, dist, nxt)
+    else:
+        # workers write their rows to the shared files
+        dist.flush()
+        nxt.flush()
+        pool = ProcessPoolExecutor(max_workers=workers,
+                                   initializer=_init_rows_worker,
+                                   initargs=(C, f'{tmp}_dist.npy',
+                                             f'{tmp}_next.npy'))
+        with pool:
+            list(pool.map(_fill_rows, chunks))
+    dist.flush()
+    nxt.flush()
+    del dist, nxt
+    np.save(f'{tmp}_ids.npy', np.array(C.ids))
+    for name in ('dist', 'next', 'ids'): # ids go last, they mark completion
+        os.replace(f'{tmp}_{name}.npy', f'{prefix}_{name}.npy')
+
+    return AllPairs.load(prefix)
+
+def all_pairs_cached(
+        G: Graph,
+        fname: str,
+        k: int,
+        cache_dir: str = 'cache',
+        workers: int = 1,
+        extra: tuple = ()) -> AllPairs:
+    """All-pairs matrices of the graph built from a stations CSV file, loaded
+    from cache_dir if they were already computed for the same file contents
+    and k.
+    ---------------------------------------------------------------------------
+    Args:
+        G: station graph built from fname with k nearest neighbors
+        fname: stations CSV file path
+        k: number of nearest neighbors per station
+        cache_dir: directory of cached matrices
+        workers: number of worker processes on cache misses
+        extra: other parameters G depends on, such as its projection; the
+            weight profile of a compiled G is added to them
+    Returns:
+        matrices: read-only memory-mapped matrices"""
+    os.makedirs(cache_dir, exist_ok=True)
+    key = matrix_key(fname, k, _cache_extra(G, extra))
+    prefix = os.path.join(cache_dir, f'apsp_{key}')
+    if os.path.exists(f'{prefix}_ids.npy'):
+        return AllPairs.load(prefix)
+
+    return all_pairs(G, prefix, workers=workers)
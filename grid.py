@@ -0,0 +1,187 @@
+# stdlib modules
+import math
+from typing import List, Tuple
+
+# third-party modules
+import numpy as np
+from numpy import ndarray
+
+
+class Grid:
+    def __init__(
+            self,
+            ids: List[int],
+            xs: List[float],
+            ys: List[float],
+            bucket: float = 2.):
+        """Constructor method. Uniform grid spatial hash over the points'
+        bounding box, an alternative to Tree for nearest stations snapping.
+        Points are sorted by cell, so the candidates of each cell are a
+        contiguous slice given by the cell offsets. The grid is static, build
+        a new one after stations change.
+        -----------------------------------------------------------------------
+        Args:
+            ids: list of point ids
+            xs: list of x-coordinates
+            ys: list of y-coordinates
+            bucket: average number of points per cell of the bounding box"""
+        ids, xs, ys = np.asarray(ids), np.asarray(xs, dtype=np.float64), \
+                      np.asarray(ys, dtype=np.float64)
+        self.dtype = ids.dtype # data type of point ids
+        n = len(xs)
+        self.x0 = float(xs.min()) if n > 0 else 0.
+        self.y0 = float(ys.min()) if n > 0 else 0.
+        width = float(xs.max()) - self.x0 if n > 0 else 0.
+        height = float(ys.max()) - self.y0 if n > 0 else 0.
+        # square cells holding bucket points on average, or a single cell
+        area = width * height if width > 0 and height > 0 else \
+               max(width, height) ** 2
+        self.cell = math.sqrt(area * bucket / n) if n > 0 and area > 0 else 1.
+        self.nx = int(width // self.cell) + 1
+        self.ny = int(height // self.cell) + 1
+        # sort points by cell and store each cell's slice offsets
+        cells = self.__cells(xs, ys)
+        order = np.argsort(cells, kind='stable')
+        self.ids, self.xs, self.ys = ids[order], xs[order], ys[order]
+        self.offsets = np.zeros(self.nx * self.ny + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=self.nx * self.ny),
+                  out=self.offsets[1:])
+        self.__rings = {} # cell offsets of each ring around a cell
+
+    def __len__(self) -> int:
+        return len(self.xs)
+
+    @property
+    def nbytes(self) -> int:
+        """Total number of bytes used by the grid arrays."""
+        return self.ids.nbytes + self.xs.nbytes + self.ys.nbytes + \
+               self.offsets.nbytes
+
+    def __clip(self, xs: ndarray, ys: ndarray) -> Tuple[ndarray, ndarray]:
+        """Column and row of the cells containing some points, or of the
+        closest cells if they fall outside the grid."""
+        cx = np.clip((xs - self.x0) // self.cell, 0, self.nx - 1)
+        cy = np.clip((ys - self.y0) // self.cell, 0, self.ny - 1)
+
+        return cx.astype(np.int64), cy.astype(np.int64)
+
+    def __cells(self, xs: ndarray, ys: ndarray) -> ndarray:
+        """Flat indices of the cells containing some points."""
+        cx, cy = self.__clip(xs, ys)
+
+        return cy * self.nx + cx
+
+    def __ring(self, r: int) -> Tuple[ndarray, ndarray]:
+        """Column and row offsets of the cells at Chebyshev distance r."""
+        if r not in self.__rings:
+            d = np.arange(-r, r + 1)
+            dx, dy = np.meshgrid(d, d)
+            edge = np.maximum(np.abs(dx), np.abs(dy)) == r
+            self.__rings[r] = dx[edge], dy[edge]
+
+        return self.__rings[r]
+
+    def __bound(self, px: ndarray, py: ndarray, cx: ndarray, cy: ndarray,
+                r: int) -> ndarray:
+        """Lower bound of the distance from each query point to the points
+        outside the block of cells within ring r of its cell, infinite once
+        the block covers the whole grid."""
+        bound = np.full(px.shape, math.inf)
+        for lo, hi, p, origin, size in ((cx - r, cx + r, px, self.x0, self.nx),
+                                        (cy - r, cy + r, py, self.y0, self.ny)):
+            left = np.where(lo > 0, p - (origin + lo * self.cell), math.inf)
+            right = np.where(hi < size - 1,
+                             origin + (hi + 1) * self.cell - p, math.inf)
+            bound = np.minimum(bound, np.minimum(left, right))
+
+        return bound
+
+    def query(self, points: ndarray, k: int = 1) -> Tuple[ndarray, ndarray]:
+        """Batched k nearest neighbors search with the same semantics as
+        Tree.query: points at zero distance from a query are skipped, and
+        missing neighbors have infinite distance and id -1. Rings of cells
+        around each query's cell are scanned outwards until its k-th distance
+        is within the distance to the cells left, so sparse areas expand
+        further.
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords
+            k: number of nearest neighbors to find
+        Returns:
+            dists: (m, k)-shape array of ascending distances
+            ids: (m, k)-shape array of nearest neighbor ids"""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        m = points.shape[0]
+        dists = np.full((m, k), math.inf)
+        nbrs = np.full((m, k), -1, dtype=np.int64) # positions
+        qx, qy = points[:, 0], points[:, 1]
+        cx, cy = self.__clip(qx, qy)
+        active = np.arange(m) if len(self) > 0 else np.empty(0, dtype=np.int64)
+        r = 0
+        while active.shape[0] > 0:
+            # candidate slices of the ring cells of every active query
+            dx, dy = self.__ring(r)
+            ix, iy = cx[active, None] + dx, cy[active, None] + dy
+            inside = (ix >= 0) & (ix < self.nx) & (iy >= 0) & (iy < self.ny)
+            cell = np.where(inside, iy * self.nx + ix, 0)
+            starts = self.offsets[cell]
+            counts = np.where(inside, self.offsets[cell + 1] - starts, 0)
+            counts, starts = counts.ravel(), starts.ravel()
+            total = int(counts.sum())
+            if total > 0:
+                rows = np.repeat(np.repeat(active, dx.shape[0]), counts)
+                # position of each candidate, consecutive within a cell
+                begin = np.cumsum(counts) - counts
+                pos = np.repeat(starts - begin, counts) + np.arange(total)
+                d = np.hypot(self.xs[pos] - qx[rows], self.ys[pos] - qy[rows])
+                d[d == 0] = math.inf # skip zero distances
+                self.__merge(dists, nbrs, active, rows, d, pos)
+            # queries whose k-th distance cannot improve are done
+            bound = self.__bound(qx[active], qy[active], cx[active],
+                                 cy[active], r)
+            active = active[(dists[active, -1] > bound) & (bound < math.inf)]
+            r += 1
+
+        ids = np.full(nbrs.shape, -1, dtype=self.dtype)
+        found = nbrs >= 0
+        ids[found] = self.ids[nbrs[found]]
+
+        return dists, ids
+
+    def __merge(self, dists: ndarray, nbrs: ndarray, active: ndarray,
+                rows: ndarray, d: ndarray, pos: ndarray) -> None:
+        """Keeps the k smallest among current and candidate distances of the
+        active query rows. Ties keep current items first.
+        ------------------------------------------------------------------------
+        Args:
+            dists: (m, k)-shape array of k smallest distances so far
+            nbrs: (m, k)-shape array of k nearest neighbor positions so far
+            active: sorted query rows being searched
+            rows: query row of each candidate, within active
+            d: candidate distances
+            pos: candidate positions"""
+        k = dists.shape[1]
+        all_rows = np.concatenate([np.repeat(active, k), rows])
+        all_d = np.concatenate([dists[active].ravel(), d])
+        all_pos = np.concatenate([nbrs[active].ravel(), pos])
+        order = np.lexsort((all_d, all_rows)) # stable, by row then distance
+        sorted_rows = all_rows[order]
+        # every active row has k current items, the first k are the best
+        rank = np.arange(order.shape[0]) - \
+               np.searchsorted(sorted_rows, sorted_rows, side='left')
+        keep = order[rank < k]
+        dists[active] = all_d[keep].reshape(-1, k)
+        nbrs[active] = all_pos[keep].reshape(-1, k)
+
+    def nearest(self, point: List[float], k: int = 1) -> Tuple[ndarray, ndarray]:
+        """k nearest neighbors of a single query point, see query.
+        ------------------------------------------------------------------------
+        Args:
+            point: query coords
+            k: number of nearest neighbors to find
+        Returns:
+            dists: (k,)-shape array of ascending distances
+            ids: (k,)-shape array of nearest neighbor ids"""
+        dists, ids = self.query(np.asarray(point).reshape(1, 2), k)
+
+        return dists[0], ids[0]
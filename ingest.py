@@ -0,0 +1,216 @@
+# stdlib modules
+import math
+import time
+from typing import Any, Iterator, List, Set, Tuple
+
+# third-party modules
+import networkx as nx
+import numpy as np
+from numpy import ndarray
+
+# custom modules
+import graph
+from projection import Equirectangular, Projection
+import tree
+import utils
+
+
+class StationNetwork:
+    def __init__(
+            self,
+            stations: ndarray,
+            k: int = 3,
+            active: Set[str] = None,
+            leaf_size: int = 16):
+        """Constructor method. Builds the 2d-tree and the k-nearest neighbors
+        graph of a station snapshot, the same graph as graph.build_graph,
+        along with the neighbor lists needed to update them from later
+        snapshots.
+        -----------------------------------------------------------------------
+        Args:
+            stations: snapshot record array with id, x, y and status fields,
+                see utils.load_stations
+            k: number of nearest neighbors per station
+            active: statuses of stations kept in the network, all if None
+            leaf_size: maximum number of points in a tree leaf bucket"""
+        self.k, self.active = k, active
+        self.coords = self.__select(stations)
+        ids = list(self.coords)
+        xs = np.array([self.coords[u][0] for u in ids])
+        ys = np.array([self.coords[u][1] for u in ids])
+        self.T = tree.Tree(np.array(ids), xs, ys, leaf_size=leaf_size)
+        # nearest neighbors of each station and stations having it as one
+        self.knn, self.rknn = {}, {u: set() for u in ids}
+        self.radius = {} # distance to the k-th nearest neighbor
+        self.__set_knn(ids)
+        self.G = nx.Graph()
+        self.G.add_nodes_from((u, {'x': x, 'y': y})
+                              for u, (x, y) in self.coords.items())
+        self.G.add_weighted_edges_from((u, v, d) for u in ids
+                                       for v, d in self.knn[u].items())
+
+    def __len__(self) -> int:
+        return len(self.coords)
+
+    def __select(self, stations: ndarray) -> dict:
+        """Maps ids of the snapshot stations with an active status to their
+        coords."""
+        keep = np.ones(len(stations), dtype=bool) if self.active is None else \
+               np.isin(stations['status'], list(self.active))
+        ids = np.asarray(stations['id'])[keep].tolist()
+        xs = np.asarray(stations['x'])[keep].tolist()
+        ys = np.asarray(stations['y'])[keep].tolist()
+
+        return dict(zip(ids, zip(xs, ys)))
+
+    def __set_knn(self, ids: List[Any]) -> Set[Tuple[Any, Any]]:
+        """Queries the nearest neighbors of some stations and stores them.
+        ------------------------------------------------------------------------
+        Args:
+            ids: station ids
+        Returns:
+            dropped: (u, v) pairs no longer nearest neighbors"""
+        dropped = set()
+        if not ids:
+            return dropped
+        dists, nns = self.T.query(np.array([self.coords[u] for u in ids]),
+                                  k=self.k)
+        for u, row_nn, row_d in zip(ids, nns.tolist(), dists.tolist()):
+            new = {v: d for v, d in zip(row_nn, row_d) if d < math.inf}
+            for v in self.knn.get(u, {}):
+                if v not in new:
+                    dropped.add((u, v))
+                    if v in self.rknn: # v may have been removed
+                        self.rknn[v].discard(u)
+            for v in new:
+                self.rknn[v].add(u)
+            self.knn[u] = new
+            self.radius[u] = row_d[-1]
+
+        return dropped
+
+    def diff(self, stations: ndarray) -> Tuple[List[Any], List[Any], List[Any]]:
+        """Compares a snapshot with the current network by station id.
+        ------------------------------------------------------------------------
+        Args:
+            stations: snapshot record array, see utils.load_stations
+        Returns:
+            added: ids of stations missing from the network
+            removed: ids of stations missing from the snapshot
+            moved: ids of stations whose coords changed"""
+        coords = self.__select(stations)
+        added = [u for u in coords if u not in self.coords]
+        removed = [u for u in self.coords if u not in coords]
+        moved = [u for u in coords
+                 if u in self.coords and coords[u] != self.coords[u]]
+
+        return added, removed, moved
+
+    def update(self, stations: ndarray) -> dict:
+        """Applies the added, removed and moved stations of a snapshot to the
+        tree and the graph in place. Only stations that had a removed or
+        moved station among their nearest neighbors, or that a new position
+        falls within the k-th nearest neighbor distance of, get their nearest
+        neighbors queried again.
+        ------------------------------------------------------------------------
+        Args:
+            stations: snapshot record array, see utils.load_stations
+        Returns:
+            counts: numbers of added, removed, moved and requeried stations"""
+        coords = self.__select(stations)
+        added, removed, moved = self.diff(stations)
+        affected = set()
+        # take out removed stations and old positions of moved ones
+        for u in removed + moved:
+            self.T.remove(u)
+            self.G.remove_node(u)
+            affected |= self.rknn[u]
+            for v in self.knn.pop(u):
+                self.rknn[v].discard(u)
+            del self.coords[u]
+            del self.radius[u]
+        for u in removed:
+            del self.rknn[u]
+        # insert new positions
+        for u in added + moved:
+            self.coords[u] = coords[u]
+            self.T.insert(u, *coords[u])
+            self.G.add_node(u, x=coords[u][0], y=coords[u][1])
+            self.rknn.setdefault(u, set())
+        new = added + moved
+        if new:
+            # stations whose k-th nearest neighbor is farther than a new one
+            r = max(self.radius.values(), default=0.)
+            if r == math.inf: # stations with less than k neighbors
+                affected |= {u for u, d in self.radius.items() if d == math.inf}
+                r = max((d for d in self.radius.values() if d < math.inf),
+                        default=0.)
+            offsets, near = self.T.query_radius_batch(
+                np.array([coords[u] for u in new]), r)
+            for i, u in enumerate(new):
+                for v in near[offsets[i]:offsets[i+1]].tolist():
+                    if v in self.radius and \
+                       math.dist(coords[u], self.coords[v]) <= self.radius[v]:
+                        affected.add(v)
+        affected = (affected - set(removed)) | set(new)
+        affected = [u for u in self.coords if u in affected]
+
+        # drop edges no longer backed by any nearest neighbor relation
+        for u, v in self.__set_knn(affected):
+            if self.G.has_edge(u, v) and u not in self.knn.get(v, ()):
+                self.G.remove_edge(u, v)
+        self.G.add_weighted_edges_from((u, v, d) for u in affected
+                                       for v, d in self.knn[u].items())
+        graph.touch(self.G)
+
+        return {'added': len(added), 'removed': len(removed),
+                'moved': len(moved), 'requeried': len(affected)}
+
+def ingest_snapshots(
+        paths: List[str],
+        k: int = 3,
+        active: Set[str] = None,
+        compare: bool = True,
+        cache_dir: str = None,
+        leaf_size: int = 16,
+        projection: Projection = None) -> Iterator[dict]:
+    """Processes a history of snapshots, building the network from the first
+    one and updating it with each of the following ones. All of them share a
+    single projection, so coords of stations that did not move match across
+    snapshots.
+    ---------------------------------------------------------------------------
+    Args:
+        paths: snapshot file paths in chronological order
+        k: number of nearest neighbors per station
+        active: statuses of stations kept in the network, all if None
+        compare: whether to time a full rebuild of each snapshot as well
+        cache_dir: directory of snapshot sidecar files, None to disable them
+        leaf_size: maximum number of points in a tree leaf bucket
+        projection: projection of all the snapshots, an equirectangular one
+            centered at the first snapshot's middle point if None
+    Returns:
+        reports: iterator of dicts with the path, update counts, update time
+            and full rebuild time of each snapshot, the network last"""
+    net = None
+    for path in paths:
+        stations = utils.load_stations(path, cache_dir=cache_dir,
+                                       projection=projection)
+        if projection is None: # first snapshot is centered at its middle point
+            projection = Equirectangular.centered(stations['lat'],
+                                                  stations['lon'])
+        report = {'path': path}
+        start = time.perf_counter()
+        if net is None:
+            net = StationNetwork(stations, k=k, active=active,
+                                 leaf_size=leaf_size)
+            report.update(added=len(net), removed=0, moved=0,
+                          requeried=len(net))
+        else:
+            report.update(net.update(stations))
+        report['update'] = time.perf_counter() - start
+        if compare:
+            start = time.perf_counter()
+            StationNetwork(stations, k=k, active=active, leaf_size=leaf_size)
+            report['rebuild'] = time.perf_counter() - start
+        report['network'] = net
+        yield report
@@ -1,5 +1,6 @@
 # stdlib modules
 import argparse
+import os
 
 # third-party modules
 import networkx as nx
@@ -8,6 +9,7 @@ from matplotlib import pyplot as plt
 
 # local modules
 import graph
+import projection
 import tree
 import utils
 
@@ -15,9 +17,28 @@ import utils
 # configure arg parser
 parser = argparse.ArgumentParser()
 parser.add_argument('-fname', type=str, default='nomenclatura_2023_05.csv',
-                    help='CSV filename containing stations information')
+                    help='CSV or Parquet file containing stations information, '
+                         'looked up inside data folder if not found')
 parser.add_argument('-method', type=str, default='dijkstra',
-                    help='Method for shortest-path computation')
+                    help='Method for shortest-path computation: dijkstra, '
+                         'bidirectional, astar, bellman-ford, spfa or '
+                         'bellman-ford-numpy')
+parser.add_argument('-engine', type=str, default='networkx',
+                    choices=['networkx', 'csr', 'ch'],
+                    help='Graph representation used by shortest-path search, '
+                         'ch is a contraction hierarchy cached in cache folder')
+parser.add_argument('-projection', type=str, default='equirectangular',
+                    choices=['equirectangular', 'tangent', 'utm'],
+                    help='Map projection of station coords')
+parser.add_argument('-origin', type=str, default=None,
+                    help='JSON file keeping the projection and its origin, '
+                         'created from the stations middle point if missing')
+parser.add_argument('-metric', type=str, default='euclidean',
+                    choices=['euclidean', 'haversine'],
+                    help='Distance between stations used for graph edges')
+parser.add_argument('-plot', action='store_true',
+                    help='Draw stations, tree, graph and path figures into out '
+                         'folder and show the path')
 # parse args
 args = parser.parse_args()
 
@@ -25,48 +46,81 @@ args = parser.parse_args()
 
 K=3
 # compute and plot (x, y) positions
-positions = utils.load_ecobici(args.fname) # load station xy coords
-fig, ax = plt.subplots(figsize=(6,6))
-plt.tight_layout()
-ax = utils.plot_positions(ax, positions['x'], positions['y'])
-plt.savefig("out/locations.png")
+fname = args.fname if os.path.exists(args.fname) else \
+        os.path.join('data', args.fname)
+if args.origin is not None and os.path.exists(args.origin):
+    P = projection.Projection.load(args.origin) # fixed origin
+else:
+    P = utils.load_projection(fname, args.projection) # cached middle point
+    if args.origin is not None:
+        P.save(args.origin)
+positions = utils.load_stations(fname, projection=P) # load station xy coords
+if args.plot:
+    fig, ax = plt.subplots(figsize=(6,6))
+    plt.tight_layout()
+    ax = utils.plot_positions(ax, positions['x'], positions['y'])
+    plt.savefig("out/locations.png")
 
 # build tree and draw it
 T = tree.Tree(positions['id'], positions['x'], positions['y'])
-fig, ax = plt.subplots(figsize=(6,6))
-plt.tight_layout()
-ax = utils.plot_positions(ax, positions['x'], positions['y'])
-ax = utils.draw_tree(ax, T)
-plt.savefig("out/2d-tree.png")
+if args.plot:
+    fig, ax = plt.subplots(figsize=(6,6))
+    plt.tight_layout()
+    ax = utils.plot_positions(ax, positions['x'], positions['y'])
+    ax = utils.draw_tree(ax, T)
+    plt.savefig("out/2d-tree.png")
 
 # build graph and plot it
-G = graph.build_graph(positions['id'], positions['x'], positions['y'], k=K)
+index = utils.load_index(positions, fname, projection=P) # cached flat tree
+G = graph.build_graph(positions['id'], positions['x'], positions['y'], k=K,
+                      T=index, projection=P if args.metric == 'haversine'
+                                              else None)
 glocs = {node_id: (x, y) for node_id, x, y in zip(positions['id'],
                                                   positions['x'],
                                                   positions['y'])}
-fig, ax = plt.subplots(figsize=(6,6))
-plt.tight_layout()
-nx.draw(G, pos=glocs, ax=ax, node_size=25, node_color='green')
-plt.savefig("out/graph.png")
+if args.plot:
+    fig, ax = plt.subplots(figsize=(6,6))
+    plt.tight_layout()
+    nx.draw(G, pos=glocs, ax=ax, node_size=25, node_color='green')
+    plt.savefig("out/graph.png")
+if args.engine == 'ch': # preprocess station graph, or load it from cache
+    H = graph.hierarchy_cached(G, fname, K, extra=(P, args.metric))
 
 # create two random points
 points = np.random.uniform(-6, 7, size=(2, 2))
 p, q = tuple(map(tuple, points))
 glocs['p'] = (p)
 glocs['q'] = (q)
-# connect them to the graph
-G = graph.connect_query_points(G, T, ['p', 'q'], p, q, k=K)
+# connect them to the graph, with great-circle weights like the stations
+geodesic = dict(projection=P, stations=(positions['id'], positions['x'],
+                                        positions['y'])) \
+           if args.metric == 'haversine' else {}
+G = graph.connect_query_points(G, T, ['p', 'q'], p, q, k=K, **geodesic)
 # draw graph
-colors = ['blue' if node == 'p' or node == 'q' else 'green' for node in G.nodes()]
-fig, ax = plt.subplots(figsize=(6,6))
-plt.tight_layout()
-nx.draw(G, pos=glocs, ax=ax, node_size=25, node_color=colors)
+if args.plot:
+    colors = ['blue' if node == 'p' or node == 'q' else 'green'
+              for node in G.nodes()]
+    fig, ax = plt.subplots(figsize=(6,6))
+    plt.tight_layout()
+    nx.draw(G, pos=glocs, ax=ax, node_size=25, node_color=colors)
 
 # find shortest path between query nodes
-G, path = graph.path_plan(id_p='p', id_q='q', G=G, method=args.method)
-path_edges = list(zip(path[:-1], path[1:]))
-colors = ['blue' if node == 'p' or node == 'q' else 'red' for node in path]
-nx.draw_networkx_nodes(G, glocs, nodelist=path, node_color=colors, node_size=25)
-nx.draw_networkx_edges(G, glocs, edgelist=path_edges, edge_color='r', width=1)
-plt.savefig("out/path.png")
-plt.show()
+overlay = None
+if args.engine == 'csr':
+    H = graph.CSRGraph(G)
+elif args.engine == 'ch': # hierarchy only knows stations, attach query points
+    overlay = graph.attach_query_points(T, ['p', 'q'], p, q, k=K, **geodesic)
+else:
+    H = G
+_, path = graph.path_plan(id_p='p', id_q='q', G=H, method=args.method,
+                          overlay=overlay)
+print(' -> '.join(map(str, path)))
+if args.plot:
+    path_edges = list(zip(path[:-1], path[1:]))
+    colors = ['blue' if node == 'p' or node == 'q' else 'red' for node in path]
+    nx.draw_networkx_nodes(G, glocs, nodelist=path, node_color=colors,
+                           node_size=25)
+    nx.draw_networkx_edges(G, glocs, edgelist=path_edges, edge_color='r',
+                           width=1)
+    plt.savefig("out/path.png")
+    plt.show()
@@ -0,0 +1,129 @@
+# stdlib modules
+from collections import Counter, defaultdict
+import json
+import threading
+import time
+from typing import Dict
+
+# third-party modules
+import numpy as np
+
+
+# whether every instrumented call is recorded, see enable
+enabled = False
+
+class Probe(Counter):
+    def __init__(self):
+        """Constructor method. Counters of a single instrumented call, timed
+        from its creation. Missing counters read as zero, so hot loops can
+        increment them directly."""
+        super().__init__()
+        self.start = time.perf_counter()
+
+class Recorder:
+    def __init__(self):
+        """Constructor method. Collects the counters of instrumented calls by
+        call name, to summarize them as histograms. Safe to share among
+        threads, but each worker process has its own."""
+        self.__samples = defaultdict(lambda: defaultdict(list))
+        self.__calls = Counter()
+        self.__lock = threading.Lock()
+
+    def add(self, name: str, counters: dict) -> None:
+        """Stores the counters of one call of name. Counters missing from
+        some calls are only summarized over the calls having them."""
+        with self.__lock:
+            self.__calls[name] += 1
+            for key, value in counters.items():
+                self.__samples[name][key].append(value)
+
+    def clear(self) -> None:
+        """Drops all the recorded calls."""
+        with self.__lock:
+            self.__samples.clear()
+            self.__calls.clear()
+
+    def calls(self) -> Dict[str, int]:
+        """Number of recorded calls of each name."""
+        with self.__lock:
+            return dict(self.__calls)
+
+    def samples(self, name: str, key: str) -> np.ndarray:
+        """Recorded values of counter key across the calls of name."""
+        with self.__lock:
+            return np.array(self.__samples[name][key]) \
+                   if key in self.__samples.get(name, {}) else np.empty(0)
+
+    def histograms(self, bins: int = 20) -> dict:
+        """Summarizes every recorded counter.
+        ------------------------------------------------------------------------
+        Args:
+            bins: number of equal-width histogram bins
+        Returns:
+            summary: dict mapping call names to dicts mapping counter names
+                to their number of calls, total, mean, p50, p99 and max along
+                with histogram bin counts and edges"""
+        with self.__lock:
+            samples = {name: {key: np.array(values)
+                              for key, values in counters.items()}
+                       for name, counters in self.__samples.items()}
+        summary = {}
+        for name, counters in samples.items():
+            summary[name] = {}
+            for key, values in counters.items():
+                counts, edges = np.histogram(values, bins=bins)
+                summary[name][key] = {
+                    'calls': int(values.shape[0]),
+                    'total': float(values.sum()),
+                    'mean': float(values.mean()),
+                    'p50': float(np.percentile(values, 50)),
+                    'p99': float(np.percentile(values, 99)),
+                    'max': float(values.max()),
+                    'counts': counts.tolist(),
+                    'edges': edges.tolist()}
+
+        return summary
+
+    def export(self, fname: str, bins: int = 20) -> None:
+        """Writes the histograms of every recorded counter to a JSON file."""
+        with open(fname, 'w') as f:
+            json.dump(self.histograms(bins), f, indent=1)
+
+# recorder of every instrumented call while metrics are enabled
+recorder = Recorder()
+
+def enable(flag: bool = True) -> None:
+    """Turns recording of every instrumented call on or off. Calls are still
+    instrumented when disabled if their caller asks for per-call stats."""
+    global enabled
+    enabled = flag
+
+def probe(stats: dict = None) -> Probe:
+    """Starts the counters of an instrumented call.
+    ---------------------------------------------------------------------------
+    Args:
+        stats: dict the caller asked to get this call's counters added to,
+            None if it did not ask for them
+    Returns:
+        probe: counters of the call, None if there is nobody to report them
+            to, in which case the call skips its instrumentation"""
+    if stats is None and not enabled:
+        return None
+
+    return Probe()
+
+def report(name: str, probe: Probe, stats: dict = None) -> None:
+    """Ends an instrumented call. Its wall time is stored under 'seconds', its
+    counters are added to the caller's stats and recorded if metrics are
+    enabled.
+    ---------------------------------------------------------------------------
+    Args:
+        name: call name, e.g. 'dijkstra'
+        probe: counters of the call, see probe
+        stats: dict the caller asked to get the counters added to, or None"""
+    probe['seconds'] = time.perf_counter() - probe.start
+    if stats is not None:
+        for key, value in probe.items():
+            stats[key] = stats.get(key, 0) + value
+    if enabled:
+        recorder.add(name, probe)
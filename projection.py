@@ -0,0 +1,301 @@
+# stdlib modules
+import abc
+import json
+import math
+from typing import Any, Tuple
+
+# third-party modules
+import numpy as np
+from numpy import ndarray
+
+R = 6371.0 # earth's mean radius in kilometers
+# WGS84 ellipsoid, in kilometers
+A = 6378.137 # semi-major axis
+F = 1 / 298.257223563 # flattening
+E2 = F * (2 - F) # first eccentricity squared
+
+
+def haversine(
+        lat1: ndarray,
+        lon1: ndarray,
+        lat2: ndarray,
+        lon2: ndarray) -> ndarray:
+    """Great-circle distances in kilometers between arrays of points given
+    in degrees, over a sphere of radius R.
+    ---------------------------------------------------------------------------
+    Args:
+        lat1, lon1: first points latitudes and longitudes
+        lat2, lon2: second points latitudes and longitudes
+    Returns:
+        dists: distances between first and second points"""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 \
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+
+    return 2 * R * np.arcsin(np.sqrt(np.minimum(a, 1.)))
+
+class Projection(abc.ABC):
+    """Maps latitudes and longitudes in degrees into planar (x, y) coords in
+    kilometers around a fixed origin. The origin is part of the projection,
+    so coords of different snapshots projected with the same one match and
+    can be indexed together."""
+    kind = None
+    # bound of planar over great-circle distance ratios for points within
+    # about 50 km of the origin, below 60 degrees of latitude
+    distortion = 1.01
+
+    def __init__(self, origin: Tuple[float, float]):
+        """Constructor method.
+        -----------------------------------------------------------------------
+        Args:
+            origin: (lat, lon) of the point mapped to (0, 0)"""
+        self.origin = (float(origin[0]), float(origin[1]))
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}(origin={self.origin})'
+
+    def __eq__(self, other: Any) -> bool:
+        return type(self) is type(other) and self.origin == other.origin
+
+    @classmethod
+    def centered(cls, lat: ndarray, lon: ndarray) -> 'Projection':
+        """Projection whose origin is the middle point of some points."""
+        return cls((np.average(lat), np.average(lon)))
+
+    @abc.abstractmethod
+    def forward(self, lat: ndarray, lon: ndarray) -> Tuple[ndarray, ndarray]:
+        """Projects arrays of latitudes and longitudes into (x, y) coords."""
+
+    @abc.abstractmethod
+    def inverse(self, xs: ndarray, ys: ndarray) -> Tuple[ndarray, ndarray]:
+        """Maps arrays of (x, y) coords back into latitudes and longitudes."""
+
+    def haversine(
+            self,
+            x1: ndarray,
+            y1: ndarray,
+            x2: ndarray,
+            y2: ndarray) -> ndarray:
+        """Great-circle distances between arrays of projected points."""
+        return haversine(*self.inverse(x1, y1), *self.inverse(x2, y2))
+
+    def save(self, fname: str) -> None:
+        """Stores projection kind and origin in a JSON file.
+        ------------------------------------------------------------------------
+        Args:
+            fname: output filename"""
+        with open(fname, 'w') as f:
+            json.dump({'kind': self.kind, 'origin': self.origin}, f)
+
+    @staticmethod
+    def load(fname: str) -> 'Projection':
+        """Loads a projection previously stored with save method.
+        ------------------------------------------------------------------------
+        Args:
+            fname: input filename
+        Returns:
+            projection: loaded projection"""
+        with open(fname) as f:
+            data = json.load(f)
+
+        return PROJECTIONS[data['kind']](data['origin'])
+
+class Equirectangular(Projection):
+    """Equirectangular approximation over a sphere of radius R, the mapping
+    used by utils.to_global. Accurate at city scale."""
+    kind = 'equirectangular'
+    distortion = 1.02
+
+    def forward(self, lat: ndarray, lon: ndarray) -> Tuple[ndarray, ndarray]:
+        lat0, lon0 = self.origin
+        dlon = np.pi * (np.asarray(lon) - lon0) / 180.0
+        dlat = np.pi * (np.asarray(lat) - lat0) / 180.0
+
+        return R * dlon * np.cos(np.pi * lat0 / 180.0), R * dlat
+
+    def inverse(self, xs: ndarray, ys: ndarray) -> Tuple[ndarray, ndarray]:
+        lat0, lon0 = self.origin
+        lat = lat0 + 180.0 * np.asarray(ys) / (np.pi * R)
+        lon = lon0 + 180.0 * np.asarray(xs) / (np.pi * R
+                                              * np.cos(np.pi * lat0 / 180.0))
+
+        return lat, lon
+
+def _to_ecef(lat: ndarray, lon: ndarray) -> Tuple[ndarray, ndarray, ndarray]:
+    """Earth-centered, earth-fixed coords in kilometers of points over the
+    WGS84 ellipsoid."""
+    lat, lon = np.radians(lat), np.radians(lon)
+    n = A / np.sqrt(1 - E2 * np.sin(lat) ** 2) # prime vertical radius
+
+    return (n * np.cos(lat) * np.cos(lon), n * np.cos(lat) * np.sin(lon),
+            n * (1 - E2) * np.sin(lat))
+
+class LocalTangentPlane(Projection):
+    """East and north coords over the plane tangent to the WGS84 ellipsoid at
+    the origin."""
+    kind = 'tangent'
+    distortion = 1.006
+
+    def forward(self, lat: ndarray, lon: ndarray) -> Tuple[ndarray, ndarray]:
+        lat0, lon0 = np.radians(self.origin)
+        x0, y0, z0 = _to_ecef(*self.origin)
+        x, y, z = _to_ecef(np.asarray(lat), np.asarray(lon))
+        dx, dy, dz = x - x0, y - y0, z - z0
+        east = -np.sin(lon0) * dx + np.cos(lon0) * dy
+        north = -np.sin(lat0) * np.cos(lon0) * dx \
+                - np.sin(lat0) * np.sin(lon0) * dy + np.cos(lat0) * dz
+
+        return east, north
+
+    def inverse(self, xs: ndarray, ys: ndarray) -> Tuple[ndarray, ndarray]:
+        # fixed point iterations scaled by local curvature radii
+        xs, ys = np.asarray(xs, dtype=np.float64), np.asarray(ys, np.float64)
+        lat = np.full(xs.shape, self.origin[0])
+        lon = np.full(xs.shape, self.origin[1])
+        for _ in range(8):
+            east, north = self.forward(lat, lon)
+            phi = np.radians(lat)
+            w = 1 - E2 * np.sin(phi) ** 2
+            rn = A / np.sqrt(w) # prime vertical radius
+            rm = A * (1 - E2) / w ** 1.5 # meridional radius
+            lat = lat + np.degrees((ys - north) / rm)
+            lon = lon + np.degrees((xs - east) / (rn * np.cos(phi)))
+
+        return lat, lon
+
+class UTM(Projection):
+    """Universal Transverse Mercator projection over the WGS84 ellipsoid, in
+    the zone of the origin, shifted so that the origin maps to (0, 0)."""
+    kind = 'utm'
+    distortion = 1.006
+    k0 = 0.9996 # central meridian scale factor
+
+    def __init__(self, origin: Tuple[float, float]):
+        super().__init__(origin)
+        self.zone = int((self.origin[1] + 180) // 6) + 1
+        self.lon0 = (self.zone - 1) * 6 - 180 + 3 # central meridian
+        self.__offset = (0., 0.)
+        self.__offset = self.forward(*self.origin)
+
+    @staticmethod
+    def __meridian(phi: ndarray) -> ndarray:
+        """Meridian arc length from the equator to latitude phi in radians."""
+        e4, e6 = E2 ** 2, E2 ** 3
+        return A * ((1 - E2 / 4 - 3 * e4 / 64 - 5 * e6 / 256) * phi
+                    - (3 * E2 / 8 + 3 * e4 / 32 + 45 * e6 / 1024)
+                    * np.sin(2 * phi)
+                    + (15 * e4 / 256 + 45 * e6 / 1024) * np.sin(4 * phi)
+                    - (35 * e6 / 3072) * np.sin(6 * phi))
+
+    def forward(self, lat: ndarray, lon: ndarray) -> Tuple[ndarray, ndarray]:
+        ep2 = E2 / (1 - E2)
+        phi = np.radians(np.asarray(lat, dtype=np.float64))
+        n = A / np.sqrt(1 - E2 * np.sin(phi) ** 2)
+        t, c = np.tan(phi) ** 2, ep2 * np.cos(phi) ** 2
+        a = np.cos(phi) * np.radians(np.asarray(lon) - self.lon0)
+        x = self.k0 * n * (a + (1 - t + c) * a ** 3 / 6
+                           + (5 - 18 * t + t ** 2 + 72 * c - 58 * ep2)
+                           * a ** 5 / 120)
+        y = self.k0 * (self.__meridian(phi) + n * np.tan(phi)
+                       * (a ** 2 / 2 + (5 - t + 9 * c + 4 * c ** 2) * a ** 4 / 24
+                          + (61 - 58 * t + t ** 2 + 600 * c - 330 * ep2)
+                          * a ** 6 / 720))
+
+        return x - self.__offset[0], y - self.__offset[1]
+
+    def inverse(self, xs: ndarray, ys: ndarray) -> Tuple[ndarray, ndarray]:
+        ep2 = E2 / (1 - E2)
+        x = np.asarray(xs, dtype=np.float64) + self.__offset[0]
+        y = np.asarray(ys, dtype=np.float64) + self.__offset[1]
+        # footpoint latitude
+        mu = y / self.k0 / (A * (1 - E2 / 4 - 3 * E2 ** 2 / 64
+                                 - 5 * E2 ** 3 / 256))
+        e1 = (1 - math.sqrt(1 - E2)) / (1 + math.sqrt(1 - E2))
+        phi1 = mu + (3 * e1 / 2 - 27 * e1 ** 3 / 32) * np.sin(2 * mu) \
+               + (21 * e1 ** 2 / 16 - 55 * e1 ** 4 / 32) * np.sin(4 * mu) \
+               + (151 * e1 ** 3 / 96) * np.sin(6 * mu) \
+               + (1097 * e1 ** 4 / 512) * np.sin(8 * mu)
+        w = 1 - E2 * np.sin(phi1) ** 2
+        n1, r1 = A / np.sqrt(w), A * (1 - E2) / w ** 1.5
+        t1, c1 = np.tan(phi1) ** 2, ep2 * np.cos(phi1) ** 2
+        d = x / (n1 * self.k0)
+        lat = phi1 - (n1 * np.tan(phi1) / r1) \
+              * (d ** 2 / 2 - (5 + 3 * t1 + 10 * c1 - 4 * c1 ** 2 - 9 * ep2)
+                 * d ** 4 / 24
+                 + (61 + 90 * t1 + 298 * c1 + 45 * t1 ** 2 - 252 * ep2
+                    - 3 * c1 ** 2) * d ** 6 / 720)
+        lon = (d - (1 + 2 * t1 + c1) * d ** 3 / 6
+               + (5 - 2 * c1 + 28 * t1 - 3 * c1 ** 2 + 8 * ep2 + 24 * t1 ** 2)
+               * d ** 5 / 120) / np.cos(phi1)
+
+        return np.degrees(lat), self.lon0 + np.degrees(lon)
+
+# projections by kind
+PROJECTIONS = {cls.kind: cls for cls in (Equirectangular, LocalTangentPlane,
+                                         UTM)}
+
+def geodesic_query(
+        T: Any,
+        projection: Projection,
+        points: ndarray,
+        k: int,
+        xs: ndarray,
+        ys: ndarray,
+        index: dict,
+        oversample: int = 2,
+        distortion: float = None) -> Tuple[ndarray, ndarray]:
+    """k nearest neighbors by great-circle distance. Candidates are the
+    k * oversample nearest ones in the projected plane, ranked again by
+    haversine distance. Points left out are at least as far in the plane as
+    the farthest candidate, so at least that distance over the distortion
+    factor along great circles. Queries whose k-th great-circle distance is
+    beyond that bound get twice as many candidates until it is covered.
+    Results are exact as long as planar distances never exceed great-circle
+    ones times the distortion factor, see Projection.distortion, and may
+    miss some neighbors otherwise.
+    ---------------------------------------------------------------------------
+    Args:
+        T: spatial index over projected coords, either a Tree or a FlatTree
+        projection: projection of the indexed coords
+        points: (m, 2)-shape array of projected query coords
+        k: number of nearest neighbors to find
+        xs, ys: projected coords of the indexed points
+        index: map from indexed point ids to their positions in xs, ys
+        oversample: number of planar candidates per neighbor at first
+        distortion: bound of planar over great-circle distance ratios, the
+            projection's if None
+    Returns:
+        dists: (m, k)-shape array of ascending great-circle distances
+        ids: (m, k)-shape array of nearest neighbor ids, -1 if missing"""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    distortion = projection.distortion if distortion is None else distortion
+    xs, ys = np.asarray(xs), np.asarray(ys)
+    m = points.shape[0]
+    dists = np.full((m, k), np.inf)
+    ids = None
+    rows, width = np.arange(m), k * oversample
+    while rows.shape[0] > 0:
+        planar, cand = T.query(points[rows], k=width)
+        if ids is None:
+            ids = np.full((m, k), -1, dtype=cand.dtype)
+        pos = np.array([[index.get(u, -1) for u in row]
+                        for row in cand.tolist()],
+                       dtype=np.int64).reshape(cand.shape)
+        valid = pos >= 0
+        px, py = xs[pos], ys[pos]
+        d = projection.haversine(points[rows, :1], points[rows, 1:], px, py)
+        d = np.where(valid, d, np.inf)
+        order = np.argsort(d, axis=1, kind='stable')[:, :k]
+        d = np.take_along_axis(d, order, axis=1)
+        dists[rows] = d
+        ids[rows] = np.where(np.isfinite(d),
+                             np.take_along_axis(cand, order, axis=1), -1)
+        # candidates ran out, or the rest are farther than the k-th one
+        covered = ~np.isfinite(planar[:, -1]) | \
+                  (d[:, -1] * distortion <= planar[:, -1])
+        rows, width = rows[~covered], width * 2
+
+    if ids is None: # no queries
+        ids = np.full((m, k), -1, dtype=np.int64)
+
+    return dists, ids
@@ -0,0 +1,315 @@
+# stdlib modules
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from typing import Any, List, Tuple
+
+# third-party modules
+from networkx import Graph
+import numpy as np
+from numpy import ndarray
+
+# local modules
+import graph
+from projection import Projection, PROJECTIONS
+import utils
+
+
+# reason phrases of the status codes sent
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           422: 'Unprocessable Entity'}
+
+class SnapBatcher:
+    def __init__(self, T: Any, window: float = 0.002, max_batch: int = 256):
+        """Constructor method. Collects the nearest stations queries arriving
+        within a short window and answers all of them with a single batched
+        tree query. A batch is flushed once its window elapses or it reaches
+        max_batch queries. Must be used from a single event loop.
+        -----------------------------------------------------------------------
+        Args:
+            T: spatial index over the stations, either a Tree or a FlatTree
+            window: seconds a batch waits for more queries, 0 to query each
+                point on its own
+            max_batch: maximum number of queries per batch"""
+        self.T, self.window, self.max_batch = T, window, max_batch
+        self.batches = self.queries = 0
+        self.__pending = [] # (point, k, future) of the open batch
+        self.__timer = None
+
+    async def snap(self, point: List[float], k: int) -> Tuple[ndarray, ndarray]:
+        """Finds the k nearest stations of a point along with the other queries
+        of its batch.
+        ------------------------------------------------------------------------
+        Args:
+            point: query coords
+            k: number of nearest stations to find
+        Returns:
+            dists: (k,)-shape array of ascending distances
+            ids: (k,)-shape array of station ids, -1 if missing"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.__pending.append((point, k, future))
+        if self.window <= 0 or len(self.__pending) >= self.max_batch:
+            self.__flush()
+        elif self.__timer is None: # first query opens the batch
+            self.__timer = loop.call_later(self.window, self.__flush)
+
+        return await future
+
+    def __flush(self) -> None:
+        """Queries the open batch and resolves its futures."""
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        pending, self.__pending = self.__pending, []
+        if not pending:
+            return
+        k = max(item[1] for item in pending)
+        try:
+            dists, ids = self.T.query(np.array([p for p, _, _ in pending]), k=k)
+        except Exception as e:
+            for _, _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        self.queries += len(pending)
+        for i, (_, k, future) in enumerate(pending):
+            if not future.done(): # skip requests cancelled meanwhile
+                future.set_result((dists[i, :k], ids[i, :k]))
+
+class RouteService:
+    def __init__(
+            self,
+            G: Graph,
+            T: Any,
+            k: int = 3,
+            method: str = 'dijkstra',
+            engine: Any = None,
+            projection: Projection = None,
+            window: float = 0.002,
+            max_batch: int = 256,
+            workers: int = 4):
+        """Constructor method. Answers route and nearest stations requests
+        concurrently over a graph and tree loaded once. Query points are
+        attached through per-request overlays, so the shared graph is never
+        modified, and searches run in a thread pool off the event loop.
+        -----------------------------------------------------------------------
+        Args:
+            G: station graph
+            T: spatial index over the graph stations
+            k: number of nearest stations to connect query points to
+            method: shortest-path method, see graph.path_plan
+            engine: graph searched by path_plan, its compiled CSRGraph if None
+            projection: projection of the station coords, requests then give
+                (lat, lon) points, or None if they give projected coords
+            window: snap batching window in seconds, see SnapBatcher
+            max_batch: maximum number of snap queries per batch
+            workers: number of threads running shortest-path searches"""
+        self.G, self.k, self.method = G, k, method
+        self.engine = graph.CSRGraph(G) if engine is None else engine
+        self.projection = projection
+        self.batcher = SnapBatcher(T, window, max_batch)
+        self.requests = 0
+        self.port = None # bound by serve
+        self.__executor = ThreadPoolExecutor(max_workers=workers)
+
+    def __point(self, value: Any) -> Tuple[float, float]:
+        """Projected coords of a request point, ValueError if malformed."""
+        a, b = (float(c) for c in value)
+        if self.projection is None:
+            return a, b
+        x, y = self.projection.forward(np.array([a]), np.array([b]))
+
+        return float(x[0]), float(y[0])
+
+    def __k(self, value: Any) -> int:
+        """Number of nearest stations of a request, ValueError unless it is
+        an integer between 1 and the number of stations."""
+        n = self.G.number_of_nodes()
+        if isinstance(value, bool) or not isinstance(value, int) or \
+           not 1 <= value <= n:
+            raise ValueError(f'k must be an integer between 1 and {n}, got '
+                             f'{value!r}')
+
+        return value
+
+    async def nearest(self, point: Any, k: int = None) -> dict:
+        """Nearest stations of a request point. k is checked before joining a
+        batch, whose query is sized by its largest k."""
+        dists, ids = await self.batcher.snap(self.__point(point),
+                                             self.__k(self.k if k is None
+                                                      else k))
+        found = dists < np.inf
+
+        return {'ids': ids[found].tolist(), 'dists': dists[found].tolist()}
+
+    async def route(self, p: Any, q: Any) -> dict:
+        """Shortest path between two request points through their nearest
+        stations, and its length with the weights of the searched engine.
+        Raises RuntimeError if there is none."""
+        p, q = self.__point(p), self.__point(q)
+        (dist_p, near_p), (dist_q, near_q) = await asyncio.gather(
+            self.batcher.snap(p, self.k), self.batcher.snap(q, self.k))
+        overlay = graph.overlay_from_neighbors(['p', 'q'], (p, q),
+                                               (dist_p, dist_q),
+                                               (near_p, near_q))
+        loop = asyncio.get_running_loop()
+        _, path = await loop.run_in_executor(
+            self.__executor, graph.path_plan, 'p', 'q', self.engine,
+            self.method, overlay)
+        length = graph.path_length(self.engine, path, overlay)
+        stations = [u.item() if hasattr(u, 'item') else u for u in path[1:-1]]
+
+        return {'stations': stations, 'length': length}
+
+    async def dispatch(self, method: str, target: str,
+                       body: bytes) -> Tuple[int, dict]:
+        """Answers a request.
+        ------------------------------------------------------------------------
+        Args:
+            method: HTTP method
+            target: request path
+            body: request body, a JSON object for POST requests
+        Returns:
+            status: HTTP status code
+            payload: JSON response object"""
+        if method == 'GET' and target == '/health':
+            return 200, {'stations': len(self.engine), 'requests': self.requests,
+                         'batches': self.batcher.batches,
+                         'snaps': self.batcher.queries}
+        if method != 'POST' or target not in ('/route', '/nearest'):
+            return 404, {'error': f'Unknown endpoint {method} {target}'}
+        try:
+            request = json.loads(body)
+            if target == '/route':
+                call = self.route(request['p'], request['q'])
+            else:
+                call = self.nearest(request['point'], request.get('k'))
+        except (ValueError, KeyError, TypeError) as e:
+            return 400, {'error': f'Malformed request: {e!r}'}
+        try:
+            return 200, await call
+        except (ValueError, TypeError) as e:
+            return 400, {'error': f'Malformed request: {e!r}'}
+        except RuntimeError as e: # no path
+            return 422, {'error': str(e)}
+
+    async def handle(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> None:
+        """Serves the HTTP/1.1 requests of a connection, keeping it open
+        between requests unless the client asks to close it."""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, target, version = line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(
+                    int(headers.get('content-length', 0)))
+                self.requests += 1
+                status, payload = await self.dispatch(method, target, body)
+                data = json.dumps(payload).encode()
+                keep = version == 'HTTP/1.1' and \
+                       headers.get('connection', '').lower() != 'close'
+                writer.write(
+                    f'HTTP/1.1 {status} {REASONS[status]}\r\n'
+                    f'Content-Type: application/json\r\n'
+                    f'Content-Length: {len(data)}\r\n'
+                    f'Connection: {"keep-alive" if keep else "close"}\r\n'
+                    f'\r\n'.encode('latin-1') + data)
+                await writer.drain()
+                if not keep:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass # client went away or sent garbage
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 8000,
+                    ready: asyncio.Event = None) -> None:
+        """Serves requests until cancelled.
+        ------------------------------------------------------------------------
+        Args:
+            host: interface to listen on
+            port: TCP port, 0 for any free one
+            ready: event set once listening, with the bound port stored in
+                self.port"""
+        server = await asyncio.start_server(self.handle, host, port)
+        self.port = server.sockets[0].getsockname()[1]
+        if ready is not None:
+            ready.set()
+        async with server:
+            await server.serve_forever()
+
+def load_service(
+        fname: str,
+        k: int = 3,
+        method: str = 'dijkstra',
+        projection: str = 'equirectangular',
+        origin: str = None,
+        **kwargs) -> RouteService:
+    """Builds a service over a stations snapshot, reusing cached projection,
+    station and index sidecars, so warm starts never parse the snapshot.
+    ---------------------------------------------------------------------------
+    Args:
+        fname: CSV or Parquet stations file
+        k: number of nearest neighbors per station and query point
+        method: shortest-path method, see graph.path_plan
+        projection: map projection name, see projection.PROJECTIONS
+        origin: JSON file of a fixed projection, see Projection.save, or
+            None for the cached one centered at the stations
+        kwargs: other RouteService arguments
+    Returns:
+        service: route service answering (lat, lon) points"""
+    P = Projection.load(origin) if origin is not None else \
+        utils.load_projection(fname, projection)
+    stations = utils.load_stations(fname, projection=P)
+    T = utils.load_index(stations, fname, projection=P)
+    G = graph.build_graph(stations['id'], stations['x'], stations['y'], k=k,
+                          T=T)
+
+    return RouteService(G, T, k=k, method=method, projection=P, **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-fname', type=str, default='nomenclatura_2023_05.csv',
+                        help='CSV or Parquet file containing stations '
+                             'information, looked up inside data folder if '
+                             'not found')
+    parser.add_argument('-method', type=str, default='dijkstra',
+                        help='Method for shortest-path computation')
+    parser.add_argument('-projection', type=str, default='equirectangular',
+                        choices=list(PROJECTIONS),
+                        help='Map projection of station coords')
+    parser.add_argument('-origin', type=str, default=None,
+                        help='JSON file keeping a fixed projection, see '
+                             'main.py -origin')
+    parser.add_argument('-host', type=str, default='127.0.0.1',
+                        help='Interface to listen on')
+    parser.add_argument('-port', type=int, default=8000,
+                        help='TCP port to listen on')
+    parser.add_argument('-window', type=float, default=0.002,
+                        help='Seconds snap queries wait to be batched')
+    parser.add_argument('-workers', type=int, default=4,
+                        help='Number of shortest-path search threads')
+    args = parser.parse_args()
+
+    fname = args.fname if os.path.exists(args.fname) else \
+            os.path.join('data', args.fname)
+    service = load_service(fname, method=args.method,
+                           projection=args.projection, origin=args.origin,
+                           window=args.window, workers=args.workers)
+    print(f'Serving {len(service.engine)} stations on '
+          f'http://{args.host}:{args.port}')
+    asyncio.run(service.serve(args.host, args.port))
@@ -1,10 +1,235 @@
 # stdlib modules
 from collections import deque
 import math
-from typing import List, Tuple
+from typing import Callable, List, Tuple
 
 # third-party modules
 import numpy as np
+from numpy import ndarray
+
+# custom modules
+import metrics
+
+
+def _split_rule(xs: ndarray, ys: ndarray, idx: ndarray) -> bool:
+    """Variance splitting rule. Split along the axis with highest variance.
+    ---------------------------------------------------------------------------
+    Args:
+        xs: array of x-coordinates
+        ys: array of y-coordinates
+        idx: indices of the points in the subtree
+    Returns:
+        split_x: splitting direction. True if x and False if y"""
+    x_var, y_var = np.var(xs[idx]), np.var(ys[idx])
+
+    return True if x_var > y_var else False
+
+def _partition(
+        side: ndarray,
+        isplit: ndarray,
+        iother: ndarray,
+        mid: int) -> Tuple[ndarray, ndarray]:
+    """Given the indices sorted along the splitting direction, split the indices
+    sorted along the other direction into the ones that fall to the left and to
+    the right of the middle point. Ordering is preserved, so both halves remain
+    presorted. Runs in linear time on the subtree size.
+    ---------------------------------------------------------------------------
+    Args:
+        side: scratch array with one entry per point
+        isplit: array of indices that sort the subtree along split axis
+        iother: array of indices that sort the subtree along other axis
+        mid: position of the splitting point within isplit
+    Returns:
+        left: elements of iother contained in isplit[:mid], order preserved
+        right: elements of iother contained in isplit[mid+1:], order preserved"""
+    # mark the side each point of the subtree falls into
+    side[isplit[:mid]] = -1
+    side[isplit[mid]] = 0
+    side[isplit[mid+1:]] = 1
+    # select marked indices along the other direction
+    mark = side[iother]
+
+    return iother[mark < 0], iother[mark > 0]
+
+
+def _min_dist_box(
+        points: ndarray,
+        xmin: float,
+        xmax: float,
+        ymin: float,
+        ymax: float) -> ndarray:
+    """Vectorized minimum distance from several points to a rectangular region.
+    Points inside the region are at distance zero.
+    ---------------------------------------------------------------------------
+    Args:
+        points: (m, 2)-shape array of point coords
+        xmin, xmax, ymin, ymax: region boundaries
+    Returns:
+        dists: (m,)-shape array of minimum distances"""
+    dx = np.maximum(np.maximum(xmin - points[:, 0], points[:, 0] - xmax), 0.)
+    dy = np.maximum(np.maximum(ymin - points[:, 1], points[:, 1] - ymax), 0.)
+
+    return np.sqrt(dx*dx + dy*dy)
+
+def _push(
+        dists: ndarray,
+        nbrs: ndarray,
+        rows: ndarray,
+        d: ndarray,
+        ids) -> None:
+    """Pushes candidates into the bounded k-best structure of each query row.
+    Each row of dists is kept in ascending order, so its last column is the
+    largest distance of a bounded max-heap and only candidates improving it
+    enter. Ties keep earlier items first, as nearest_neighbors does, and zero
+    distances are skipped.
+    ---------------------------------------------------------------------------
+    Args:
+        dists: (m, k)-shape array of k smallest distances so far
+        nbrs: (m, k)-shape array of k nearest neighbor ids so far
+        rows: (r,)-shape array of query rows the candidates belong to
+        d: (r,)-shape or (r, c)-shape array of candidate distances
+        ids: candidate ids, broadcastable to the shape of d"""
+    d = d.reshape(rows.shape[0], -1)
+    ids = np.broadcast_to(ids, d.shape)
+    d = np.where(d > 0, d, math.inf) # skip zero distances
+    keep = (d < dists[rows, -1:]).any(axis=1)
+    if not keep.any():
+        return
+    rows, d, ids = rows[keep], d[keep], ids[keep]
+    # merge current k-best items with candidates, stable sort keeps ties order
+    D = np.concatenate([dists[rows], d], axis=1)
+    I = np.concatenate([nbrs[rows], ids], axis=1)
+    order = np.argsort(D, axis=1, kind='stable')[:, :dists.shape[1]]
+    dists[rows] = np.take_along_axis(D, order, axis=1)
+    nbrs[rows] = np.take_along_axis(I, order, axis=1)
+
+def _query(node, points: ndarray, rows: ndarray, dists: ndarray,
+           nbrs: ndarray, counters: dict = None) -> None:
+    """Recursive batched k nearest neighbors search. All the query rows whose
+    k-th smallest distance is larger than their distance to the node's region
+    traverse the subtree together, so every visited node costs a handful of
+    vectorized operations instead of one Python frame per query. Queries visit
+    the child on their side of the split first.
+    ---------------------------------------------------------------------------
+    Args:
+        node: subtree root, either a TreeNode or a FlatNode
+        points: (m, 2)-shape array of query coords
+        rows: query rows active in this subtree
+        dists: (m, k)-shape array of k smallest distances so far
+        nbrs: (m, k)-shape array of k nearest neighbor ids so far
+        counters: visited and pruned (query, node) pairs, None to skip them"""
+    if counters is not None:
+        counters['visited'] += rows.shape[0]
+    p = points[rows]
+    if node.bucket is not None: # scan leaf bucket at once
+        bids, bxs, bys = node.bucket
+        dx, dy = p[:, :1] - bxs, p[:, 1:] - bys
+        _push(dists, nbrs, rows, np.sqrt(dx*dx + dy*dy), bids)
+        return
+
+    dx, dy = p[:, 0] - node.x, p[:, 1] - node.y
+    if not node.deleted:
+        _push(dists, nbrs, rows, np.sqrt(dx*dx + dy*dy), node.id)
+
+    below = (dx < 0) if node.split_x else (dy < 0)
+    for sub, children in ((rows[below], (node.left, node.right)),
+                          (rows[~below], (node.right, node.left))):
+        for child in children:
+            if child is None or sub.shape[0] == 0:
+                continue
+            dmin = _min_dist_box(points[sub], child.xmin, child.xmax,
+                                 child.ymin, child.ymax)
+            active = sub[dmin < dists[sub, -1]] # prune regions
+            if counters is not None:
+                counters['pruned'] += sub.shape[0] - active.shape[0]
+            if active.shape[0] > 0:
+                _query(child, points, active, dists, nbrs, counters)
+
+def _batch_query(root, points: ndarray, k: int, dtype,
+                 stats: dict = None) -> Tuple[ndarray]:
+    """Batched k nearest neighbors search from the root of a 2d-tree.
+    ---------------------------------------------------------------------------
+    Args:
+        root: tree's root node, None if the tree is empty
+        points: (m, 2)-shape array of query coords
+        k: number of nearest neighbors to find
+        dtype: data type of point ids
+        stats: dict to add the search counters to, see metrics.report
+    Returns:
+        dists: (m, k)-shape array of ascending distances
+        ids: (m, k)-shape array of nearest neighbor ids"""
+    counters = metrics.probe(stats)
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    m = points.shape[0]
+    dists = np.full((m, k), math.inf)
+    nbrs = np.full((m, k), -1, dtype=dtype)
+    if root is not None and m > 0:
+        _query(root, points, np.arange(m), dists, nbrs, counters)
+    if counters is not None:
+        counters['queries'] = m
+        metrics.report('query', counters, stats)
+
+    return dists, nbrs
+
+
+def _range(node, rows: ndarray, contains: Callable, overlaps: Callable,
+           found: List[Tuple[ndarray]]) -> None:
+    """Recursive batched range search. Query rows descend into a child only if
+    their range overlaps the child's rectangular region.
+    ---------------------------------------------------------------------------
+    Args:
+        node: subtree root, either a TreeNode or a FlatNode
+        rows: query rows active in this subtree
+        contains: function mapping query rows and (c,)-shape arrays of point
+            coords to a (r, c)-shape mask of points within each range
+        overlaps: function mapping query rows and a node to a (r,)-shape mask
+            of ranges overlapping the node's region
+        found: list of (rows, ids) pairs of points found so far"""
+    if node.bucket is not None:
+        pids, pxs, pys = node.bucket
+    else:
+        pids, pxs, pys = np.array([node.id]), np.array([node.x]), \
+                         np.array([node.y])
+    if not node.deleted:
+        r, c = np.nonzero(contains(rows, pxs, pys))
+        if r.shape[0] > 0:
+            found.append((rows[r], pids[c]))
+
+    for child in (node.left, node.right):
+        if child is None:
+            continue
+        active = rows[overlaps(rows, child)] # prune regions
+        if active.shape[0] > 0:
+            _range(child, active, contains, overlaps, found)
+
+def _batch_range(root, m: int, contains: Callable, overlaps: Callable,
+                 dtype) -> Tuple[ndarray, ndarray]:
+    """Batched range search from the root of a 2d-tree. Results are returned
+    in CSR-style, ids found for query i are ids[offsets[i]:offsets[i+1]].
+    ---------------------------------------------------------------------------
+    Args:
+        root: tree's root node, None if the tree is empty
+        m: number of queries
+        contains: points within range function, see _range
+        overlaps: range and region overlap function, see _range
+        dtype: data type of point ids
+    Returns:
+        offsets: (m+1,)-shape array of offsets into ids
+        ids: ids of the points found for all the queries"""
+    found = []
+    if root is not None and m > 0:
+        _range(root, np.arange(m), contains, overlaps, found)
+    if len(found) == 0:
+        return np.zeros(m + 1, dtype=np.int64), np.empty(0, dtype=dtype)
+
+    rows = np.concatenate([f[0] for f in found])
+    ids = np.concatenate([f[1] for f in found])
+    # group ids by query row, keeping traversal order within each row
+    order = np.argsort(rows, kind='stable')
+    offsets = np.zeros(m + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=m), out=offsets[1:])
+
+    return offsets, ids[order]
 
 
 # Node Class
@@ -34,6 +259,12 @@ class TreeNode:
         self.split_x = split_x
         # left and right children
         self.left, self.right = None, None
+        # (ids, xs, ys) arrays of the subtree points if node is a leaf bucket
+        self.bucket = None
+        # number of points stored in the subtree, including removed ones
+        self.size = 1
+        # removed points are kept as tombstones until their subtree is rebuilt
+        self.deleted = False
 
     def __str__(self) -> str:
         """2d-tree node string representation.
@@ -45,26 +276,70 @@ class TreeNode:
 
 # 2d-Tree class
 class Tree:
+    # scapegoat balance factor for subtree rebuilds after insertions
+    alpha = 0.75
+
     def __init__(
             self, 
             ids: List[int],
             xs: List[float], 
-            ys: List[float]):
+            ys: List[float],
+            leaf_size: int = 1):
         """Constructor method. Builds a variance dependent 2d-tree using list of 
-        spatial input coords.
+        spatial input coords. Subtrees with at most leaf_size points are stored
+        as a single leaf bucket node which is scanned at once during queries.
         -----------------------------------------------------------------------
         Args:
+            ids: list of point ids
             xs: list of x-coordinates
-            ys: list of y-coordinates"""
+            ys: list of y-coordinates
+            leaf_size: maximum number of points in a leaf bucket"""
+        self.leaf_size = leaf_size
+        # cast to numpy arrays so that points are indexed by position
+        ids, xs, ys = np.asarray(ids), np.asarray(xs), np.asarray(ys)
+        self.dtype = ids.dtype # data type of point ids
+        # build tree recursively in O(n log n)
+        self.root = self.__build_subtree(ids, xs, ys)
+        # number of stored points and tombstones
+        self.__alive, self.__deleted = len(xs), 0
+        # map from point ids to the nodes storing them, built on first update
+        self.__nodes = None
+        # bumped on every update so that derived caches can detect changes
+        self.version = 0
+
+    def __len__(self) -> int:
+        return self.__alive
+
+    def __build_subtree(
+            self,
+            ids: ndarray,
+            xs: ndarray,
+            ys: ndarray,
+            parent: TreeNode = None,
+            left: bool = True) -> TreeNode:
+        """Builds a subtree for a list of points.
+        ------------------------------------------------------------------------
+        Args:
+            ids: array of point ids
+            xs: array of x-coordinates
+            ys: array of y-coordinates
+            parent: parent node, None if subtree is the whole tree
+            left: whether the subtree is the left one of parent
+        Returns:
+            node: subtree's root node, None if there are no points"""
+        if len(xs) == 0:
+            return None
         # compute indices that would sort xs and ys
         ix_sort, iy_sort = np.argsort(xs), np.argsort(ys)
-        # compute variances along xs and ys
-        x_var, y_var = np.var(xs), np.var(ys)
         # splitting rule
-        split_x = True if x_var > y_var else False
-        
-        # build tree recursively
-        self.root = self.__build_tree(ids, xs, ys, ix_sort, iy_sort, split_x)
+        split_x = _split_rule(xs, ys, slice(None))
+        # scratch array used to partition presorted indices at each level
+        self.__side = np.zeros(len(xs), dtype=np.int8)
+        node = self.__build_tree(ids, xs, ys, ix_sort, iy_sort, split_x,
+                                 parent, left)
+        del self.__side
+
+        return node
 
     def print(self):
         """Printing method starting at tree's root.
@@ -86,52 +361,35 @@ class Tree:
         if node.right != None:
             self.__print_subtree(node.right) # explore right subtree
 
-    def __select(self, isorted: List[int], isecond: List[int]) -> List[int]:
-        """Given an array of indices, select from a second array those that
-        match with any of the elements of the first array. From the selected
-        items, it preserves the ordering in the second array.
-        ------------------------------------------------------------------------
-        Args:
-            isorted: array of indices that would sort an array
-            isecond: array of indices that would sort another array
-        Returns:
-            io: array of indices in isecond that are contained in isorted, order
-                is preserved"""
-        io = np.array([]).astype(int)
-        # iterate along second array of indices (non-splitting direction)
-        for i in isecond:
-            r = (isorted == i) # compare isorted elements to i
-            if r.any() == True: # element is present in isorted
-                io = np.append(io, i)
-
-        return io
-
     def __get_bounds(
             self, 
-            node: TreeNode, 
-            parent: TreeNode) -> Tuple[float]:
+            parent: TreeNode,
+            left: bool) -> Tuple[float]:
         """Computes node region's boundaries based on parent splitting dir.
+        The side is given by the subtree the node belongs to rather than by
+        comparing coordinates, so points tied with the parent along the
+        splitting axis stay within their subtree's region.
         ------------------------------------------------------------------------
         Args:
-            node: 2d-tree node
             parent: parent node
+            left: whether node is the left child of parent
         Returns:
             (4,)-tuple containing rectangular boundaries"""
         xmin, xmax = parent.xmin, parent.xmax
         ymin, ymax = parent.ymin, parent.ymax
 
         if parent.split_x == True: # parent splits along x
-            # check if parent is to the left or right of node
-            if parent.x <= node.x:
-                xmin = parent.x
-            else:
+            # check if node is to the left or right of parent
+            if left:
                 xmax = parent.x
+            else:
+                xmin = parent.x
 
         else: # parent splits along y
-            if parent.y <= node.y:
-                ymin = parent.y
-            else:
+            if left:
                 ymax = parent.y
+            else:
+                ymin = parent.y
 
         return xmin, xmax, ymin, ymax
 
@@ -140,74 +398,62 @@ class Tree:
             ids: List[int],
             xs: List[float],
             ys: List[float],
-            ix: List[int],
-            iy: List[int],
+            ix: ndarray,
+            iy: ndarray,
             split_x: bool = None,
-            parent = None) -> TreeNode:
+            parent = None,
+            left: bool = True) -> TreeNode:
         """Recursive building method. Builds a 2d-tree for a list of points.
         Uses variance rule for determining splitting direction of child nodes.
+        Index arrays stay presorted along both axes, so each level of the tree
+        is built in linear time.
         ------------------------------------------------------------------------
         Args:
+            ids: list of point ids
             xs: list of x-coordinates
             ys: list of y-coordinates
             ix: list of indices that define xs sorting
             iy: list of indices that define ys sorting
             split_x: splitting direction. True if x and False if y
-            parent: parent node"""
+            parent: parent node
+            left: whether the subtree is the left one of parent"""
         size = ix.shape[0] # number of nodes
         mid = size // 2 # middle index
-        
-        if split_x: # split along x-axis
-            # use middle node along x-axis to partition space
-            node = TreeNode(ids[ix[mid]], xs[ix[mid]], ys[ix[mid]], True)
-            if parent != None:
-                # compute region's boundaries
-                bounds = self.__get_bounds(node, parent)
-                node.xmin, node.xmax = bounds[:2]
-                node.ymin, node.ymax = bounds[2:]
-                
-            if mid > 0:
-                # select iy elements corresponding to ix[:mid]
-                sub_iy = self.__select(ix[:mid], iy)
-                # compute splitting axis based on variance rule
-                x_var, y_var = np.var(xs[ix[:mid]]), np.var(ys[ix[:mid]])
-                split_x = True if x_var > y_var else False
-                # build left-subtree
-                node.left = self.__build_tree(ids, xs, ys, ix[:mid], sub_iy,
-                                              split_x, node)
-
-            if mid + 1 < size:
-                sub_iy = self.__select(ix[mid+1:], iy)
-                x_var, y_var = np.var(xs[ix[mid+1:]]), np.var(ys[ix[mid+1:]])
-                split_x = True if x_var > y_var else False
-                # build right-subtree
-                node.right = self.__build_tree(ids, xs, ys, ix[mid+1:], sub_iy,
-                                               split_x, node)
-
-        else: # split along y-axis
-            node = TreeNode(ids[iy[mid]], xs[iy[mid]], ys[iy[mid]], False)
-            if parent != None:
-                bounds = self.__get_bounds(node, parent)
-                node.xmin, node.xmax = bounds[:2]
-                node.ymin, node.ymax = bounds[2:]
-
-            if mid > 0:
-                # select ix elements corresponding to iy[:mid]
-                sub_ix = self.__select(iy[:mid], ix)
-                x_var, y_var = np.var(xs[iy[:mid]]), np.var(ys[iy[:mid]])
-                split_x = True if x_var > y_var else False
-                # build left-subtree
-                node.left = self.__build_tree(ids, xs, ys, sub_ix, iy[:mid],
-                                              split_x, node)
-
-            if mid + 1 < size:
-                # select ix elements corresponding to iy[:mid]
-                sub_ix = self.__select(iy[mid+1:], ix)
-                x_var, y_var = np.var(xs[iy[mid+1:]]), np.var(ys[iy[mid+1:]])
-                split_x = True if x_var > y_var else False
-                # build right-subtree
-                node.right = self.__build_tree(ids, xs, ys, sub_ix, iy[mid+1:],
-                                              split_x, node)
+        # presorted indices along splitting and non-splitting directions
+        isplit, iother = (ix, iy) if split_x else (iy, ix)
+
+        # use middle node along splitting axis to partition space
+        i = isplit[mid]
+        node = TreeNode(ids[i], xs[i], ys[i], split_x)
+        node.size = size
+        if parent != None:
+            # compute region's boundaries
+            bounds = self.__get_bounds(parent, left)
+            node.xmin, node.xmax = bounds[:2]
+            node.ymin, node.ymax = bounds[2:]
+
+        if 1 < size <= self.leaf_size:
+            # store subtree points in a leaf bucket
+            node.bucket = (ids[isplit], xs[isplit], ys[isplit])
+            return node
+
+        # select other axis elements corresponding to each side of the split
+        left, right = _partition(self.__side, isplit, iother, mid)
+
+        if mid > 0:
+            # compute splitting axis based on variance rule
+            split = _split_rule(xs, ys, isplit[:mid])
+            sub = (isplit[:mid], left) if split_x else (left, isplit[:mid])
+            # build left-subtree
+            node.left = self.__build_tree(ids, xs, ys, *sub, split, node,
+                                          True)
+
+        if mid + 1 < size:
+            split = _split_rule(xs, ys, isplit[mid+1:])
+            sub = (isplit[mid+1:], right) if split_x else (right, isplit[mid+1:])
+            # build right-subtree
+            node.right = self.__build_tree(ids, xs, ys, *sub, split, node,
+                                           False)
 
         # once it finishes recursive calls, return subtree's root node
         return node
@@ -262,13 +508,209 @@ class Tree:
 
         return dist_min
 
+    def __update(
+            self,
+            dnode: float,
+            node: TreeNode,
+            dmins: deque,
+            nns: deque) -> None:
+        """Inserts a node into the k nearest neighbors found so far if it is
+        closer than any of them. Nodes at zero distance are skipped.
+        ------------------------------------------------------------------------
+        Args:
+            dnode: distance from query to node
+            node: candidate node
+            dmins: queue with distances for k smallest distances so far
+            nns: current queue with k nearest neighbor nodes"""
+        update = dnode < np.array(dmins)
+        if update.any() and dnode > 0:
+            pos = np.argmax(update)
+            if len(dmins) == dmins.maxlen:
+                dmins.pop()
+                nns.pop()
+            dmins.insert(pos, dnode)
+            nns.insert(pos, node)
+
+    def __get_nodes(self) -> dict:
+        """Returns the map from point ids to the nodes storing them. It is
+        built on first call.
+        ------------------------------------------------------------------------
+        """
+        if self.__nodes is None:
+            self.__nodes = {}
+            self.__index_subtree(self.root)
+
+        return self.__nodes
+
+    def __index_subtree(self, node: TreeNode) -> None:
+        """Adds the points of a subtree to the map from ids to nodes.
+        ------------------------------------------------------------------------
+        Args:
+            node: subtree's root node"""
+        stack = [node] if node is not None else []
+        while len(stack) > 0:
+            node = stack.pop()
+            if node.bucket is not None:
+                self.__nodes.update(dict.fromkeys(node.bucket[0].tolist(),
+                                                  node))
+            elif not node.deleted:
+                self.__nodes[node.id] = node
+            stack += [c for c in (node.left, node.right) if c is not None]
+
+    def __collect(self, node: TreeNode) -> Tuple[ndarray, int]:
+        """Collects the points stored in a subtree, skipping tombstones.
+        ------------------------------------------------------------------------
+        Args:
+            node: subtree's root node
+        Returns:
+            ids, xs, ys: arrays of the subtree points
+            deleted: number of tombstones found"""
+        ids, xs, ys = [], [], []
+        deleted = 0
+        stack = [node] if node is not None else []
+        while len(stack) > 0:
+            node = stack.pop()
+            if node.bucket is not None:
+                ids.append(node.bucket[0])
+                xs.append(node.bucket[1])
+                ys.append(node.bucket[2])
+                # removed bucket points count as tombstones
+                deleted += node.size - len(node.bucket[0])
+            elif node.deleted:
+                deleted += 1
+            else:
+                ids.append([node.id])
+                xs.append([node.x])
+                ys.append([node.y])
+            stack += [c for c in (node.left, node.right) if c is not None]
+
+        if len(ids) == 0:
+            empty = np.empty(0)
+            return empty.astype(self.dtype), empty, empty, deleted
+
+        ids = np.concatenate(ids).astype(self.dtype)
+        return ids, np.concatenate(xs), np.concatenate(ys), deleted
+
+    def __rebuild(self, path: List[TreeNode], i: int) -> None:
+        """Rebuilds the subtree rooted at path[i] from its stored points,
+        dropping its tombstones.
+        ------------------------------------------------------------------------
+        Args:
+            path: list of nodes from the root down to the subtree
+            i: position of the subtree's root in path"""
+        node = path[i]
+        parent = path[i-1] if i > 0 else None
+        left = parent is not None and parent.left is node
+        ids, xs, ys, deleted = self.__collect(node)
+        # rebuild and hang new subtree from parent
+        new = self.__build_subtree(ids, xs, ys, parent, left)
+        if parent is None:
+            self.root = new
+        elif left:
+            parent.left = new
+        else:
+            parent.right = new
+        # update tombstones count and ancestors sizes
+        self.__deleted -= deleted
+        for ancestor in path[:i]:
+            ancestor.size -= deleted
+        if self.__nodes is not None:
+            self.__index_subtree(new)
+
+    def insert(self, node_id: int, x: float, y: float) -> None:
+        """Inserts a point into the tree. The point descends to the region
+        containing it, so region bounds remain valid. Whenever the insertion
+        leaves the tree too deep, the highest unbalanced subtree along the
+        insertion path is rebuilt scapegoat-style. Overflowing leaf buckets are
+        split by rebuilding them.
+        ------------------------------------------------------------------------
+        Args:
+            node_id: point's id
+            x: x-coordinate
+            y: y-coordinate"""
+        nodes = self.__get_nodes()
+        if node_id in nodes:
+            raise ValueError(f'Point {node_id} is already in the tree')
+        self.__alive += 1
+        self.version += 1
+
+        if self.root is None:
+            self.dtype = np.asarray(node_id).dtype
+            self.root = TreeNode(node_id, x, y, True)
+            nodes[node_id] = self.root
+            return
+
+        # descend to the leaf region containing the point
+        path, node = [], self.root
+        while node is not None:
+            path.append(node)
+            node.size += 1
+            if node.bucket is not None: # store point in leaf bucket
+                bids, bxs, bys = node.bucket
+                node.bucket = (np.append(bids, node_id).astype(self.dtype),
+                               np.append(bxs, x), np.append(bys, y))
+                nodes[node_id] = node
+                break
+
+            left = (x < node.x) if node.split_x else (y < node.y)
+            child = node.left if left else node.right
+            if child is None: # hang a new leaf node
+                child = TreeNode(node_id, x, y, not node.split_x)
+                bounds = self.__get_bounds(node, left)
+                child.xmin, child.xmax = bounds[:2]
+                child.ymin, child.ymax = bounds[2:]
+                if left:
+                    node.left = child
+                else:
+                    node.right = child
+                path.append(child)
+                nodes[node_id] = child
+                break
+            node = child
+
+        leaf = path[-1]
+        if leaf.bucket is not None and len(leaf.bucket[0]) > self.leaf_size:
+            self.__rebuild(path, len(path) - 1)
+        elif len(path) - 1 > math.log(self.root.size, 1 / self.alpha):
+            # find the highest alpha-unbalanced ancestor
+            for i, node in enumerate(path[:-1]):
+                child = path[i+1]
+                if child.size > self.alpha * node.size:
+                    self.__rebuild(path, i)
+                    break
+
+    def remove(self, node_id: int) -> None:
+        """Removes a point from the tree. Points stored in internal nodes are
+        marked as tombstones, so region bounds remain valid. Once tombstones
+        outnumber stored points the whole tree is rebuilt.
+        ------------------------------------------------------------------------
+        Args:
+            node_id: point's id"""
+        nodes = self.__get_nodes()
+        if node_id not in nodes:
+            raise KeyError(f'Point {node_id} is not in the tree')
+        node = nodes.pop(node_id)
+        if node.bucket is not None:
+            bids, bxs, bys = node.bucket
+            keep = bids != node_id
+            node.bucket = (bids[keep], bxs[keep], bys[keep])
+        else:
+            node.deleted = True
+        self.__alive -= 1
+        self.__deleted += 1
+        self.version += 1
+
+        if self.__deleted > self.__alive:
+            self.__rebuild([self.root], 0)
+
     def nearest_neighbors(
             self, 
             query: List[float], 
             node: TreeNode,
             k: int = 1,
             dmins: deque = None,
-            nns: deque = None) -> List[TreeNode]:
+            nns: deque = None,
+            stats: dict = None) -> List[TreeNode]:
         """Given a query node, find k nearest neighbor among the subtree nodes.
         ------------------------------------------------------------------------
         Args:
@@ -277,35 +719,530 @@ class Tree:
             node: subtree node
             dists: queue with distances for k smallest distances so far
             nns: current queue with k nearest neighbor nodes
+            stats: dict to add the visited and pruned nodes and wall time to,
+                None to skip them unless metrics are enabled
         Returns:
             nearest: nearest neighbor to query node in subtree rooted at node"""
+        top = dmins is None # recursive calls pass the top call's counters
+        counters = metrics.probe(stats) if top else stats
         if dmins is None:
             dmins = deque([math.inf], maxlen=k)
         if nns is None:
             nns = deque([None], maxlen=k)
         # compute distance from query to node and update dmin if applicable
         xq, yq = query
-        if node is not None:
-            dnode = self.__dist(query, [node.x, node.y])
-            update = dnode < np.array(dmins)
-            if update.any() and dnode > 0:
-                pos = np.argmax(update)
-                if len(dmins) == dmins.maxlen:
-                    dmins.pop()
-                    nns.pop()
-                dmins.insert(pos, dnode)
-                nns.insert(pos, node)
+        if node is not None and node.bucket is not None:
+            # compute distances to all the bucket points at once
+            bids, bxs, bys = node.bucket
+            dx, dy = xq - bxs, yq - bys
+            dbucket = np.sqrt(dx*dx + dy*dy)
+            for i in np.flatnonzero(dbucket < max(dmins)):
+                near = TreeNode(bids[i], bxs[i], bys[i], node.split_x)
+                self.__update(dbucket[i], near, dmins, nns)
+
+        elif node is not None:
+            if not node.deleted: # skip tombstones
+                dnode = self.__dist(query, [node.x, node.y])
+                self.__update(dnode, node, dmins, nns)
 
             dleft = self.__min_dist_region(query, node.left)
             explore_left = dleft < np.array(dmins)
             if explore_left.any():
                 dmins, nns = self.nearest_neighbors(query, node.left, k=k,
-                                                    dmins=dmins, nns=nns)
+                                                    dmins=dmins, nns=nns,
+                                                    stats=counters)
+            elif counters is not None and node.left is not None:
+                counters['pruned'] += 1
 
             dright = self.__min_dist_region(query, node.right)
             explore_right = dright < np.array(dmins)
             if explore_right.any(): # explore right subtree
                 dmins, nns = self.nearest_neighbors(query, node.right, k=k,
-                                                    dmins=dmins, nns=nns)
+                                                    dmins=dmins, nns=nns,
+                                                    stats=counters)
+            elif counters is not None and node.right is not None:
+                counters['pruned'] += 1
+
+        if counters is not None:
+            counters['visited'] += node is not None
+            if top:
+                metrics.report('nearest_neighbors', counters, stats)
+
+        return dmins, nns
+
+    def query(
+            self,
+            points: ndarray,
+            k: int = 1,
+            stats: dict = None) -> Tuple[ndarray, ndarray]:
+        """Batched k nearest neighbors search for several query points. Same
+        semantics as nearest_neighbors: points at zero distance from a query
+        are skipped. Missing neighbors have infinite distance and id -1.
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords
+            k: number of nearest neighbors to find
+            stats: dict to add the visited and pruned (query, node) pairs
+                and wall time to, None to skip them unless metrics are enabled
+        Returns:
+            dists: (m, k)-shape array of ascending distances
+            ids: (m, k)-shape array of nearest neighbor ids"""
+        return _batch_query(self.root, points, k, self.dtype, stats)
+
+    def query_radius(self, point: List[float], r: float) -> ndarray:
+        """Finds all the points within distance r from a query point.
+        ------------------------------------------------------------------------
+        Args:
+            point: (2,)-shape list containing query xy coordinates
+            r: search radius
+        Returns:
+            ids: ids of the points within range"""
+        _, ids = self.query_radius_batch(np.reshape(point, (1, 2)), r)
+
+        return ids
+
+    def query_box(
+            self,
+            xmin: float,
+            xmax: float,
+            ymin: float,
+            ymax: float) -> ndarray:
+        """Finds all the points within a rectangular region.
+        ------------------------------------------------------------------------
+        Args:
+            xmin, xmax, ymin, ymax: query rectangle boundaries
+        Returns:
+            ids: ids of the points within range"""
+        _, ids = self.query_box_batch([[xmin, xmax, ymin, ymax]])
+
+        return ids
+
+    def query_radius_batch(
+            self,
+            points: ndarray,
+            r: float) -> Tuple[ndarray, ndarray]:
+        """Batched fixed-radius search. Ids found for query i are given by
+        ids[offsets[i]:offsets[i+1]].
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords
+            r: search radius, either a scalar or one per query
+        Returns:
+            offsets: (m+1,)-shape array of offsets into ids
+            ids: ids of the points found for all the queries"""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        r = np.broadcast_to(np.asarray(r, dtype=np.float64), points.shape[:1])
+
+        def contains(rows, xs, ys):
+            dx, dy = points[rows, :1] - xs, points[rows, 1:] - ys
+            return np.sqrt(dx*dx + dy*dy) <= r[rows, None]
+
+        def overlaps(rows, node):
+            dmin = _min_dist_box(points[rows], node.xmin, node.xmax,
+                                 node.ymin, node.ymax)
+            return dmin <= r[rows]
+
+        return _batch_range(self.root, points.shape[0], contains, overlaps,
+                            self.dtype)
+
+    def query_box_batch(self, boxes: ndarray) -> Tuple[ndarray, ndarray]:
+        """Batched rectangular region search. Ids found for query i are given
+        by ids[offsets[i]:offsets[i+1]].
+        ------------------------------------------------------------------------
+        Args:
+            boxes: (m, 4)-shape array of (xmin, xmax, ymin, ymax) rectangles
+        Returns:
+            offsets: (m+1,)-shape array of offsets into ids
+            ids: ids of the points found for all the queries"""
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        bxmin, bxmax, bymin, bymax = boxes.T
+
+        def contains(rows, xs, ys):
+            x_in = (bxmin[rows, None] <= xs) & (xs <= bxmax[rows, None])
+            y_in = (bymin[rows, None] <= ys) & (ys <= bymax[rows, None])
+            return x_in & y_in
+
+        def overlaps(rows, node):
+            x_in = (node.xmin <= bxmax[rows]) & (bxmin[rows] <= node.xmax)
+            y_in = (node.ymin <= bymax[rows]) & (bymin[rows] <= node.ymax)
+            return x_in & y_in
+
+        return _batch_range(self.root, boxes.shape[0], contains, overlaps,
+                            self.dtype)
+
+
+# Flat node view class
+class FlatNode:
+    __slots__ = ('tree', 'index')
+    # flat trees store one point per node and are immutable
+    bucket = None
+    deleted = False
+
+    def __init__(self, tree: 'FlatTree', index: int):
+        """Constructor method. Lightweight view over a node stored in a
+        FlatTree. Exposes the same attributes as TreeNode, so traversal and
+        drawing code can use either layout.
+        -----------------------------------------------------------------------
+        Args:
+            tree: flat 2d-tree storing the node
+            index: node's offset within the tree arrays"""
+        self.tree = tree
+        self.index = index
+
+    @property
+    def id(self):
+        return self.tree.ids[self.index]
+
+    @property
+    def x(self) -> float:
+        return self.tree.xs[self.index]
+
+    @property
+    def y(self) -> float:
+        return self.tree.ys[self.index]
+
+    @property
+    def split_x(self) -> bool:
+        return bool(self.tree.split_x[self.index])
+
+    @property
+    def xmin(self) -> float:
+        return self.tree.xmin[self.index]
+
+    @property
+    def xmax(self) -> float:
+        return self.tree.xmax[self.index]
+
+    @property
+    def ymin(self) -> float:
+        return self.tree.ymin[self.index]
+
+    @property
+    def ymax(self) -> float:
+        return self.tree.ymax[self.index]
+
+    @property
+    def left(self) -> 'FlatNode':
+        return self.tree.node(self.tree.left[self.index])
+
+    @property
+    def right(self) -> 'FlatNode':
+        return self.tree.node(self.tree.right[self.index])
+
+    def __eq__(self, other) -> bool:
+        return (isinstance(other, FlatNode) and self.tree is other.tree
+                and self.index == other.index)
+
+    def __hash__(self) -> int:
+        return hash((id(self.tree), self.index))
+
+    def __str__(self) -> str:
+        """2d-tree node string representation.
+        ------------------------------------------------------------------------
+        """
+        split = 'x' if self.split_x == True else 'y'
+        return f"[(x={str(self.x)}, y={str(self.y)}), split_dir={split}]"
+
+
+# Flat 2d-Tree class
+class FlatTree:
+    # arrays defining the tree layout
+    fields = ('ids', 'xs', 'ys', 'split_x', 'xmin', 'xmax', 'ymin', 'ymax',
+              'left', 'right')
+
+    def __init__(
+            self,
+            ids: List[int],
+            xs: List[float],
+            ys: List[float]):
+        """Constructor method. Builds the same variance dependent 2d-tree as
+        Tree, but stores nodes in contiguous arrays instead of linked objects.
+        Nodes are laid out in preorder, root at offset 0, and children are
+        referenced by their offsets (-1 if missing).
+        -----------------------------------------------------------------------
+        Args:
+            ids: list of point ids
+            xs: list of x-coordinates
+            ys: list of y-coordinates"""
+        ids, xs, ys = np.asarray(ids), np.asarray(xs), np.asarray(ys)
+        n = len(xs)
+        # allocate node arrays
+        self.ids = np.empty(n, dtype=ids.dtype)
+        self.xs = np.empty(n, dtype=np.float64)
+        self.ys = np.empty(n, dtype=np.float64)
+        self.split_x = np.empty(n, dtype=bool)
+        self.xmin = np.full(n, -math.inf)
+        self.xmax = np.full(n, math.inf)
+        self.ymin = np.full(n, -math.inf)
+        self.ymax = np.full(n, math.inf)
+        self.left = np.full(n, -1, dtype=np.int32)
+        self.right = np.full(n, -1, dtype=np.int32)
+
+        if n > 0:
+            ix_sort, iy_sort = np.argsort(xs), np.argsort(ys)
+            split_x = _split_rule(xs, ys, slice(None))
+            self.__side = np.zeros(n, dtype=np.int8)
+            self.__size = 0 # number of nodes laid out so far
+            self.__build_tree(ids, xs, ys, ix_sort, iy_sort, split_x)
+            del self.__side, self.__size
+
+    def __len__(self) -> int:
+        return len(self.xs)
+
+    @property
+    def root(self) -> FlatNode:
+        """Tree's root node view, None if the tree is empty."""
+        return self.node(0 if len(self) > 0 else -1)
+
+    @property
+    def nbytes(self) -> int:
+        """Total number of bytes used by the tree arrays."""
+        return sum(getattr(self, f).nbytes for f in self.fields)
+
+    def node(self, index: int) -> FlatNode:
+        """Returns a view over the node at a given offset, None if offset is
+        negative."""
+        return FlatNode(self, int(index)) if index >= 0 else None
+
+    def save(self, fname: str) -> None:
+        """Stores tree arrays in a .npz file. No Python objects are pickled.
+        ------------------------------------------------------------------------
+        Args:
+            fname: output filename"""
+        np.savez(fname, **{f: getattr(self, f) for f in self.fields})
+
+    @classmethod
+    def load(cls, fname: str) -> 'FlatTree':
+        """Loads a tree previously stored with save method.
+        ------------------------------------------------------------------------
+        Args:
+            fname: input filename
+        Returns:
+            tree: loaded flat 2d-tree"""
+        with np.load(fname, allow_pickle=False) as data:
+            return cls.from_arrays({f: data[f] for f in cls.fields})
+
+    @classmethod
+    def from_arrays(cls, arrays: dict) -> 'FlatTree':
+        """Wraps existing tree arrays, e.g. ones in shared memory, without
+        copying them.
+        ------------------------------------------------------------------------
+        Args:
+            arrays: dict mapping every name in fields to its array
+        Returns:
+            tree: flat 2d-tree over the given arrays"""
+        tree = cls.__new__(cls)
+        for f in cls.fields:
+            setattr(tree, f, arrays[f])
+
+        return tree
+
+    def __set_bounds(self, node: int, parent: int, left: bool) -> None:
+        """Computes node region's boundaries based on parent splitting dir.
+        ------------------------------------------------------------------------
+        Args:
+            node: node offset
+            parent: parent node offset
+            left: whether node is the left child of parent"""
+        self.xmin[node], self.xmax[node] = self.xmin[parent], self.xmax[parent]
+        self.ymin[node], self.ymax[node] = self.ymin[parent], self.ymax[parent]
+
+        if self.split_x[parent]: # parent splits along x
+            # check if node is to the left or right of parent
+            if left:
+                self.xmax[node] = self.xs[parent]
+            else:
+                self.xmin[node] = self.xs[parent]
+
+        else: # parent splits along y
+            if left:
+                self.ymax[node] = self.ys[parent]
+            else:
+                self.ymin[node] = self.ys[parent]
+
+    def __build_tree(
+            self,
+            ids: ndarray,
+            xs: ndarray,
+            ys: ndarray,
+            ix: ndarray,
+            iy: ndarray,
+            split_x: bool,
+            parent: int = -1,
+            left: bool = True) -> int:
+        """Recursive building method. Lays out the subtree for a list of points
+        in preorder, mirroring Tree's building procedure.
+        ------------------------------------------------------------------------
+        Args:
+            ids: array of point ids
+            xs: array of x-coordinates
+            ys: array of y-coordinates
+            ix: array of indices that define xs sorting
+            iy: array of indices that define ys sorting
+            split_x: splitting direction. True if x and False if y
+            parent: parent node offset
+            left: whether the subtree is the left one of parent
+        Returns:
+            node: offset of the subtree's root node"""
+        size = ix.shape[0] # number of nodes
+        mid = size // 2 # middle index
+        isplit, iother = (ix, iy) if split_x else (iy, ix)
+
+        # use middle node along splitting axis to partition space
+        i = isplit[mid]
+        node = self.__size
+        self.__size += 1
+        self.ids[node], self.xs[node], self.ys[node] = ids[i], xs[i], ys[i]
+        self.split_x[node] = split_x
+        if parent >= 0:
+            self.__set_bounds(node, parent, left)
+
+        left, right = _partition(self.__side, isplit, iother, mid)
+
+        if mid > 0:
+            split = _split_rule(xs, ys, isplit[:mid])
+            sub = (isplit[:mid], left) if split_x else (left, isplit[:mid])
+            self.left[node] = self.__build_tree(ids, xs, ys, *sub, split,
+                                                node, True)
+
+        if mid + 1 < size:
+            split = _split_rule(xs, ys, isplit[mid+1:])
+            sub = (isplit[mid+1:], right) if split_x else (right, isplit[mid+1:])
+            self.right[node] = self.__build_tree(ids, xs, ys, *sub, split,
+                                                 node, False)
+
+        return node
+
+    def __dist(self, query: List[float], node: int) -> float:
+        """Compute Euclidean distance between a 2d-point and a node's point."""
+        dx, dy = query[0] - self.xs[node], query[1] - self.ys[node]
+
+        return math.sqrt(dx*dx + dy*dy)
+
+    def __min_dist_region(self, point: List[float], node: int) -> float:
+        """Function to compute minimum distance from a point to the rectangular
+        region defined by a 2d-tree splitting node. Same rule as Tree's.
+        ------------------------------------------------------------------------
+        Args:
+            point: (2,)-shape list containing point of interest xy coordinates
+            node: offset of the splitting node, -1 if missing
+        Returns:
+            dist_min: minimum distance from point to region defined by node"""
+        if node < 0:
+            return math.inf
+
+        xp, yp = point
+        xmin, xmax = self.xmin[node], self.xmax[node]
+        ymin, ymax = self.ymin[node], self.ymax[node]
+
+        xin_reg = (xmin <= xp and xp <= xmax) # is xp in [xmin, xmax]?
+        yin_reg = (ymin <= yp and yp <= ymax) # is yp in [ymin, ymax]?
+
+        if xin_reg and yin_reg:
+            dist_x = min(abs(yp - ymin), abs(yp - ymax))
+            dist_y = min(abs(xp - xmin), abs(xp - xmax))
+            dist_min = min(dist_x, dist_y)
+        elif xin_reg:
+            dist_min = min(abs(yp - ymin), abs(yp - ymax))
+        elif yin_reg:
+            dist_min = min(abs(xp - xmin), abs(xp - xmax))
+        else: # point does not intersect neither [xmin, xmax] nor [ymin, ymax]
+            dx = min(abs(xp - xmin), abs(xp - xmax))
+            dy = min(abs(yp - ymin), abs(yp - ymax))
+            dist_min = math.sqrt(dx*dx + dy*dy)
+
+        return dist_min
+
+    def nearest_neighbors(
+            self,
+            query: List[float],
+            node: FlatNode,
+            k: int = 1,
+            dmins: deque = None,
+            nns: deque = None,
+            stats: dict = None) -> List[FlatNode]:
+        """Given a query node, find k nearest neighbor among the subtree nodes.
+        Same semantics as Tree.nearest_neighbors.
+        ------------------------------------------------------------------------
+        Args:
+            query: list of query coords
+            node: subtree root node, either a view or its offset
+            k: number of nearest neighbors to find
+            dmins: queue with distances for k smallest distances so far
+            nns: current queue with k nearest neighbor nodes
+            stats: dict to add the visited and pruned nodes and wall time to,
+                None to skip them unless metrics are enabled
+        Returns:
+            dmins: distances to the k nearest neighbors
+            nns: k nearest neighbor node views"""
+        counters = metrics.probe(stats)
+        if dmins is None:
+            dmins = deque([math.inf], maxlen=k)
+        if nns is None:
+            nns = deque([None], maxlen=k)
+        if node is not None:
+            index = node.index if isinstance(node, FlatNode) else int(node)
+            xq, yq = query
+            self.__search((float(xq), float(yq)), index, dmins, nns, counters)
+        if counters is not None:
+            metrics.report('nearest_neighbors', counters, stats)
 
         return dmins, nns
+
+    def __search(
+            self,
+            query: Tuple[float],
+            node: int,
+            dmins: deque,
+            nns: deque,
+            counters: dict = None) -> None:
+        """Recursive k nearest neighbor search over node offsets.
+        ------------------------------------------------------------------------
+        Args:
+            query: query coords
+            node: subtree root offset
+            dmins: queue with distances for k smallest distances so far
+            nns: current queue with k nearest neighbor nodes
+            counters: visited and pruned nodes, None to skip them"""
+        # dmins is kept in ascending order, so its last item is the largest
+        dnode = self.__dist(query, node)
+        if dnode < dmins[-1] and dnode > 0:
+            # insert before the first larger distance
+            pos = next(j for j, d in enumerate(dmins) if dnode < d)
+            if len(dmins) == dmins.maxlen:
+                dmins.pop()
+                nns.pop()
+            dmins.insert(pos, dnode)
+            nns.insert(pos, FlatNode(self, node))
+
+        left, right = self.left[node], self.right[node]
+        if self.__min_dist_region(query, left) < dmins[-1]:
+            self.__search(query, left, dmins, nns, counters)
+        elif counters is not None and left >= 0:
+            counters['pruned'] += 1
+
+        if self.__min_dist_region(query, right) < dmins[-1]:
+            self.__search(query, right, dmins, nns, counters)
+        elif counters is not None and right >= 0:
+            counters['pruned'] += 1
+        if counters is not None:
+            counters['visited'] += 1
+
+    def query(
+            self,
+            points: ndarray,
+            k: int = 1,
+            stats: dict = None) -> Tuple[ndarray, ndarray]:
+        """Batched k nearest neighbors search for several query points. Same
+        semantics as nearest_neighbors: points at zero distance from a query
+        are skipped. Missing neighbors have infinite distance and id -1.
+        ------------------------------------------------------------------------
+        Args:
+            points: (m, 2)-shape array of query coords
+            k: number of nearest neighbors to find
+            stats: dict to add the visited and pruned (query, node) pairs
+                and wall time to, None to skip them unless metrics are enabled
+        Returns:
+            dists: (m, k)-shape array of ascending distances
+            ids: (m, k)-shape array of nearest neighbor ids"""
+        return _batch_query(self.root, points, k, self.ids.dtype, stats)
@@ -1,5 +1,7 @@
 # stdlib modules
+import hashlib
 import os
+from typing import Any, Iterator, Tuple
 
 # third-party modules
 from matplotlib import pyplot as plt
@@ -10,30 +12,205 @@ import pandas as pd
 from pandas import DataFrame
 
 # custom modules
+from projection import Equirectangular, Projection, PROJECTIONS
 import tree
 
 colors = ['red', 'orange', 'brown', 'green', 'cyan', 'magenta', 'black', 'gray']
 count = 0
 
 def to_global(coords: DataFrame) -> DataFrame:
-    """"""
-    lat_mean = np.average(coords['latitude'])
-    lon_mean = np.average(coords['longitude'])
-    r = 6371.0 # earth's radius
-    dlon = np.pi * (coords['longitude'] - lon_mean) / 180.0
-    dlat = np.pi * (coords['latitude'] - lat_mean) / 180.0
-    x = r * dlon * np.cos(np.pi * lat_mean / 180.0)
-    y = r * dlat
+    """Projects latitude and longitude columns into (x, y) coords in
+    kilometers centered at the middle point of all the stations."""
+    xs, ys = project(coords['latitude'].to_numpy(),
+                     coords['longitude'].to_numpy())
 
-    return (pd.concat([x, y], axis=1)).rename(columns={'longitude': 'x',
-                                                       'latitude': 'y'})
+    return DataFrame({'x': xs, 'y': ys}, index=coords.index)
 
 def load_ecobici(fname: str) -> DataFrame:
-    """"""
+    """Loads station ids and (x, y) coords from a CSV file inside data."""
     df = pd.read_csv(os.path.join('data', fname), encoding='ISO-8859-1')
     glob = to_global(df[['latitude', 'longitude']])
 
-    return pd.concat([df['id'], glob], axis=1)
+    return DataFrame({'id': df['id'], 'x': glob['x'], 'y': glob['y']})
+
+# columns kept by load_stations and their source names
+STATION_COLUMNS = {'id': 'id', 'lat': 'latitude', 'lon': 'longitude',
+                   'status': 'status'}
+
+def project(
+        lat: ndarray,
+        lon: ndarray,
+        origin: Tuple[float, float] = None) -> Tuple[ndarray, ndarray]:
+    """Maps latitudes and longitudes into (x, y) coordinates, in kilometers,
+    with an equirectangular projection centered at origin.
+    ---------------------------------------------------------------------------
+    Args:
+        lat: latitudes in degrees
+        lon: longitudes in degrees
+        origin: (lat, lon) center of the projection, the middle point if None
+    Returns:
+        xs, ys: projected coordinates"""
+    if origin is None:
+        return Equirectangular.centered(lat, lon).forward(lat, lon)
+
+    return Equirectangular(origin).forward(lat, lon)
+
+def read_chunks(path: str, chunksize: int = 100000) -> Iterator[dict]:
+    """Reads the station columns of a CSV or Parquet snapshot in chunks.
+    Parquet files require pyarrow.
+    ---------------------------------------------------------------------------
+    Args:
+        path: snapshot file path
+        chunksize: number of rows per chunk
+    Returns:
+        chunks: iterator of dicts mapping column names to arrays"""
+    names = list(STATION_COLUMNS.values())
+    if path.endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError('Reading Parquet snapshots requires pyarrow') \
+                from e
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize,
+                                                        columns=names):
+            yield {col: batch.column(name).to_numpy(zero_copy_only=False)
+                   for col, name in STATION_COLUMNS.items()}
+        return
+
+    reader = pd.read_csv(path, encoding='ISO-8859-1', usecols=names,
+                         chunksize=chunksize)
+    for df in reader:
+        yield {col: df[name].to_numpy() for col, name in
+               STATION_COLUMNS.items()}
+
+def load_stations(
+        path: str,
+        chunksize: int = 100000,
+        cache_dir: str = 'cache',
+        origin: Tuple[float, float] = None,
+        projection: Projection = None) -> ndarray:
+    """Loads a station snapshot into a record array with fields id, lat, lon,
+    status and projected coords x, y, coords being float64. Chunks are
+    projected as they are read when the projection is known beforehand.
+    Arrays are stored in a .npy sidecar inside cache_dir, keyed by the
+    snapshot path, size and modification time and by the projection, so
+    later loads map the sidecar instead of parsing the snapshot.
+    ---------------------------------------------------------------------------
+    Args:
+        path: CSV or Parquet snapshot file path
+        chunksize: number of rows read at once
+        cache_dir: directory of sidecar files, None to disable caching
+        origin: (lat, lon) center of an equirectangular projection
+        projection: projection of the coords, if neither it nor origin are
+            given an equirectangular one centered at the middle point of the
+            snapshot stations
+    Returns:
+        stations: record array, memory-mapped if cached"""
+    if projection is None and origin is not None:
+        projection = Equirectangular(origin)
+    if cache_dir is not None:
+        key = snapshot_key(path, projection)
+        sidecar = os.path.join(cache_dir, f'stations_{key}.npy')
+        if os.path.exists(sidecar):
+            return np.load(sidecar, mmap_mode='r').view(np.recarray)
+
+    chunks = []
+    for c in read_chunks(path, chunksize):
+        c['lat'], c['lon'] = c['lat'].astype(np.float64), \
+                             c['lon'].astype(np.float64)
+        if projection is not None: # project while streaming
+            c['x'], c['y'] = projection.forward(c['lat'], c['lon'])
+        chunks.append(c)
+    names = list(STATION_COLUMNS) + ([] if projection is None else ['x', 'y'])
+    cols = {col: np.concatenate([c[col] for c in chunks]) if chunks else
+            np.empty(0) for col in names}
+    lat, lon = cols['lat'], cols['lon']
+    if projection is None:
+        xs, ys = Equirectangular.centered(lat, lon).forward(lat, lon)
+    else:
+        xs, ys = cols['x'], cols['y']
+    status = cols['status'].astype(str)
+    dtype = [('id', cols['id'].dtype), ('lat', np.float64),
+             ('lon', np.float64), ('x', np.float64), ('y', np.float64),
+             ('status', status.dtype if len(status) else 'U1')]
+    stations = np.empty(len(lat), dtype=dtype).view(np.recarray)
+    stations.id, stations.lat, stations.lon = cols['id'], lat, lon
+    stations.x, stations.y, stations.status = xs, ys, status
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f'{sidecar}.{os.getpid()}.tmp.npy'
+        np.save(tmp, stations.view(np.ndarray))
+        os.replace(tmp, sidecar) # never a partial sidecar
+
+    return stations
+
+def snapshot_key(path: str, *extra: Any) -> str:
+    """Cache key of a snapshot file, from its absolute path, size and
+    modification time, so that it is computed without reading the file, and
+    from any extra parameters the cached data depends on."""
+    st = os.stat(path)
+    key = f'{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}'
+    if any(e is not None for e in extra):
+        key += ':' + ':'.join(map(repr, extra))
+
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+def load_projection(
+        path: str,
+        kind: str = 'equirectangular',
+        cache_dir: str = 'cache') -> Projection:
+    """Projection of some kind centered at the middle point of a snapshot's
+    stations. Its origin is stored in a JSON sidecar inside cache_dir, keyed
+    like load_stations sidecars, so only the first load parses the snapshot.
+    ---------------------------------------------------------------------------
+    Args:
+        path: CSV or Parquet snapshot file path
+        kind: projection kind, see projection.PROJECTIONS
+        cache_dir: directory of sidecar files, None to disable caching
+    Returns:
+        projection: projection centered at the snapshot's middle point"""
+    if cache_dir is not None:
+        sidecar = os.path.join(cache_dir,
+                               f'origin_{snapshot_key(path, kind)}.json')
+        if os.path.exists(sidecar):
+            return Projection.load(sidecar)
+    raw = load_stations(path, cache_dir=None)
+    P = PROJECTIONS[kind].centered(raw['lat'], raw['lon'])
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f'{sidecar}.{os.getpid()}.tmp'
+        P.save(tmp)
+        os.replace(tmp, sidecar)
+
+    return P
+
+def load_index(
+        stations: ndarray,
+        path: str,
+        cache_dir: str = 'cache',
+        projection: Projection = None) -> tree.FlatTree:
+    """Flat 2d-tree over the stations of a snapshot loaded by load_stations,
+    stored in a .npz sidecar inside cache_dir.
+    ---------------------------------------------------------------------------
+    Args:
+        stations: stations of the snapshot
+        path: snapshot file path, the sidecar key
+        cache_dir: directory of sidecar files
+        projection: projection the stations were loaded with, if any
+    Returns:
+        index: flat 2d-tree over the stations coords"""
+    key = snapshot_key(path, projection)
+    sidecar = os.path.join(cache_dir, f'tree_{key}.npz')
+    if os.path.exists(sidecar):
+        return tree.FlatTree.load(sidecar)
+    T = tree.FlatTree(np.asarray(stations.id), np.asarray(stations.x),
+                      np.asarray(stations.y))
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = f'{sidecar}.{os.getpid()}.tmp.npz'
+    T.save(tmp)
+    os.replace(tmp, sidecar)
+
+    return T
 
 def plot_positions(ax, x, y):
     """"""